@@ -7,9 +7,9 @@
 /*  Use at your own risk!  */
 /***************************/
 
-#define VERSION "v0.93"
+#define VERSION "v0.95"
 
-// Serial commands (19200-8N1):
+// Serial commands (19200-8N1 after reset, see 66 for faster baud rates):
 
 // 255 (0xFF): Start device (TriggerMode; only needed once at beginning) - Can now also stop device!
 //  99 (0x63): Identify device by blinking display
@@ -25,11 +25,24 @@
 //  78 (0x4E): Zero pulse count
 //  69 (0x45) + 1: Turn on display
 //  68 (0x44) + 0: Turn off display
+//  66 (0x42) + Index: Set baud rate (0: 19200, 1: 38400, 2: 57600, 3: 115200, 4: 250000, 5: 500000, 6: 1000000)
 //  65 (0x41): Query data
 //  58 (0x3A) + HighByte + LowByte: Set pulse repetition period [10...9999 * 1us]
 //  57 (0x39) + HighByte + LowByte: Set pulse width [10...9999 * 1us]
 //  33 (0x21): Emergency stop pulse sequence
 
+// Serial feedback on startup:
+
+// 101 (0x65): Serial port ready (sent once after reset, before the splash screen)
+
+// Baud rate change (command 66):
+
+// 115: Baud rate accepted (sent at the old baud rate, then the baud rate is changed)
+// The host then sends 85 (0x55) at the new baud rate within 500ms to confirm
+// 116: Confirmation received (sent at the new baud rate)
+// Without confirmation the device goes back to 19200 baud
+// 117: Baud rate index not supported (baud rate unchanged)
+
 #include <LiquidCrystal_I2C.h>  // LiquidCrystal_I2C library by Frank de Brabander, Version 1.1.2
 
 // No operation (single cycle, takes 62.5ns at 16MHz)
@@ -59,6 +72,13 @@ LiquidCrystal_I2C lcd(0x27,20,4);
 // Serial buffer for receiving setting values (needs to be declared globally for whatever reason...)
 byte value_buffer[2];
 
+// Baud rates (command 66 + index)
+#define BAUD_DEFAULT 19200        // Baud rate after reset and after a failed change
+#define BAUD_CONFIRM 85           // Sent by the host at the new baud rate
+#define BAUD_CONFIRM_TIMEOUT 500  // ms
+const long BAUD_RATES[] = {19200, 38400, 57600, 115200, 250000, 500000, 1000000};
+const uint8_t NUM_BAUD_RATES = 7;
+
 // Device settings (= defaults)
 int SET_VOLTAGE = 4000;           // Monopolar or positive bipolar output voltage (* 0.5mV)
 int SET_DAC_POS = 4048;           // DAC positive value (updated in setup)
@@ -116,6 +136,23 @@ void update_display() {
   }
 }
 
+// Change baud rate (keep it only if the host confirms at the new baud rate)
+void change_baudrate(long baudrate) {
+  unsigned long start_time;
+  Serial.flush();           // Send the acknowledgement at the old baud rate
+  Serial.end();
+  Serial.begin(baudrate);
+  start_time = millis();
+  while ((millis()-start_time) < BAUD_CONFIRM_TIMEOUT) {
+    if ((Serial.available() > 0) && (Serial.read() == BAUD_CONFIRM)) {  // Other bytes are noise from the change
+      Serial.write(116);
+      return;
+    }
+  }
+  Serial.end();             // No confirmation => back to the default baud rate
+  Serial.begin(BAUD_DEFAULT);
+}
+
 // Write voltage value into DAC (but do not yet output it)
 void writeDAC(int data) {             // 12 bits, 4095, 0xFFF
   DAC_PORT &= ~(1 << DAC_CLK_AVR);    // digitalWrite(DAC_CLK_PIN,LOW);
@@ -180,8 +217,9 @@ void setup() {
   pinMode(13,OUTPUT);
   digitalWrite(13,LOW);
   // Initialize serial connection
-  Serial.begin(19200);
+  Serial.begin(BAUD_DEFAULT);
   Serial.setTimeout(100);   // Set timeout to 100ms (for Serial.readBytes)
+  Serial.write(101);        // Tell the host that the bootloader has finished (commands are buffered from now on)
   // Initialize i2c LCD
   lcd.init();
   lcd.backlight();
@@ -549,6 +587,17 @@ void loop() {
           Serial.write(int(SET_BIPOLAR));
           Serial.write(int(SET_OPAMP_EN));
           break;
+        case 66:  // Set baud rate (new command)
+          num_bytes = Serial.readBytes(value_buffer,1);
+          if (num_bytes == 1) {
+            if (uint8_t(value_buffer[0]) < NUM_BAUD_RATES) {
+              // Serial feedback (at the old baud rate)
+              Serial.write(115);
+              change_baudrate(BAUD_RATES[value_buffer[0]]);
+            }
+            else Serial.write(117);
+          }
+          break;
         case 58:  // Set pulse repetition period in us (new command)
           num_bytes = Serial.readBytes(value_buffer,2);
           if (num_bytes == 2) {
@@ -19,8 +19,10 @@
 """
 
 import time
-import serial
 from tkinter import *
+from tkinter import ttk
+
+from fnmes import CommandQueue, MarkerPublisher, PresetStore, SessionLog, StimulatorPool
 
 # Find port address MAC
 # To find the address of the serial port, open terminal and type: ls /dev/*
@@ -34,168 +36,91 @@ from tkinter import *
 # 3. Locate your Arduino device. The port number will be displayed as "COM" followed by a number (e.g., COM3).
 # Use this COM port number in your script.
 
-# Initialize Serial Connections and wake up DACs
-ser1 = serial.Serial("YOUR/USB/PATH", 19200, timeout=0, writeTimeout=0)
-time.sleep(2)  # wait 2 s
-ser1.write(b'\xFF')  # Start device
+# One port per DAC (add or remove ports to control any number of DACs)
+PORTS = ["YOUR/USB/PATH", "YOUR/USB/PATH"]
+# Event markers for EEG/EMG: None (off), ("127.0.0.1", port) for UDP or a Unix domain socket path
+MARKERS = None
+# Session log of all serial traffic: None (off) or a file path (time.strftime fields give one file per session)
+SESSION_LOG = None
+# Baud rate after the start (firmware v0.95: up to 1000000; older firmware stays at 19200)
+BAUDRATE = 115200
+# Named parameter sets for all DACs, stored with their encoded frames
+PRESETS = "presets.fnpreset"
 
-ser2 = serial.Serial("YOUR/USB/PATH", 19200, timeout=0, writeTimeout=0)
-time.sleep(2)  # wait 2 s
-ser2.write(b'\xFF')  # Start device
 # Initialize Serial Connections and wake up DACs
+# All ports are opened at the same time; each DAC is started as soon as its Arduino has finished resetting
+# Each DAC gets its own I/O thread, and its reply bytes are read and confirmed in the background
+pool = StimulatorPool.open(PORTS, BAUDRATE)
+# Record every byte sent to and received from the DACs (binary session log)
+session_log = None
+if SESSION_LOG is not None:
+    session_log = SessionLog(time.strftime(SESSION_LOG))
+    for dac in pool:
+        session_log.attach(dac)
+if MARKERS is not None:
+    markers = MarkerPublisher(MARKERS)
+    for dac in pool:
+        markers.attach(dac)
+ALL = len(pool) + 1  # Column of the buttons that act on all DACs
 
 # Create GUI Window
 window = Tk()
 window.title("Arduino Controller")
-window.geometry("950x450")
+window.geometry("%ix580" % (240 * (ALL + 1)))
+# Serial I/O runs off the Tk thread; repeated requests are coalesced and results come back through after()
+commands = CommandQueue(pool, window, on_error=lambda error: Status.config(text="Error: %s" % error))
 
 # Define GUI functions
 
 def blink():
-    ser1.write(b'\x63')
-    ser2.write(b'\x63')
+    commands.broadcast(b'\x63')
 
 def LEDOFF():
-    ser1.write(b'\x44')
-    ser1.write(b'\x00')
-    ser2.write(b'\x44')
-    ser2.write(b'\x00')
+    commands.broadcast(b'\x44\x00', key="display")
 
 def LEDON():
-    ser1.write(b'\x45')
-    ser1.write(b'\x01')
-    ser2.write(b'\x45')
-    ser2.write(b'\x01')
+    commands.broadcast(b'\x45\x01', key="display")
 
 def Train_Reset():
-    ser1.write(b'\x4E')
-    ser2.write(b'\x4E')
-
-def Start_stim_DAC1():
-    ser1.write(b'\x50')
+    commands.broadcast(b'\x4E')
 
-def Start_stim_DAC2():
-    ser2.write(b'\x50')
+def Start_stim(i):
+    commands.send(i, b'\x50', key="start")
 
-def Start_stim_DAC1_2():
-    ser1.write(b'\x50')
-    ser2.write(b'\x50')
+# All ports are armed, then the start byte is written to each of them back to back
+def Start_stim_DACS():
+    commands.start_synchronized(callback=lambda report: Start_Skew.config(text="Start skew: %.0f us" % (report.skew * 1e6)))
 
-def stop():
-    ser1.write(b'\x21')
-    ser2.write(b'\x21')
+# Queued commands are dropped and the stop byte is written to all ports at once (also bound to the Escape key)
+def stop(event=None):
+    commands.stop()
 
 def Close_COM():
-    ser1.close()
-    ser2.close()
+    commands.close(callback=lambda _: session_log.close() if session_log is not None else None)
+    presets.close()
 
 def Bipolar():
-    ser1.write(b'\x62')
-    ser2.write(b'\x62')
+    commands.broadcast(b'\x62', key="mode")
 
 def MonopolarEN():
-    ser1.write(b'\x61')
-    ser2.write(b'\x61')
-
-def Pulses_DAC1():
-    Pulse_no = int(P_Input.get())
-    HB_p = Pulse_no // 256
-    LB_p = Pulse_no % 256
-    P_HB = HB_p.to_bytes(1, byteorder="little")
-    P_LB = LB_p.to_bytes(1, byteorder="little")
-    ser1.write(b'\x59')
-    ser1.write(P_HB)
-    ser1.write(P_LB)
-
-def Pulses_DAC2():
-    Pulse_no = int(P_Input2.get())
-    HB_p = Pulse_no // 256
-    LB_p = Pulse_no % 256
-    P_HB = HB_p.to_bytes(1, byteorder="little")
-    P_LB = LB_p.to_bytes(1, byteorder="little")
-    ser2.write(b'\x59')
-    ser2.write(P_HB)
-    ser2.write(P_LB)
-
-def Output_Voltage_DAC1():
-    OV = float(OV_Input.get())
-    HB_ov = int(OV // 128)
-    LB_ov = int((OV % 128) / 0.5)
-    OV_HB = HB_ov.to_bytes(1, byteorder="little")
-    OV_LB = LB_ov.to_bytes(1, byteorder="little")
-    ser1.write(b'\x53')
-    ser1.write(OV_HB)
-    ser1.write(OV_LB)
-
-def Output_Voltage_DAC2():
-    OV = float(OV_Input2.get())
-    HB_ov = int(OV // 128)
-    LB_ov = int((OV % 128) / 0.5)
-    OV_HB = HB_ov.to_bytes(1, byteorder="little")
-    OV_LB = LB_ov.to_bytes(1, byteorder="little")
-    ser2.write(b'\x53')
-    ser2.write(OV_HB)
-    ser2.write(OV_LB)
-
-def Pulse_Delay_ms_DAC1():
-    PD_ms = int(PP_Input.get())
-    PDms_hb = PD_ms // 25.6
-    PDms_lb = int(round((PD_ms % 25.6) / 0.1))
-    PDms_HB = PDms_hb.to_bytes(1, byteorder="little")
-    PDms_LB = PDms_lb.to_bytes(1, byteorder="little")
-    if PDms_hb > 0 or PDms_lb > 0:
-        ser1.write(b'\x58')
-        ser1.write(PDms_HB)
-        ser1.write(PDms_LB)
-
-def Pulse_Delay_ms_DAC2():
-    PD_ms = int(PP_Input2.get())
-    PDms_hb = PD_ms // 25.6
-    PDms_lb = int(round((PD_ms % 25.6) / 0.1))
-    PDms_HB = PDms_hb.to_bytes(1, byteorder="little")
-    PDms_LB = PDms_lb.to_bytes(1, byteorder="little")
-    if PDms_hb > 0 or PDms_lb > 0:
-        ser2.write(b'\x58')
-        ser2.write(PDms_HB)
-        ser2.write(PDms_LB)
-
-def Pulse_Width_us_DAC1():
-    PW_us = int(PWus_Input.get())
-    PWus_hb = PW_us // 256
-    PWus_lb = PW_us % 256
-    PWus_HB = PWus_hb.to_bytes(1, byteorder="little")
-    PWus_LB = PWus_lb.to_bytes(1, byteorder="little")
-    if PWus_hb > 0 or PWus_lb > 0:
-        ser1.write(b'\x39')
-        ser1.write(PWus_HB)
-        ser1.write(PWus_LB)
-
-def Pulse_Width_us_DAC2():
-    PW_us2 = int(PWus_Input2.get())
-    PWus_hb2 = PW_us2 // 256
-    PWus_lb2 = PW_us2 % 256
-    PWus_HB2 = PWus_hb2.to_bytes(1, byteorder="little")
-    PWus_LB2 = PWus_lb2.to_bytes(1, byteorder="little")
-    if PWus_hb2 > 0 or PWus_lb2 > 0:
-        ser2.write(b'\x39')
-        ser2.write(PWus_HB2)
-        ser2.write(PWus_LB2)
-
-def Send_DAC1():
-    Pulses_DAC1()
-    Pulse_Delay_ms_DAC1()
-    Pulse_Width_us_DAC1()
-    Output_Voltage_DAC1()
-
-def Send_DAC2():
-    Pulses_DAC2()
-    Pulse_Delay_ms_DAC2()
-    Pulse_Width_us_DAC2()
-    Output_Voltage_DAC2()
+    commands.broadcast(b'\x61', key="mode")
+
+def Parameters(i):
+    entries = Inputs[i]
+    return dict(count=int(entries["count"].get()),
+                period_ms=int(entries["period_ms"].get()),
+                width_us=int(entries["width_us"].get()),
+                voltage_mv=float(entries["voltage_mv"].get()))
+
+# Only parameters that changed since the last confirmed upload are sent, in a single write
+# (repeated clicks before the upload is written send the latest values once)
+def Send(i):
+    commands.send_parameters(i, **Parameters(i))
 
 def Send_DACS():
-    Send_DAC1()
-    Send_DAC2()
+    parameters = [Parameters(i) for i in range(len(pool))]
+    for i, values in enumerate(parameters):
+        commands.send_parameters(i, **values)
 
 # Define GUI elements
 
@@ -211,90 +136,96 @@ LED_ON.grid(column=1, row=1)
 Set_Count_0 = Button(window, text="Reset Count", bg="white", fg="black", width=22, height=2, font="bold", command=Train_Reset)
 Set_Count_0.grid(column=0, row=10)
 
-Start_DAC1 = Button(window, text="Start DAC1", bg="green", fg="black", font="bold", width=22, height=2, command=Start_stim_DAC1)
-Start_DAC1.grid(column=1, row=12)
-
-Start_DAC2 = Button(window, text="Start DAC2", bg="green", fg="black", font="bold", width=22, height=2, command=Start_stim_DAC2)
-Start_DAC2.grid(column=2, row=12)
+Start_DACS = Button(window, text="Start DACS", bg="green", fg="black", font="bold", width=22, height=2, command=Start_stim_DACS)
+Start_DACS.grid(column=ALL, row=12)
 
-Start_DAC1_2 = Button(window, text="Start DACS", bg="green", fg="black", font="bold", width=22, height=2, command=Start_stim_DAC1_2)
+Start_Skew = Label(window, text="", bg="white", fg="black")
+Start_Skew.grid(column=ALL, row=13)
 
-Start_DAC1_2 = Button(window, text="Start DACS", bg="green", fg="black", font="bold", width=22, height=2, command=Start_stim_DAC1_2)
-Start_DAC1_2.grid(column=3, row=12)
+Status = Label(window, text="", bg="white", fg="red")
+Status.grid(column=0, row=14, columnspan=ALL + 1)
 
 Stop_Train = Button(window, text="STOP", bg="red", fg="black", font="bold", width=22, height=2, command=stop)
 Stop_Train.grid(column=0, row=12)
+window.bind_all("<Escape>", stop)
 
 Close_Port = Button(window, text="Close Port", bg="white", fg="black", width=22, height=2, command=Close_COM)
 Close_Port.grid(column=0, row=0)
 
 Bipolar_En = Button(window, text="Bipolar (OpAmp Enabled)", bg="white", fg="black", width=22, height=2, command=Bipolar)
-Bipolar_En.grid(column=3, row=3)
+Bipolar_En.grid(column=ALL, row=3)
 
 Mono_EN = Button(window, text="Monopolar (OpAmp Enabled)", bg="white", fg="black", width=22, height=2, command=MonopolarEN)
-Mono_EN.grid(column=3, row=5)
+Mono_EN.grid(column=ALL, row=5)
 
 Set_Message = Label(window, text="Settings", bg="white", fg="black", width=22, height=2)
 Set_Message.grid(column=0, row=2)
 
-Input_User_Message1 = Label(window, text="DAC 1 Values", bg="white", fg="black", width=22, height=2)
-Input_User_Message1.grid(column=1, row=2)
-
-Input_User_Message2 = Label(window, text="DAC 2 Values", bg="white", fg="black", width=22, height=2)
-Input_User_Message2.grid(column=2, row=2)
-
-P_Message = Label(window, text="Number of Pulses (1-9999)", bg="white", fg="black", width=22, height=2)
-P_Message.grid(column=0, row=4)
-
-P_Input = Entry(window, bg="white", fg="black", font="bold")
-P_Input.insert(0, "30")
-P_Input.grid(column=1, row=4)
-
-P_Input2 = Entry(window, bg="white", fg="black", font="bold")
-P_Input2.insert(0, "30")
-P_Input2.grid(column=2, row=4)
-
-OV_Message = Label(window, text="Output Voltage (mV)", bg="white", fg="black", width=22, height=2)
-OV_Message.grid(column=0, row=9)
-
-OV_Input = Entry(window, bg="white", fg="black", font="bold")
-OV_Input.insert(0, "0")
-OV_Input.grid(column=1, row=9)
-
-OV_Input2 = Entry(window, bg="white", fg="black", font="bold")
-OV_Input2.insert(0, "0")
-OV_Input2.grid(column=2, row=9)
-
-PP_Message = Label(window, text="Pulse Delay (ms)", bg="white", fg="black", width=22, height=2)
-PP_Message.grid(column=0, row=5)
-
-PP_Input = Entry(window, bg="white", fg="black", width=20, font="bold")
-PP_Input.insert(0, "17")
-PP_Input.grid(column=1, row=5)
-
-PP_Input2 = Entry(window, bg="white", fg="black", width=20, font="bold")
-PP_Input2.insert(0, "17")
-PP_Input2.grid(column=2, row=5)
-
-PWus_Message = Label(window, text="Pulse Width (μs)", bg="white", fg="black", width=22, height=2)
-PWus_Message.grid(column=0, row=8)
-
-PWus_Input = Entry(window, bg="white", fg="black", font="bold")
-PWus_Input.insert(0, "100")
-PWus_Input.grid(column=1, row=8)
-
-PWus_Input2 = Entry(window, bg="white", fg="black", font="bold")
-PWus_Input2.insert(0, "100")
-PWus_Input2.grid(column=2, row=8)
-
-Send_DAC1_button = Button(window, text="Set DAC1", bg="white", fg="black", font="bold", width=22, height=2, command=Send_DAC1)
-Send_DAC1_button.grid(column=1, row=10)
-
-Send_DAC2_button = Button(window, text="Set DAC2", bg="white", fg="black", font="bold", width=22, height=2, command=Send_DAC2)
-Send_DAC2_button.grid(column=2, row=10)
-
-Send_DACS_button = Button(window, text="Set DAC1 & DAC2", bg="white", fg="black", font="bold", width=22, height=2, command=Send_DACS)
-Send_DACS_button.grid(column=3, row=10)
+# Settings (one row per parameter): label, parameter name, row, default value
+SETTINGS = [("Number of Pulses (1-9999)", "count", 4, "30"),
+            ("Pulse Delay (ms)", "period_ms", 5, "17"),
+            ("Pulse Width (μs)", "width_us", 8, "100"),
+            ("Output Voltage (mV)", "voltage_mv", 9, "0")]
+
+for text, name, row, default in SETTINGS:
+    Setting_Message = Label(window, text=text, bg="white", fg="black", width=22, height=2)
+    Setting_Message.grid(column=0, row=row)
+
+# One column of input fields and Set/Start buttons per DAC
+Inputs = []
+
+for i, dac in enumerate(pool):
+    Input_User_Message = Label(window, text="%s Values" % dac.name, bg="white", fg="black", width=22, height=2)
+    Input_User_Message.grid(column=i + 1, row=2)
+
+    entries = {}
+    for text, name, row, default in SETTINGS:
+        entries[name] = Entry(window, bg="white", fg="black", font="bold")
+        entries[name].insert(0, default)
+        entries[name].grid(column=i + 1, row=row)
+    Inputs.append(entries)
+
+    Send_button = Button(window, text="Set %s" % dac.name, bg="white", fg="black", font="bold", width=22, height=2, command=lambda i=i: Send(i))
+    Send_button.grid(column=i + 1, row=10)
+
+    Start_button = Button(window, text="Start %s" % dac.name, bg="green", fg="black", font="bold", width=22, height=2, command=lambda i=i: Start_stim(i))
+    Start_button.grid(column=i + 1, row=12)
+
+Send_DACS_button = Button(window, text="Set All DACS", bg="white", fg="black", font="bold", width=22, height=2, command=Send_DACS)
+Send_DACS_button.grid(column=ALL, row=10)
+
+# Presets: recalling sends the frames encoded when the preset was saved (one write per DAC), then fills in the fields
+presets = PresetStore(PRESETS)
+
+def Save_Preset():
+    name = Preset_Name.get().strip()
+    if name:
+        try:
+            presets.save(name, [Parameters(i) for i in range(len(pool))])
+        except ValueError as error:
+            Status.config(text="Error: %s" % error)
+        Preset_Name["values"] = presets.names()
+
+def Recall_Preset():
+    name = Preset_Name.get().strip()
+    if name not in presets:
+        Status.config(text="Error: no preset named %r" % name)
+        return
+    for i, frame in enumerate(presets.frames(name)[:len(pool)]):
+        commands.send(i, frame, key="parameters")
+    for entries, values in zip(Inputs, presets.parameters(name)):
+        for key, entry in entries.items():
+            entry.delete(0, END)
+            entry.insert(0, values.get(key, 0))
+
+Preset_Name = ttk.Combobox(window, values=presets.names())
+Preset_Name.grid(column=1, row=15)
+
+Save_Preset_button = Button(window, text="Save Preset", bg="white", fg="black", width=22, height=2, command=Save_Preset)
+Save_Preset_button.grid(column=0, row=15)
+
+Recall_Preset_button = Button(window, text="Recall Preset", bg="white", fg="black", font="bold", width=22, height=2, command=Recall_Preset)
+Recall_Preset_button.grid(column=ALL, row=15)
 
 # Loop window
 window.mainloop()
@@ -29,30 +29,74 @@
 
 # Import modules
 
-from tkinter import *
-
 import time
+from tkinter import *
+from tkinter import ttk
 
-import serial
+from fnmes import CommandQueue, MarkerPublisher, PresetStore, SessionLog, StatePoller, StimulatorPool
 
 ##################################################################################################################################
 
 # Define Serial
-# wake up DACs
+# One port per DAC (add or remove ports to control any number of DACs: DAC1, DAC2, ...)
+
+PORTS = ["/dev/tty.usbmodem1464101",
+         "/dev/tty.usbmodem1464201"]
+
+# Event markers for EEG/EMG acquisition software: None (off), ("127.0.0.1", port) for UDP,
+# or the path of a Unix domain socket (start, end of train and stop of every DAC, see README)
+
+MARKERS = None
+
+# Session log of every byte sent to and received from the DACs (see README): None (off) or a file path.
+# time.strftime fields give one file per session (e.g. "logs/session_%Y%m%d_%H%M%S.fnlog"); a fixed name
+# is overwritten at every start. Each file takes 32 MiB.
+
+SESSION_LOG = None
+
+# Baud rate: the DACs start at 19200 and are then switched to this rate (firmware v0.95: 19200, 38400,
+# 57600, 115200, 250000, 500000 or 1000000). DACs with older firmware, or that do not confirm, stay at 19200.
+
+BAUDRATE = 115200
+
+# Preset file (named parameter sets for all DACs, stored with their encoded frames)
+
+PRESETS = "presets.fnpreset"
 
-ser1 = serial.Serial("/dev/tty.usbmodem1464101",
-                     19200, timeout=0, writeTimeout=0)
+# wake up DACs (all ports at once; each is started as soon as its Arduino has finished resetting)
+# Each DAC gets its own I/O thread and a background thread that reads and confirms the firmware's reply bytes
 
-time.sleep(2)  # wait 2 s
+pool = StimulatorPool.open(PORTS, BAUDRATE)
 
-ser1.write(b'\xFF')  # Start device
+# Record every byte sent to and received from the DACs (binary session log, see README)
 
-ser2 = serial.Serial("/dev/tty.usbmodem1464201",
-                     19200, timeout=0, writeTimeout=0)
+session_log = None
 
-time.sleep(2)  # wait 2 s
+if SESSION_LOG is not None:
 
-ser2.write(b'\xFF')  # Start device
+    session_log = SessionLog(time.strftime(SESSION_LOG))
+
+    for dac in pool:
+
+        session_log.attach(dac)
+
+if MARKERS is not None:
+
+    markers = MarkerPublisher(MARKERS)
+
+    for dac in pool:
+
+        markers.attach(dac)
+
+# Keep a mirror of all devices' settings (Query Data once per second while idle)
+
+poller = StatePoller(pool, interval=1.0)
+
+poller.start()
+
+# Column of the buttons that act on all DACs
+
+ALL = len(pool) + 1
 
 ##################################################################################################################################
 
@@ -65,6 +109,21 @@ window.title("Arduino Controller")
 
 window.geometry()
 
+# All serial I/O runs off the Tk thread: buttons queue their commands and return at once,
+# repeated requests are coalesced while they wait and results come back through after()
+
+
+def Show_Error(error):
+
+    Status.config(text="Error: %s" % error)
+
+
+commands = CommandQueue(pool, window, on_error=Show_Error)
+
+Status = Label(window, text="", bg="white", fg="red", justify='left')
+
+Status.grid(column=0, row=14, columnspan=ALL + 1)
+
 ##################################################################################################################################
 
 # # Click Settings (On, Off, Blink, LED on/off, and Query data), Reset Pulse Count and Start Stim##
@@ -74,7 +133,7 @@ window.geometry()
 
 def blink():
 
-    ser.write(b'\x63')  # Send byte for Blink
+    commands.broadcast(b'\x63')  # Send byte for Blink
 
 
 Blink = Button(window, text="Blink", bg="white", fg="black", width=22,
@@ -87,13 +146,7 @@ Blink.grid(column=1, row=0)
 
 def LEDOFF():
 
-    ser1.write(b'\x44')  # Display Off
-
-    ser1.write(b'\x00')
-
-    ser2.write(b'\x44')  # Display Off
-
-    ser2.write(b'\x00')
+    commands.broadcast(b'\x44\x00', key="display")  # Display Off
 
 
 LED_OFF = Button(window, text="Screen Off", bg="white", fg="black",
@@ -104,13 +157,7 @@ LED_OFF.grid(column=0, row=1)
 
 def LEDON():
 
-    ser1.write(b'\x45')  # Display On
-
-    ser1.write(b'\x01')
-
-    ser2.write(b'\x45')  # Display On
-
-    ser2.write(b'\x01')
+    commands.broadcast(b'\x45\x01', key="display")  # Display On
 
 
 LED_ON = Button(window, text="Screen On", bg="white", fg="black",
@@ -119,25 +166,38 @@ LED_ON = Button(window, text="Screen On", bg="white", fg="black",
 LED_ON.grid(column=1, row=1)
 
 
-# ## Query Data
+# ## Query Data (decoded device settings are shown below the Start buttons)
+
+def Q_Data():
+
+    for i in range(len(pool)):
+
+        commands.device(i, "request_state")  # Not sent while a pulse train is running
+
+    window.after(200, Show_Data)
+
 
-# def Q_Data():
+def Show_Data():
 
-#     ser1.write(b'\x41')
-#     ser2.write(b'\x41')
+    Query_Result.config(text="\n".join("%s: %s" % (dac.name, dac.state or "no data")
+                                       for dac in pool))
 
 
-# Query_Data = Button(window, text="Query Data", bg="white", fg="black",width=22, height=2,justify='center',wraplength=120,command=Q_Data)
+Query_Data = Button(window, text="Query Data", bg="white", fg="black", width=22,
+                    height=2, justify='center', wraplength=120, command=Q_Data)
 
-# Query_Data.grid(column=2, row=1)
+Query_Data.grid(column=2, row=1)
+
+Query_Result = Label(window, text="", bg="white", fg="black", justify='left')
+
+Query_Result.grid(column=0, row=13, columnspan=ALL)
 
 
 # Set Train Count to 0
 
 def Train_Reset():
 
-    ser1.write(b'\x4E')
-    ser2.write(b'\x4E')
+    commands.broadcast(b'\x4E')
 
 
 Set_Count_0 = Button(window, text="Reset Count", bg="white", fg="black", width=22,
@@ -146,46 +206,47 @@ Set_Count_0 = Button(window, text="Reset Count", bg="white", fg="black", width=2
 Set_Count_0.grid(column=0, row=10)
 
 
-# Start Stimulation DAC1
-
-def Start_stim_DAC1():
+# Start Stimulation
 
-    ser1.write(b'\x50')
+def Start_stim(i):
 
+    commands.send(i, b'\x50', key="start")
 
-def Start_stim_DAC2():
 
-    ser2.write(b'\x50')
+def Start_stim_DACS():
 
+    # Synchronized start: all ports are armed, then written back to back
+    commands.start_synchronized(callback=Show_Skew)
 
-def Start_stim_DAC1_2():
 
-    ser1.write(b'\x50')
-    ser2.write(b'\x50')
+def Show_Skew(report):
 
+    Start_Skew.config(text="Start skew: %.0f us" % (report.skew * 1e6))
 
-Send_settings = Button(window, text="Start DAC1", bg="green", fg="black",
-                       font="bold", width=22, height=2, command=Start_stim_DAC1)
 
-Send_settings.grid(column=1, row=12)
+for i, dac in enumerate(pool):
 
-Send_settings = Button(window, text="Start DAC2", bg="green", fg="black",
-                       font="bold", width=22, height=2, command=Start_stim_DAC2)
+    Send_settings = Button(window, text="Start %s" % dac.name, bg="green", fg="black",
+                           font="bold", width=22, height=2, command=lambda i=i: Start_stim(i))
 
-Send_settings.grid(column=2, row=12)
+    Send_settings.grid(column=i + 1, row=12)
 
 Send_settings = Button(window, text="Start DACS", bg="green", fg="black",
-                       font="bold", width=22, height=2, command=Start_stim_DAC1_2)
+                       font="bold", width=22, height=2, command=Start_stim_DACS)
+
+Send_settings.grid(column=ALL, row=12)
+
+Start_Skew = Label(window, text="", bg="white", fg="black", justify='center')
 
-Send_settings.grid(column=3, row=12)
+Start_Skew.grid(column=ALL, row=13)
 
 #   Emergency Stop which interupts the train of pulses
+#   Queued commands are dropped and the stop byte is written to all ports at once (also bound to the Escape key)
 
 
-def stop():
+def stop(event=None):
 
-    ser1.write(b'\x21')
-    ser2.write(b'\x21')
+    commands.stop()
 
 
 Stop_Train = Button(window, text="STOP", bg="red", fg="black",
@@ -193,13 +254,19 @@ Stop_Train = Button(window, text="STOP", bg="red", fg="black",
 
 Stop_Train.grid(column=0, row=12)
 
+window.bind_all("<Escape>", stop)
+
 
 # Close Port
 
 def Close_COM():
 
-    ser1.close()  # Close Port
-    ser2.close()  # Close Port
+    poller.stop()
+
+    # Close Ports (after queued commands)
+    commands.close(callback=lambda _: session_log.close() if session_log is not None else None)
+
+    presets.close()
 
 
 Close_Port = Button(window, text="Close Port", bg="white", fg="black",
@@ -214,86 +281,24 @@ Close_Port.grid(column=0, row=0)
 
 def Bipolar():
 
-    ser1.write(b'\x62')  # Set bipolar (OpAmp Enabled)
-    ser2.write(b'\x62')  # Set bipolar (OpAmp Enabled)
+    commands.broadcast(b'\x62', key="mode")  # Set bipolar (OpAmp Enabled)
 
 
 Bipolar_En = Button(window, text="Bipolar (OpAmp Enabled)", bg="white", fg="black",
                     width=22, height=2, justify='center', wraplength=120, command=Bipolar)
 
-Bipolar_En.grid(column=3, row=3)
+Bipolar_En.grid(column=ALL, row=3)
 
 
 def MonopolarEN():
 
-    ser1.write(b'\x61')  # Set Monopolar (OpAmp Enabled)
-    ser2.write(b'\x61')  # Set Monopolar (OpAmp Enabled)
+    commands.broadcast(b'\x61', key="mode")  # Set Monopolar (OpAmp Enabled)
 
 
 Mono_EN = Button(window, text="Monopolar (OpAmp Enabled)", bg="white", fg="black",
                  width=22, height=2, justify='center', wraplength=120, command=MonopolarEN)
 
-Mono_EN.grid(column=3, row=5)
-
-##################################################################################################################################
-
-# Set Trigger mode (0-3)## DAC1
-
-
-def Trigger_DAC1():
-
-    Trigger1 = int(Trigger_Input1.get())  # Get user input and convert to int
-
-    # Convert integer to byte
-    Trig1 = (Trigger1).to_bytes(1, byteorder="little")
-
-    ser1.write(b'\x5A')  # Set Trigger Mode
-
-    ser1.write(Trig1)  # Set Trigger Mode (Available inputs: 0,1,2,3)
-
-
-Trigger_Message = Label(window, text="Trigger Number", bg="white",
-                        fg="black", justify='center', wraplength=120, width=22, height=2)
-
-Trigger_Message.grid(column=0, row=3)
-
-
-Trigger_Input1 = Entry(window, bg="white", fg="black",
-                       font="bold", justify='center')
-
-Trigger_Input1.insert(0, "0")
-
-Trigger_Input1.grid(column=1, row=3)
-
-
-##################################################################################################################################
-
-# Set Trigger mode (0-3)## DAC2
-
-def Trigger_DAC2():
-
-    Trigger2 = int(Trigger_Input2.get())  # Get user input and convert to int
-
-    # Convert integer to byte
-    Trig2 = (Trigger2).to_bytes(1, byteorder="little")
-
-    ser2.write(b'\x5A')  # Set Trigger Mode
-
-    ser2.write(Trig2)  # Set Trigger Mode (Available inputs: 0,1,2,3)
-
-
-Trigger_Message = Label(window, text="Trigger Number", bg="white",
-                        fg="black", justify='center', wraplength=120, width=22, height=2)
-
-Trigger_Message.grid(column=0, row=3)
-
-
-Trigger_Input2 = Entry(window, bg="white", fg="black",
-                       font="bold", justify='center')
-
-Trigger_Input2.insert(0, "0")
-
-Trigger_Input2.grid(column=2, row=3)
+Mono_EN.grid(column=ALL, row=5)
 
 ##################################################################################################################################
 
@@ -304,715 +309,178 @@ Set_Message = Label(window, text="Settings", bg="white", fg="black",
 
 Set_Message.grid(column=0, row=2)
 
-
-Input_User_Message = Label(window, text="DAC 1 Values", bg="white",
-                           fg="black", width=22, height=2, justify='center', wraplength=120)
-
-Input_User_Message.grid(column=1, row=2)
-
-Input_User_Message = Label(window, text="DAC 2 Values", bg="white",
-                           fg="black", width=22, height=2, justify='center', wraplength=120)
-
-Input_User_Message.grid(column=2, row=2)
-
-##################################################################################################################################
-
-# Set number of pulses for DAC1
-
-
-def Pulses_DAC1():
-
-    Pulse_no = int(P_Input.get())  # Get user input and convert to int
-
-    #   Create integer for high & low byte
-
-    # Integer (floor division) divided by high byte for 'Pulse Repetition Time' (256)
-    HB_p = Pulse_no//256
-
-    LB_p = int((Pulse_no % 256)/1)  # Calculate remainder (modulo division)
-
-    #   Create high and low byte for serial command
-
-    P_HB = (HB_p).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-    P_LB = (LB_p).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-    #   Send Serial Command for Repetition Time
-
-    ser1.write(b'\x59')  # Send serial Command to input number of pulses (x59)
-
-    ser1.write(P_HB)  # Set Highbyte
-
-    ser1.write(P_LB)  # Set Lowbyte
-
-
-P_Message = Label(window, text="Number of Pulses (1-9999)", bg="white",
-                  fg="black", width=22, height=2, justify='center', wraplength=120)
-
-P_Message.grid(column=0, row=4)
-
-P_Input = Entry(window, bg="white", fg="black", justify='center', font="bold")
-
-P_Input.insert(0, "30")
-
-P_Input.grid(column=1, row=4)
-
-##################################################################################################################################
-
-# Set number of pulses for DAC2
-
-
-def Pulses_DAC2():
-
-    Pulse_no = int(P_Input2.get())  # Get user input and convert to int
-
-    #   Create integer for high & low byte
-
-    # Integer (floor division) divided by high byte for 'Pulse Repetition Time' (256)
-    HB_p = Pulse_no//256
-
-    LB_p = int((Pulse_no % 256)/1)  # Calculate remainder (modulo division)
-
-    #   Create high and low byte for serial command
-
-    P_HB = (HB_p).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-    P_LB = (LB_p).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-    #   Send Serial Command for Repetition Time
-
-    ser2.write(b'\x59')  # Send serial Command to input number of pulses (x59)
-
-    ser2.write(P_HB)  # Set Highbyte
-
-    ser2.write(P_LB)  # Set Lowbyte
-
-
-P_Message = Label(window, text="Number of Pulses (1-9999)", bg="white",
-                  fg="black", width=22, height=2, justify='center', wraplength=120)
-
-P_Message.grid(column=0, row=4)
-
-P_Input2 = Entry(window, bg="white", fg="black", justify='center', font="bold")
-
-P_Input2.insert(0, "30")
-
-P_Input2.grid(column=2, row=4)
-
-##################################################################################################################################
-
-# Set Ouput Voltage Width - DAC1
-
-
-def Output_Voltage_DAC1():
-
-    OV = float(OV_Input.get())  # Get user input
-
-
-#   Create integer for high and low byte
-
-    # Input (floor division) divided by high byte for 'Output Voltage' (128 mV) and convert to int
-    HB_ov = int(OV//128)
-
-    # Calculate remainder (modulo division), then divide by low byte (0.5)) and convert to int
-    LB_ov = int((OV % 128)/0.5)
-
-
-#   Covert int to byte for high and low byte for serial command
-
-    OV_HB = (HB_ov).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-    OV_LB = (LB_ov).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for voltage output (x53)
-
-    ser1.write(b'\x53')  # Serial Command for Repetition Time
-
-    ser1.write(OV_HB)  # Set Highbyte
-
-    ser1.write(OV_LB)  # Set Lowbyte
-
-#   Create high and low byte for serial command
-
-
-OV_Message = Label(window, text="Output Voltage (mV)", bg="white",
-                   fg="black", width=22, height=2, justify='center', wraplength=120)
-
-OV_Message.grid(column=0, row=9)
-
-
-OV_Input = Entry(window, bg="white", fg="black", font="bold", justify='center')
-
-OV_Input.insert(0, "0")
-
-OV_Input.grid(column=1, row=9)
-
-##################################################################################################################################
-
-
-# Set Ouput Voltage Width - DAC2
-
-def Output_Voltage_DAC2():
-
-    OV = float(OV_Input2.get())  # Get user input
-
-
-#   Create integer for high and low byte
-
-    # Input (floor division) divided by high byte for 'Output Voltage' (128 mV) and convert to int
-    HB_ov = int(OV//128)
-
-    # Calculate remainder (modulo division), then divide by low byte (0.5)) and convert to int
-    LB_ov = int((OV % 128)/0.5)
-
-
-#   Covert int to byte for high and low byte for serial command
-
-    OV_HB = (HB_ov).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-    OV_LB = (LB_ov).to_bytes(1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for voltage output (x53)
-
-    ser2.write(b'\x53')  # Serial Command for Repetition Time
-
-    ser2.write(OV_HB)  # Set Highbyte
-
-    ser2.write(OV_LB)  # Set Lowbyte
-
-#   Create high and low byte for serial command
-
-
-OV_Message = Label(window, text="Output Voltage (mV)", bg="white",
-                   fg="black", width=22, height=2, justify='center', wraplength=120)
-
-OV_Message.grid(column=0, row=9)
-
-
-OV_Input2 = Entry(window, bg="white", fg="black",
-                  font="bold", justify='center')
-
-OV_Input2.insert(0, "0")
-
-OV_Input2.grid(column=2, row=9)
-
-##################################################################################################################################
-# Delay in-between pulses of a train (milliseconds) DAC1
-
-
-def Pulse_Delay_ms_DAC1():
-
-    PD_ms = int(PP_Input.get())  # Get user input and conv to byte
-
-
-#   Create integer for highbyte and lowbyte
-
-    # Integer (floor division) divided by high byte for high byte (26.6 ms)
-    PDms_hb = int(PD_ms//25.6)
-
-    # Input divide (modulo division) low byte (0.1) then conv to int
-    PDms_lb = int(round(((PD_ms % 25.6)/.1), 2))
-
-
-#   Create high and low byte for serial command
-
-    PDms_HB = (PDms_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-    PDms_LB = (PDms_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for Pulse Width in microseconds (x58) if input is > 0
-
-    if (PDms_hb > 0 or PDms_lb > 0):
-
-        #   Send Serial Command for Repetition Time
-
-        ser1.write(b'\x58')  # Serial Command for Repetition Period
-
-        ser1.write(PDms_HB)  # Set Highbyte
-
-        ser1.write(PDms_LB)  # Set Lowbyte
-
-
-PP_Message = Label(window, text="Pulse Delay (ms)", bg="white",
-                   fg="black", width=22, height=2, justify='center', wraplength=120)
-
-PP_Message.grid(column=0, row=5)
-
-
-PP_Input = Entry(window, bg="white", fg="black",
-                 width=20, font="bold", justify='center')
-
-PP_Input.insert(0, "17")
-
-PP_Input.grid(column=1, row=5)
-
-##################################################################################################################################
-
-# Delay in-between pulses of a train (milliseconds) DAC2
-
-
-def Pulse_Delay_ms_DAC2():
-
-    PD_ms = int(PP_Input2.get())  # Get user input and conv to byte
-
-
-#   Create integer for highbyte and lowbyte
-
-    # Integer (floor division) divided by high byte for high byte (26.6 ms)
-    PDms_hb = int(PD_ms//25.6)
-
-    # Input divide (modulo division) low byte (0.1) then conv to int
-    PDms_lb = int(round(((PD_ms % 25.6)/.1), 2))
-
-
-#   Create high and low byte for serial command
-
-    PDms_HB = (PDms_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-    PDms_LB = (PDms_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for Pulse Width in microseconds (x58) if input is > 0
-
-    if (PDms_hb > 0 or PDms_lb > 0):
-
-        #   Send Serial Command for Repetition Time
-
-        ser2.write(b'\x58')  # Serial Command for Repetition Period
-
-        ser2.write(PDms_HB)  # Set Highbyte
-
-        ser2.write(PDms_LB)  # Set Lowbyte
-
-
-PP_Message = Label(window, text="Pulse Delay (ms)", bg="white",
-                   fg="black", width=22, height=2, justify='center', wraplength=120)
-
-PP_Message.grid(column=0, row=5)
-
-
-PP_Input2 = Entry(window, bg="white", fg="black",
-                  width=20, font="bold", justify='center')
-
-PP_Input2.insert(0, "17")
-
-PP_Input2.grid(column=2, row=5)
-
 ##################################################################################################################################
-# Delay in-between pulses of a train (microseconds) DAC1
-
-
-def Pulse_Delay_us_DAC1():
-
-    PD_us = int(PDus_Input.get())  # Get user input and conv to byte
-
-
-#   Create integer for highbyte and lowbyte
-
-    # Integer (floor division) divided by high byte for high byte (26.6 ms)
-    PDus_hb = PD_us//256
-
-    # Input divide (modulo division) low byte (0.1) then conv to int
-    PDus_lb = int((PD_us % 256)/1)
-
-
-#   Create high and low byte for serial command
-
-    PDus_HB = (PDus_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-    PDus_LB = (PDus_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for Pulse Width in microseconds (x3A) if input is > 0
-
-    if (PDus_hb > 0 or PDus_lb > 0):
-
-        #   Send Serial Command for Repetition Time
-
-        ser1.write(b'\x3A')  # Serial Command for Repetition Period
-
-        ser1.write(PDus_HB)  # Set Highbyte
-
-        ser1.write(PDus_LB)  # Set Lowbyte
-
-
-PDus_Message = Label(window, text="Pulse Delay (us)", bg="white",
-                     fg="black", width=22, height=2, justify='center', wraplength=120)
-
-PDus_Message.grid(column=0, row=6)
-
-
-PDus_Input = Entry(window, bg="white", fg="black",
-                   width=20, font="bold", justify='center')
-
-PDus_Input.insert(0, "0")
-
-PDus_Input.grid(column=1, row=6)
-
-##################################################################################################################################
-
-# Delay in-between pulses of a train (microseconds) DAC2
-
-
-def Pulse_Delay_us_DAC2():
-
-    PD_us = int(PDus_Input2.get())  # Get user input and conv to byte
-
-
-#   Create integer for highbyte and lowbyte
-
-    # Integer (floor division) divided by high byte for high byte (26.6 ms)
-    PDus_hb = PD_us//256
-
-    # Input divide (modulo division) low byte (0.1) then conv to int
-    PDus_lb = int((PD_us % 256)/1)
-
-
-#   Create high and low byte for serial command
-
-    PDus_HB = (PDus_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-    PDus_LB = (PDus_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for Pulse Width in microseconds (x3A) if input is > 0
-
-    if (PDus_hb > 0 or PDus_lb > 0):
 
-        #   Send Serial Command for Repetition Time
+# Settings (one row per parameter): label, parameter name, row, default value
 
-        ser2.write(b'\x3A')  # Serial Command for Repetition Period
+SETTINGS = [("Trigger Number", "trigger", 3, "0"),
+            ("Number of Pulses (1-9999)", "count", 4, "30"),
+            ("Pulse Delay (ms)", "period_ms", 5, "17"),
+            ("Pulse Delay (us)", "period_us", 6, "0"),
+            ("Pulse Width (ms)", "width_ms", 7, "0"),
+            ("Pulse Width (μs)", "width_us", 8, "100"),
+            ("Output Voltage (mV)", "voltage_mv", 9, "0")]
 
-        ser2.write(PDus_HB)  # Set Highbyte
+for text, name, row, default in SETTINGS:
 
-        ser2.write(PDus_LB)  # Set Lowbyte
+    Setting_Message = Label(window, text=text, bg="white", fg="black",
+                            width=22, height=2, justify='center', wraplength=120)
 
-
-PDus_Message = Label(window, text="Pulse Delay (us)", bg="white",
-                     fg="black", width=22, height=2, justify='center', wraplength=120)
-
-PDus_Message.grid(column=0, row=6)
-
-
-PDus_Input2 = Entry(window, bg="white", fg="black",
-                    width=20, font="bold", justify='center')
-
-PDus_Input2.insert(0, "0")
-
-PDus_Input2.grid(column=2, row=6)
+    Setting_Message.grid(column=0, row=row)
 
 ##################################################################################################################################
 
-# Set Pulse Width (milliseconds) DAC1
-
-
-def Pulse_Width_ms_DAC1():
-
-    PW_ms = int(PWms_Input.get())  # Get user input
-
-
-#   Create integer for highbyte
-
-    # Integer (floor division) divided by high byte for pulse width (25.6 ms)
-    PWms_hb = int(PW_ms//25.6)
+# Input fields for each DAC (one column per DAC)
 
-    # Take user input modulo division by 25.6 and divide by 0.1 then convert to int
-    PWms_lb = int(round(((PW_ms % 25.6)/.1), 2))
+Inputs = []
 
+for i, dac in enumerate(pool):
 
-#   Create high and low byte for serial command
+    Input_User_Message = Label(window, text="%s Values" % dac.name, bg="white",
+                               fg="black", width=22, height=2, justify='center', wraplength=120)
 
-    PWms_HB = (PWms_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
+    Input_User_Message.grid(column=i + 1, row=2)
 
-    PWms_LB = (PWms_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
+    entries = {}
 
+    for text, name, row, default in SETTINGS:
 
-#   Send Serial Command for Repetition Time (x57)
+        entries[name] = Entry(window, bg="white", fg="black",
+                              font="bold", justify='center')
 
-    if PWms_hb > 0 or PWms_lb > 0:
+        entries[name].insert(0, default)
 
-        ser1.write(b'\x57')  # Serial Command for Pulse Width
+        entries[name].grid(column=i + 1, row=row)
 
-        ser1.write(PWms_HB)  # Set Highbyte
-
-        ser1.write(PWms_LB)  # Set Lowbyte
-
-
-PWms_Message = Label(window, text="Pulse Width (ms)", bg="white",
-                     fg="black", width=22, height=2, justify='center', wraplength=120)
-
-PWms_Message.grid(column=0, row=7)
-
-
-PWms_Input = Entry(window, bg="white", fg="black",
-                   font="bold", justify='center')
-
-PWms_Input.insert(0, "0")
-
-PWms_Input.grid(column=1, row=7)
+    Inputs.append(entries)
 
 ##################################################################################################################################
-
-# Set Pulse Width (milliseconds) DAC2
-
-
-def Pulse_Width_ms_DAC2():
-
-    PW_ms = int(PWms_Input2.get())  # Get user input
+# Read parameters from the input fields
 
 
-#   Create integer for highbyte
+def Parameters(i):
 
-    # Integer (floor division) divided by high byte for pulse width (25.6 ms)
-    PWms_hb = int(PW_ms//25.6)
+    entries = Inputs[i]
 
-    # Take user input modulo division by 25.6 and divide by 0.1 then convert to int
-    PWms_lb = int(round(((PW_ms % 25.6)/.1), 2))
-
-
-#   Create high and low byte for serial command
-
-    PWms_HB = (PWms_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-    PWms_LB = (PWms_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for Repetition Time (x57)
-
-    if PWms_hb > 0 or PWms_lb > 0:
-
-        ser2.write(b'\x57')  # Serial Command for Pulse Width
-
-        ser2.write(PWms_HB)  # Set Highbyte
-
-        ser2.write(PWms_LB)  # Set Lowbyte
-
-
-PWms_Message = Label(window, text="Pulse Width (ms)", bg="white",
-                     fg="black", width=22, height=2, justify='center', wraplength=120)
-
-PWms_Message.grid(column=0, row=7)
-
-
-PWms_Input2 = Entry(window, bg="white", fg="black",
-                    font="bold", justify='center')
-
-PWms_Input2.insert(0, "0")
-
-PWms_Input2.grid(column=2, row=7)
+    return dict(trigger=int(entries["trigger"].get()),
+                count=int(entries["count"].get()),
+                period_ms=int(entries["period_ms"].get()),
+                period_us=int(entries["period_us"].get()),
+                width_ms=int(entries["width_ms"].get()),
+                width_us=int(entries["width_us"].get()),
+                voltage_mv=float(entries["voltage_mv"].get()))
 
 ##################################################################################################################################
-# Set Pulse Width (milliseconds) DAC1
-
-
-def Pulse_Width_us_DAC1():
-
-    PW_us = int(PWus_Input2.get())  # Get user input
-
-
-#   Create integer for highbyte
-
-    # Integer (floor division) divided by high byte for repeition width (256 ms)
-    PWus_hb = PW_us//256
+# Set parameters for one DAC (only changed parameters, in one write; repeated clicks upload the latest values once)
 
-    # Take user input modulo division by 25.6 and divide by 1 then convert to int
-    PWus_lb = int((PW_us % 256)/1)
 
+def Send(i):
 
-#   Create high and low byte for serial command
+    commands.send_parameters(i, **Parameters(i))
 
-    PWus_HB = (PWus_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
 
-    PWus_LB = (PWus_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
+for i, dac in enumerate(pool):
 
+    Send_settings = Button(window, text="Set %s" % dac.name, bg="white",
+                           fg="black", font="bold", width=22, height=2, command=lambda i=i: Send(i))
 
-#   Send Serial Command for Repetition Time (39)
-
-    if PWus_hb > 0 or PWus_lb > 0:
-
-        ser1.write(b'\x39')  # Serial Command for Pulse Width
-
-        ser1.write(PWus_HB)  # Set Highbyte
-
-        ser1.write(PWus_LB)  # Set Lowbyte
-
-
-PWus_Message = Label(window, text="Pulse Width (μs)", bg="white",
-                     fg="black", width=22, height=2, justify='center', wraplength=120)
-
-PWus_Message.grid(column=0, row=8)
-
-
-PWus_Input2 = Entry(window, bg="white", fg="black",
-                    font="bold", justify='center')
-
-PWus_Input2.insert(0, "100")
-
-PWus_Input2.grid(column=1, row=8)
+    Send_settings.grid(column=i + 1, row=10)
 
 ##################################################################################################################################
+# Send commands to all DACS (one write per port, all ports at once)
 
-# Set Pulse Width (milliseconds) DAC2
-
-
-def Pulse_Width_us_DAC2():
-
-    PW_us = int(PWus_Input2.get())  # Get user input
-
-
-#   Create integer for highbyte
-
-    # Integer (floor division) divided by high byte for repeition width (256 ms)
-    PWus_hb = PW_us//256
-
-    # Take user input modulo division by 25.6 and divide by 1 then convert to int
-    PWus_lb = int((PW_us % 256)/1)
-
-
-#   Create high and low byte for serial command
-
-    PWus_HB = (PWus_hb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-    PWus_LB = (PWus_lb).to_bytes(
-        1, byteorder="little")  # Convert integer to byte
-
-
-#   Send Serial Command for Repetition Time (39)
-
-    if PWus_hb > 0 or PWus_lb > 0:
-        ser2.write(b'\x39')  # Serial Command for Pulse Width
-
-        ser2.write(PWus_HB)  # Set Highbyte
-
-        ser2.write(PWus_LB)  # Set Lowbyte
 
+def Send_DACS():
 
-PWus_Message = Label(window, text="Pulse Width (μs)", bg="white",
-                     fg="black", width=22, height=2, justify='center', wraplength=120)
+    # Read all parameter sets before writing so that the ports are written at the same time
+    parameters = [Parameters(i) for i in range(len(pool))]
 
-PWus_Message.grid(column=0, row=8)
+    for i, values in enumerate(parameters):
 
+        commands.send_parameters(i, **values)
 
-PWus_Input2 = Entry(window, bg="white", fg="black",
-                    font="bold", justify='center')
 
-PWus_Input2.insert(0, "100")
+Send_settings = Button(window, text="Set All DACS", bg="white",
+                       fg="black", font="bold", width=22, height=2, command=Send_DACS)
 
-PWus_Input2.grid(column=2, row=8)
+Send_settings.grid(column=ALL, row=10)
 
 ##################################################################################################################################
-# Set parameters for DAC1
+# Presets: save the values of all input fields under a name, recall them with one write per DAC
+# (the frames were encoded when the preset was saved; the input fields are filled in afterwards)
 
+presets = PresetStore(PRESETS)
 
-def Send():
 
-    Trigger_DAC1()
+def Save_Preset():
 
-    Pulses_DAC1()
+    name = Preset_Name.get().strip()
 
-    Pulse_Delay_ms_DAC1()
+    if not name:
+        return
 
-    Pulse_Delay_us_DAC1()
+    try:
+        presets.save(name, [Parameters(i) for i in range(len(pool))])
 
-    Pulse_Width_ms_DAC1()
+    except ValueError as error:
+        Show_Error(error)
+        return
 
-    Pulse_Width_us_DAC1()
+    Preset_Name["values"] = presets.names()
 
-    Output_Voltage_DAC1()
 
+def Recall_Preset():
 
-Send_settings = Button(window, text="Set DAC1", bg="white",
-                       fg="black", font="bold", width=22, height=2, command=Send)
+    name = Preset_Name.get().strip()
 
-Send_settings.grid(column=1, row=10)
+    if name not in presets:
+        Show_Error("no preset named %r" % name)
+        return
 
-##################################################################################################################################
+    for i, frame in enumerate(presets.frames(name)[:len(pool)]):
 
-##################################################################################################################################
-# Set parameters for DAC2
+        commands.send(i, frame, key="parameters")  # Replaces an upload still waiting
 
+    for entries, values in zip(Inputs, presets.parameters(name)):
 
-def Send():
+        for key, entry in entries.items():
 
-    Trigger_DAC2()
+            entry.delete(0, END)
 
-    Pulses_DAC2()
+            entry.insert(0, values.get(key, 0))
 
-    Pulse_Delay_ms_DAC2()
 
-    Pulse_Delay_us_DAC2()
+Preset_Message = Label(window, text="Preset", bg="white", fg="black",
+                       width=22, height=2, justify='center', wraplength=120)
 
-    Pulse_Width_ms_DAC2()
+Preset_Message.grid(column=0, row=15)
 
-    Pulse_Width_us_DAC2()
+Preset_Name = ttk.Combobox(window, values=presets.names(), justify='center')
 
-    Output_Voltage_DAC2()
+Preset_Name.grid(column=1, row=15)
 
+Save_Preset_Button = Button(window, text="Save Preset", bg="white", fg="black",
+                            width=22, height=2, justify='center', wraplength=120, command=Save_Preset)
 
-Send_settings = Button(window, text="Set DAC2", bg="white",
-                       fg="black", font="bold", width=22, height=2, command=Send)
+Save_Preset_Button.grid(column=ALL, row=15)
 
-Send_settings.grid(column=2, row=10)
+Recall_Preset_Button = Button(window, text="Recall Preset", bg="white", fg="black",
+                              font="bold", width=22, height=2, command=Recall_Preset)
 
-##################################################################################################################################
+Recall_Preset_Button.grid(column=ALL, row=16)
 
 ##################################################################################################################################
-# Send commands to both DACS
-
-
-def Send_DACS():
-
-    Trigger_DAC1()
+# Refresh the device settings shown in the window
 
-    Pulses_DAC1()
 
-    Pulse_Delay_ms_DAC1()
+def Refresh_Data():
 
-    Pulse_Delay_us_DAC1()
+    Show_Data()
 
-    Pulse_Width_ms_DAC1()
+    window.after(1000, Refresh_Data)
 
-    Pulse_Width_us_DAC1()
-
-    Output_Voltage_DAC1()
-
-    Trigger_DAC2()
-
-    Pulses_DAC2()
-
-    Pulse_Delay_ms_DAC2()
-
-    Pulse_Delay_us_DAC2()
-
-    Pulse_Width_ms_DAC2()
-
-    Pulse_Width_us_DAC2()
-
-    Output_Voltage_DAC2()
-
-
-Send_settings = Button(window, text="Set DAC1 & DAC2", bg="white",
-                       fg="black", font="bold", width=22, height=2, command=Send_DACS)
 
-Send_settings.grid(column=3, row=10)
+Refresh_Data()
 
 ##################################################################################################################################
 # Loop window
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Command layer for the Arduino DS5 Controller
+# -----------------------------------------------------------------------------
+# Description:
+# Importable command layer shared by GUI_full.py and GUI_condensed.py.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+from .protocol import (PARAMETER_NAMES, build_frame, command, encode_count,
+                       encode_display, encode_parameters, encode_period_ms,
+                       encode_period_us, encode_trigger, encode_voltage,
+                       encode_width_ms, encode_width_us, parameter_commands,
+                       split_frame)
+from .link import BAUDRATE, open_device, open_devices, wait_ready
+from .replies import LatencyLog, PendingCommands, ReplyParser, ReplyReader, Ticket, wait_all
+from .query import DeviceState, StatePoller, decode_query
+from .flow import CreditWindow
+from .stimulator import Stimulator
+from .pool import PortWorker, StartReport, StimulatorPool, StopReport, StopWorker
+from .scheduler import ProtocolScheduler, Trial, TrialRecord, load_trials, timing_summary
+from .sessionlog import SessionLog, load_session, read_header, session_bytes
+from .markers import Marker, MarkerPublisher, decode_marker
+from .commandqueue import CommandQueue
+from .presets import PresetStore
+from .ramp import RampStep, VoltageRamp, ramp_frames, ramp_summary, ramp_voltages
+from .closedloop import AmplitudeController, ControlTick, SignalInput, control_summary
+
+
+# Loaded on first use: encode_trials and the planner need NumPy, the emulator needs a POSIX
+# pseudo-terminal, AsyncStimulator imports asyncio
+_LAZY = {"encode_trials": "vectorized", "FirmwareEmulator": "emulator", "AsyncStimulator": "aio",
+         "ProtocolPlan": "planner", "plan_trials": "planner"}
+
+
+def __getattr__(name):
+
+    if name in _LAZY:
+        from importlib import import_module
+        return getattr(import_module("." + _LAZY[name], __name__), name)
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: python -m fnmes
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
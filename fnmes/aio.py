@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: asyncio client for the DS5 Controller
+# -----------------------------------------------------------------------------
+# Description:
+# AsyncStimulator wraps a Stimulator for asyncio programs. Every command the
+# GUIs send is a coroutine that resolves when the firmware's acknowledgement
+# arrives (or raises asyncio.TimeoutError), so one event loop can drive
+# several rigs concurrently. Writes do not block the event loop: a write
+# that waits for flow control credits runs in the loop's default executor.
+# Replies are still read by the stimulator's reader thread and handed to the
+# event loop.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import asyncio
+from functools import partial
+
+from .link import BAUDRATE, BOOT_TIMEOUT, open_device, open_devices
+from .protocol import (BLINK, MODE_BIPOLAR, MODE_MONOPOLAR_DIS, MODE_MONOPOLAR_EN,
+                       START_PULSE, ZERO_COUNT, command, encode_count, encode_display,
+                       encode_period_ms, encode_period_us, encode_trigger, encode_voltage,
+                       encode_width_ms, encode_width_us)
+from .stimulator import Stimulator
+
+##################################################################################################################################
+
+# Pulse modes
+
+MODES = {
+    "bipolar": MODE_BIPOLAR,                    # OpAmp enabled
+    "monopolar": MODE_MONOPOLAR_EN,             # OpAmp enabled
+    "monopolar_disabled": MODE_MONOPOLAR_DIS,   # OpAmp disabled
+}
+
+TIMEOUT = 1.0
+
+
+def ticket_future(ticket, loop):
+
+    # asyncio future that is set to the ticket once it is resolved (from the reader thread)
+
+    future = loop.create_future()
+
+    def resolved(ticket):
+
+        loop.call_soon_threadsafe(_set_result, future, ticket)
+
+    ticket.add_done_callback(resolved)
+
+    return future
+
+
+def _set_result(future, ticket):
+
+    if not future.done():
+        future.set_result(ticket)
+
+##################################################################################################################################
+
+# Client
+
+
+class AsyncStimulator:
+
+    def __init__(self, stimulator):
+
+        self.stimulator = stimulator
+
+    def __repr__(self):
+
+        return "AsyncStimulator(%r)" % self.stimulator.name
+
+    @classmethod
+    async def open(cls, port, name=None, baudrate=BAUDRATE, boot_timeout=BOOT_TIMEOUT):
+
+        # Open and wake up a port without blocking the event loop
+        loop = asyncio.get_running_loop()
+        ser = await loop.run_in_executor(None, open_device, port, baudrate, boot_timeout)
+
+        return cls(Stimulator(ser, name))
+
+    @classmethod
+    async def open_all(cls, ports, names=None, baudrate=BAUDRATE, boot_timeout=BOOT_TIMEOUT):
+
+        # Open several ports at once (DAC1, DAC2, ... unless names are given)
+
+        names = names or ["DAC%i" % (i + 1) for i in range(len(ports))]
+
+        loop = asyncio.get_running_loop()
+        sers = await loop.run_in_executor(None, open_devices, ports, baudrate, boot_timeout)
+
+        return [cls(Stimulator(ser, name)) for ser, name in zip(sers, names)]
+
+    @property
+    def name(self):
+
+        return self.stimulator.name
+
+    @property
+    def busy(self):
+
+        return self.stimulator.busy
+
+    @property
+    def state(self):
+
+        return self.stimulator.state
+
+    ##############################################################################################################################
+
+    # Sending
+
+    async def send(self, frame, timeout=TIMEOUT):
+
+        # Write a frame and wait until every command in it was confirmed. Returns the tickets;
+        # raises asyncio.TimeoutError if a confirmation did not arrive in time. A frame held
+        # back because a train is running (see Stimulator.hold) and still held at the timeout
+        # (or when the coroutine is cancelled) is withdrawn: it is never written.
+
+        loop = asyncio.get_running_loop()
+        tickets = await self._write(loop, self.stimulator.send, frame)
+
+        return await self._confirmed(tickets, loop, timeout)
+
+    async def _write(self, loop, method, *args, **kwargs):
+
+        # Without flow control a write returns at once. With a CreditWindow it waits for
+        # credits (see Stimulator.send_paced), so it is handed to the default executor.
+
+        if self.stimulator.flow is None:
+            return method(*args, **kwargs)
+
+        return await loop.run_in_executor(None, partial(method, *args, **kwargs))
+
+    async def _confirmed(self, tickets, loop, timeout):
+
+        if tickets:
+
+            futures = [ticket_future(ticket, loop) for ticket in tickets]
+
+            try:
+                await asyncio.wait_for(asyncio.gather(*futures), timeout)
+
+            except asyncio.CancelledError:
+                self.stimulator.withdraw(tickets)
+                raise
+
+            except asyncio.TimeoutError:
+
+                if self.stimulator.withdraw(tickets):
+                    raise asyncio.TimeoutError("%s: not sent, a pulse train is still running" % self.name)
+
+                raise
+
+            for ticket in tickets:
+                if not ticket.confirmed:
+                    raise asyncio.TimeoutError("%s: 0x%02X was not confirmed" % (self.name, ticket.code))
+
+        return tickets
+
+    ##############################################################################################################################
+
+    # Commands (as in the GUIs)
+
+    async def start(self, timeout=None):
+
+        # Start a pulse train; resolves with its ticket when the end-of-sequence byte arrives
+        tickets = await self.send(command(START_PULSE), timeout)
+
+        return tickets[0]
+
+    async def blink(self):
+
+        await self._write(asyncio.get_running_loop(), self.stimulator.send, command(BLINK))  # No reply
+
+    async def display(self, on, timeout=TIMEOUT):
+
+        await self.send(encode_display(on), timeout)
+
+    async def zero_count(self, timeout=TIMEOUT):
+
+        await self.send(command(ZERO_COUNT), timeout)
+
+    async def mode(self, mode, timeout=TIMEOUT):
+
+        # "bipolar", "monopolar" (OpAmp enabled) or "monopolar_disabled" (OpAmp disabled)
+        await self.send(command(MODES[mode]), timeout)
+
+    async def trigger(self, trigger, timeout=TIMEOUT):
+
+        await self.send(encode_trigger(trigger), timeout)
+
+    async def count(self, count, timeout=TIMEOUT):
+
+        await self.send(encode_count(count), timeout)
+
+    async def period_ms(self, period_ms, timeout=TIMEOUT):
+
+        await self.send(encode_period_ms(period_ms), timeout)
+
+    async def period_us(self, period_us, timeout=TIMEOUT):
+
+        await self.send(encode_period_us(period_us), timeout)
+
+    async def width_ms(self, width_ms, timeout=TIMEOUT):
+
+        await self.send(encode_width_ms(width_ms), timeout)
+
+    async def width_us(self, width_us, timeout=TIMEOUT):
+
+        await self.send(encode_width_us(width_us), timeout)
+
+    async def voltage(self, voltage_mv, timeout=TIMEOUT):
+
+        await self.send(encode_voltage(voltage_mv), timeout)
+
+    async def set_parameters(self, timeout=TIMEOUT, force=False, **parameters):
+
+        # Only the parameters that changed, in one write (see Stimulator.send_parameters)
+        loop = asyncio.get_running_loop()
+        tickets = await self._write(loop, self.stimulator.send_parameters, force=force, **parameters)
+
+        return await self._confirmed(tickets, loop, timeout)
+
+    async def query(self, timeout=TIMEOUT):
+
+        # Current device settings (DeviceState). A device running a pulse train is not
+        # queried (see StatePoller); its last known state is returned instead.
+
+        loop = asyncio.get_running_loop()
+        ticket = await self._write(loop, self.stimulator.request_state)
+
+        if ticket is not None:
+            await self._confirmed([ticket], loop, timeout)
+
+        return self.stimulator.state
+
+    async def stop(self, timeout=TIMEOUT):
+
+        # Emergency stop; resolves when the interrupted train has ended (right away if idle)
+
+        loop = asyncio.get_running_loop()
+        _, train = self.stimulator.emergency_stop()
+
+        if train is not None:
+            await self._confirmed([train], loop, timeout)
+
+        return train
+
+    async def close(self):
+
+        self.stimulator.close()
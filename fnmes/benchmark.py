@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Latency and throughput benchmarks for the serial command path
+# -----------------------------------------------------------------------------
+# Description:
+# Measures parameter upload time for the original byte-by-byte Send_DACS path
+# and the frame and delta paths, write-to-acknowledgement latency and
+# command throughput, the start skew between DACs for sequential and
+# synchronized starts, back-to-back uploads with and without credit-based
+# flow control, and uploads with the display on and off. Runs against real devices or the firmware emulator and
+# writes the results as JSON, so that releases can be compared.
+# Run as: python -m fnmes.benchmark [-p PORT ...] [-o results.json]
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from contextlib import nullcontext
+
+from .flow import CreditWindow
+from .link import BAUDRATE
+from .pool import StimulatorPool
+from .protocol import START_PULSE, command, encode_parameters, encode_voltage
+from .replies import wait_all
+from .timing import percentile
+
+##################################################################################################################################
+
+# Parameters used for the benchmarks (short trains so that starts can be repeated quickly)
+
+PARAMETERS = dict(trigger=0, count=1, period_ms=1, width_us=100, voltage_mv=500)
+
+##################################################################################################################################
+
+# Statistics
+
+
+def stats(values):
+
+    # n, mean, p50, p99 and max in seconds
+
+    values = sorted(values)
+
+    if not values:
+        return {"n": 0}
+
+    return {"n": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p99": percentile(values, 99),
+            "max": values[-1]}
+
+##################################################################################################################################
+
+# Upload paths
+
+
+def legacy_upload(pool, parameters):
+
+    # As Send_DACS in the original GUI: every byte is its own write, one device after the other
+
+    tickets = []
+
+    for stimulator in pool:
+
+        frame = encode_parameters(**parameters)
+        sent, codes = stimulator.prepare(frame)
+
+        with stimulator.write_lock:
+
+            stimulator.transmit(b"", sent, codes)   # Register the tickets only
+
+            for byte in frame:
+                stimulator.ser.write(bytes((byte,)))
+
+        tickets += sent
+
+    return tickets
+
+
+def frame_upload(pool, parameters):
+
+    # Whole parameter set as one frame per port, all ports at once
+    futures = [pool.submit(i, "send_parameters", force=True, **parameters) for i in range(len(pool))]
+
+    return [ticket for sent in pool.wait(futures) for ticket in sent]
+
+
+def delta_upload(pool, parameters):
+
+    # Only what changed since the last confirmed upload
+    futures = [pool.send_parameters(i, **parameters) for i in range(len(pool))]
+
+    return [ticket for sent in pool.wait(futures) for ticket in sent]
+
+
+UPLOADS = (("legacy", legacy_upload), ("frame", frame_upload), ("delta", delta_upload))
+
+##################################################################################################################################
+
+# Benchmarks
+
+
+def bench_upload(pool, repeat, timeout):
+
+    # Time from the first write until every command of every device was confirmed.
+    # The voltage changes on every repetition, so the delta path sends one command per device.
+
+    results = {}
+
+    for name, upload in UPLOADS:
+
+        durations = []
+        latencies = []
+
+        wait_all(frame_upload(pool, PARAMETERS), timeout)   # Same starting point for every path
+
+        for i in range(repeat):
+
+            parameters = dict(PARAMETERS, voltage_mv=PARAMETERS["voltage_mv"] + 1 + i % 2)
+
+            start = time.perf_counter()
+            tickets = upload(pool, parameters)
+
+            if not wait_all(tickets, timeout):
+                raise TimeoutError("%s upload was not confirmed" % name)
+
+            durations.append(max(ticket.received for ticket in tickets) - start)
+            latencies += [ticket.latency for ticket in tickets]
+
+        results[name] = {"upload": stats(durations), "latency": stats(latencies),
+                         "commands": len(tickets)}
+
+    return results
+
+
+def bench_commands(pool, duration, timeout):
+
+    # Closed loop on every device at once: send one voltage command, wait for its
+    # confirmation, repeat. Returns commands/s over all devices and the latency.
+
+    def loop(stimulator):
+
+        latencies = []
+        end = time.perf_counter() + duration
+
+        while time.perf_counter() < end:
+
+            ticket = stimulator.send(encode_voltage(len(latencies) % 2))[0]
+
+            if not ticket.wait(timeout):
+                raise TimeoutError("%s: command was not confirmed" % stimulator.name)
+
+            latencies.append(ticket.latency)
+
+        return latencies
+
+    start = time.perf_counter()
+    results = pool.wait([pool.workers[i].submit(loop, stimulator) for i, stimulator in enumerate(pool)])
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for result in results for latency in result]
+
+    return {"commands_per_s": len(latencies) / elapsed, "latency": stats(latencies)}
+
+
+def bench_start(pool, repeat, timeout):
+
+    # Skew between the first and the last start write: one write after the other
+    # (as Start_stim_DAC1_2 did) versus the synchronized start
+
+    frame = command(START_PULSE)
+    sequential = []
+    synchronized = []
+
+    wait_all(frame_upload(pool, PARAMETERS), timeout)
+
+    for _ in range(repeat):
+
+        tickets = [stimulator.send(frame)[0] for stimulator in pool]
+        written = [ticket.written for ticket in tickets]
+        sequential.append(max(written) - min(written))
+
+        if not wait_all(tickets, timeout):
+            raise TimeoutError("pulse trains did not end")
+
+        report = pool.start_synchronized()
+        synchronized.append(report.skew)
+
+        if not wait_all(report.tickets, timeout):
+            raise TimeoutError("pulse trains did not end")
+
+    return {"sequential": stats(sequential), "synchronized": stats(synchronized)}
+
+
+def bench_burst(pool, frames, timeout, unpaced=False):
+
+    # Queue a burst of whole parameter frames on every device without waiting for replies,
+    # with a credit window and (unpaced, emulated devices only: lost argument bytes turn the
+    # following bytes into arbitrary commands) with every frame written right away. Returns
+    # the confirmed share of the commands, commands/s and the final window.
+
+    results = {}
+    windows = [stimulator.flow for stimulator in pool]
+
+    for name in ("paced", "unpaced") if unpaced else ("paced",):
+
+        for stimulator in pool:
+            stimulator.flow = CreditWindow() if name == "paced" else None
+
+        wait_all(frame_upload(pool, PARAMETERS), timeout)
+
+        burst = [encode_parameters(**dict(PARAMETERS, voltage_mv=500 + k % 2)) for k in range(frames)]
+
+        start = time.perf_counter()
+        futures = [pool.submit(i, "send", frame) for frame in burst for i in range(len(pool))]
+        tickets = [ticket for sent in pool.wait(futures) for ticket in sent]
+
+        wait_all(tickets, timeout + frames * 0.2)   # Lost commands may never be resolved
+
+        confirmed = [ticket for ticket in tickets if ticket.confirmed]
+        elapsed = max([ticket.received for ticket in confirmed] or [start]) - start
+
+        results[name] = {"commands": len(tickets),
+                         "confirmed": len(confirmed) / len(tickets),
+                         "commands_per_s": len(confirmed) / elapsed if elapsed else 0.0,
+                         "latency": stats([ticket.latency for ticket in confirmed])}
+
+        if name == "paced":
+            results[name]["window"] = [stimulator.flow.stats() for stimulator in pool]
+
+    for stimulator, window in zip(pool, windows):
+        stimulator.flow = window
+
+    return results
+
+
+def bench_display(pool, repeat, timeout):
+
+    # Full parameter uploads with the display on and inside pool.streaming() (display off):
+    # upload time and acknowledgement latency, and the p50 gain of each
+
+    results = {}
+
+    for name in ("on", "off"):
+
+        durations = []
+        latencies = []
+
+        with pool.streaming() if name == "off" else nullcontext():
+
+            for i in range(repeat):
+
+                parameters = dict(PARAMETERS, voltage_mv=PARAMETERS["voltage_mv"] + 1 + i % 2)
+
+                start = time.perf_counter()
+                tickets = frame_upload(pool, parameters)
+
+                if not wait_all(tickets, timeout):
+                    raise TimeoutError("upload with the display %s was not confirmed" % name)
+
+                durations.append(max(ticket.received for ticket in tickets) - start)
+                latencies += [ticket.latency for ticket in tickets]
+
+        results[name] = {"upload": stats(durations), "latency": stats(latencies)}
+
+    results["gain"] = {key: results["on"][key]["p50"] - results["off"][key]["p50"]
+                       for key in ("upload", "latency")}
+
+    return results
+
+
+def run(pool, repeat=50, duration=2.0, timeout=2.0, burst=20, unpaced=False):
+
+    return {"upload": bench_upload(pool, repeat, timeout),
+            "commands": bench_commands(pool, duration, timeout),
+            "start_skew": bench_start(pool, repeat, timeout) if len(pool) > 1 else None,
+            "display": bench_display(pool, repeat, timeout),
+            "burst": bench_burst(pool, burst, timeout, unpaced) if burst else None}
+
+##################################################################################################################################
+
+# Comparison with earlier results
+
+
+def compare(results, baseline, tolerance):
+
+    # (path, baseline, result) for every p50 that got slower by more than the tolerance
+    # (or commands/s that dropped by more than the tolerance)
+
+    regressions = []
+
+    def walk(path, new, old):
+
+        if isinstance(new, dict) and isinstance(old, dict):
+            for key in new:
+                if key in old:
+                    walk(path + (key,), new[key], old[key])
+
+        elif isinstance(new, (int, float)) and isinstance(old, (int, float)) and old:
+
+            if path[-1] == "p50" and new > old * (1 + tolerance):
+                regressions.append((".".join(path), old, new))
+
+            elif path[-1] == "commands_per_s" and new < old * (1 - tolerance):
+                regressions.append((".".join(path), old, new))
+
+    walk((), results, baseline)
+
+    return regressions
+
+
+def report(results):
+
+    # Short human-readable summary (milliseconds)
+
+    lines = []
+
+    for name, result in results["upload"].items():
+        lines.append("upload %-7s p50 %7.2f ms  p99 %7.2f ms  (%i commands)"
+                     % (name, result["upload"]["p50"] * 1e3, result["upload"]["p99"] * 1e3,
+                        result["commands"]))
+
+    commands = results["commands"]
+    lines.append("commands       %7.1f /s   ack p50 %.2f ms  p99 %.2f ms"
+                 % (commands["commands_per_s"], commands["latency"]["p50"] * 1e3,
+                    commands["latency"]["p99"] * 1e3))
+
+    if results["start_skew"]:
+        for name, result in results["start_skew"].items():
+            lines.append("start %-12s skew p50 %7.3f ms  p99 %7.3f ms"
+                         % (name, result["p50"] * 1e3, result["p99"] * 1e3))
+
+    if results.get("display"):
+        for name in ("on", "off"):
+            result = results["display"][name]
+            lines.append("display %-4s  upload p50 %7.2f ms  ack p50 %7.2f ms"
+                         % (name, result["upload"]["p50"] * 1e3, result["latency"]["p50"] * 1e3))
+
+    if results.get("burst"):
+        for name, result in results["burst"].items():
+            lines.append("burst %-7s  %7.1f /s   %5.1f %% of %i commands confirmed"
+                         % (name, result["commands_per_s"], result["confirmed"] * 100,
+                            result["commands"]))
+
+    return "\n".join(lines)
+
+##################################################################################################################################
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m fnmes.benchmark",
+                                     description="Benchmark the serial command path.")
+
+    parser.add_argument("-p", "--port", action="append", dest="ports",
+                        help="serial port of one DAC (default: emulated devices)")
+    parser.add_argument("-n", "--devices", type=int, default=2,
+                        help="number of emulated devices when no port is given")
+    parser.add_argument("--baudrate", type=int, default=BAUDRATE,
+                        help="switch to this baud rate after the start (firmware v0.95)")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="length of the throughput run (s)")
+    parser.add_argument("--burst", type=int, default=20,
+                        help="parameter frames per device queued at once (0 = skip)")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against --compare (0.2 = 20%%)")
+
+    args = parser.parse_args(argv)
+
+    emulators = []
+    ports = args.ports
+
+    if not ports:
+        from .emulator import FirmwareEmulator
+        emulators = [FirmwareEmulator() for _ in range(args.devices)]  # Real boot and start screen
+        ports = [emulator.port for emulator in emulators]
+
+    pool = StimulatorPool.open(ports, args.baudrate)
+    baudrates = [stimulator.ser.baudrate for stimulator in pool]   # 19200 if not switched
+
+    try:
+        results = run(pool, args.repeat, args.duration, burst=args.burst, unpaced=bool(emulators))
+
+    finally:
+        pool.close()
+
+        for emulator in emulators:
+            emulator.close()
+
+    results = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "devices": len(ports),
+                        "emulated": bool(emulators),
+                        "baudrate": baudrates,
+                        "repeat": args.repeat,
+                        "burst": args.burst,
+                        "parameters": PARAMETERS},
+               **results}
+
+    print(report(results))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        for path, old, new in regressions:
+            print("regression: %s %.6g -> %.6g" % (path, old, new), file=sys.stderr)
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
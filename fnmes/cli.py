@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Command-line interface
+# -----------------------------------------------------------------------------
+# Description:
+# Headless entry point for scripted sessions: start and query any number of
+# DS5 Controllers, or run a timed trial list, a ramp or a closed loop, without
+# starting Tk. Run as: python -m fnmes --port PORT [--port PORT ...] COMMAND
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import argparse
+import csv
+import sys
+from contextlib import nullcontext
+
+from .closedloop import AmplitudeController, SignalInput
+from .link import BAUDRATE, BOOT_TIMEOUT
+from .pool import StimulatorPool
+from .protocol import PARAMETER_NAMES
+from .ramp import SHAPES, VOLTAGE_MAX_MV, VoltageRamp, ramp_voltages
+from .replies import wait_all
+from .scheduler import ProtocolScheduler, load_trials
+
+##################################################################################################################################
+
+# Arguments
+
+
+def parameter_arguments(parser):
+
+    # --trigger, --count, --period-ms, ... (see parameter_commands)
+
+    for name in PARAMETER_NAMES:
+
+        parser.add_argument("--" + name.replace("_", "-"), dest=name,
+                            type=int if name in ("trigger", "count", "period_us", "width_us") else float)
+
+
+def build_parser():
+
+    parser = argparse.ArgumentParser(prog="python -m fnmes",
+                                     description="Control DS5 Controllers without the GUI.")
+
+    parser.add_argument("-p", "--port", action="append", dest="ports",
+                        help="serial port of one DAC (repeat for DAC2, DAC3, ...; not needed for plan)")
+    parser.add_argument("--baudrate", type=int, default=BAUDRATE,
+                        help="switch to this baud rate after the start (firmware v0.95)")
+    parser.add_argument("--boot-timeout", type=float, default=BOOT_TIMEOUT,
+                        help="fallback wait (s) for firmware without a ready byte")
+    parser.add_argument("--timeout", type=float, default=1.0,
+                        help="time (s) to wait for the firmware's replies")
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    dacs = argparse.ArgumentParser(add_help=False)
+    dacs.add_argument("-d", "--dac", action="append", type=int, dest="dacs",
+                      help="DAC number (1 = first port; repeat for several, default all)")
+
+    # Opening a port resets the Arduino, so every command starts from the firmware defaults
+    # (there is no separate set or stop: settings would not outlive the command, and the
+    # reset itself ends a running train)
+
+    start = commands.add_parser("start", parents=[dacs],
+                                help="set the given parameters (the others keep the firmware defaults) "
+                                     "and start with a synchronized start")
+    parameter_arguments(start)
+    start.add_argument("--wait", action="store_true", help="wait until all trains have finished")
+
+    commands.add_parser("query", parents=[dacs],
+                        help="print the device settings (the defaults after the reset by opening the port)")
+
+    run = commands.add_parser("run-protocol", help="run a CSV trial list")
+    run.add_argument("trials", help="CSV file with the columns dac, iti_ms and any parameters")
+    run.add_argument("--records", help="write planned and actual start times to this CSV file")
+    run.add_argument("--display-off", action="store_true",
+                     help="turn the displays off while the protocol runs (faster replies)")
+
+    ramp = commands.add_parser("ramp", parents=[dacs], help="stream a voltage ramp (0x53 steps)")
+    ramp.add_argument("--from-mv", type=float, required=True, dest="start_mv")
+    ramp.add_argument("--to-mv", type=float, required=True, dest="end_mv")
+    ramp.add_argument("--steps", type=int, default=20)
+    ramp.add_argument("--shape", choices=sorted(SHAPES), default="linear")
+    ramp.add_argument("--interval-ms", type=float, default=0.0,
+                      help="time between steps (default: as fast as the replies allow)")
+    ramp.add_argument("--ceiling-mv", type=float, default=VOLTAGE_MAX_MV,
+                      help="refuse ramps above this voltage")
+    ramp.add_argument("--display-off", action="store_true",
+                      help="turn the displays off during the ramp (faster replies)")
+    ramp.add_argument("--records", help="write the planned and actual time of every step to this CSV file")
+
+    loop = commands.add_parser("closed-loop", parents=[dacs],
+                               help="set the voltage from a live signal (0x53 commands at a fixed rate)")
+    loop.add_argument("source", help='"-" (stdin), udp:[HOST:]PORT, tcp:HOST:PORT, a FIFO or a file to follow')
+    loop.add_argument("--column", type=int, default=-1, help="field of each line to use (default the last)")
+    loop.add_argument("--rate-hz", type=float, default=100.0)
+    loop.add_argument("--gain-mv", type=float, default=1.0, help="mV per unit of the signal")
+    loop.add_argument("--offset-mv", type=float, default=0.0)
+    loop.add_argument("--floor-mv", type=float, default=0.0)
+    loop.add_argument("--ceiling-mv", type=float, required=True, help="hard upper limit of the voltage")
+    loop.add_argument("--slew-mv-s", type=float, help="largest voltage change per second")
+    loop.add_argument("--stale-ms", type=float, default=100.0,
+                      help="go to the floor when the latest sample is older than this")
+    loop.add_argument("--duration", type=float, help="stop after this time (s; default Ctrl+C)")
+    loop.add_argument("--display-off", action="store_true",
+                      help="turn the displays off while the loop runs (needed above ~30 Hz)")
+    loop.add_argument("--records", help="write every tick to this CSV file")
+
+    plan = commands.add_parser("plan", help="check a CSV trial list without a device")
+    plan.add_argument("trials", help="CSV file with the columns dac, iti_ms and any parameters")
+    plan.add_argument("--start-delay", type=float, default=0.5, help="time (s) before the first trial")
+    plan.add_argument("--gain", type=float, help="stimulator gain in mA/V (to report the charge)")
+    plan.add_argument("--monopolar", action="store_true", help="DACs are in monopolar mode")
+    plan.add_argument("--pulses", help="write the onset and offset of every pulse to this CSV file")
+
+    return parser
+
+##################################################################################################################################
+
+# Commands
+
+
+def upload(pool, indices, args):
+
+    # Send only the parameters given on the command line; False if one was not confirmed
+
+    parameters = {name: getattr(args, name) for name in PARAMETER_NAMES
+                  if getattr(args, name) is not None}
+
+    if not parameters:
+        return True
+
+    futures = [pool.submit(i, "send_parameters", force=True, **parameters) for i in indices]
+    tickets = [ticket for sent in pool.wait(futures, args.timeout) for ticket in sent]
+
+    return wait_all(tickets, args.timeout)
+
+
+def run_start(pool, indices, args):
+
+    if not upload(pool, indices, args):
+        print("parameters were not confirmed", file=sys.stderr)
+        return 1
+
+    report = pool.start_synchronized(indices, args.timeout)
+
+    print("started %s, skew %.0f us" % (", ".join(report.names), report.skew * 1e6))
+
+    if args.wait:
+        wait_all(report.tickets)
+
+    return 0
+
+
+def run_query(pool, indices, args):
+
+    states = pool.wait([pool.submit(i, "query", args.timeout) for i in indices])
+
+    for i, state in zip(indices, states):
+        print("%s: %s" % (pool[i].name, state or "no data"))
+
+    return 0 if all(states) else 1
+
+
+def run_protocol(pool, indices, args):
+
+    scheduler = ProtocolScheduler(pool, load_trials(args.trials), upload_timeout=args.timeout)
+
+    with pool.streaming() if args.display_off else nullcontext():
+
+        scheduler.start()
+
+        try:
+            while scheduler.is_alive():
+                scheduler.join(0.1)
+
+        except KeyboardInterrupt:
+            scheduler.stop()
+            pool.emergency_stop()
+            scheduler.join()
+
+    if args.records:
+
+        with open(args.records, "w", newline="") as file:
+
+            writer = csv.writer(file)
+            writer.writerow(("trial", "dac", "planned_s", "actual_s", "error_us", "uploaded"))
+
+            for record in scheduler.records:
+                writer.writerow((record.index + 1, record.dac + 1, "%.6f" % record.planned,
+                                 "%.6f" % record.actual,
+                                 "%.1f" % ((record.actual - record.planned) * 1e6),
+                                 int(record.uploaded)))
+
+    summary = scheduler.summary()
+
+    if summary["n"]:
+        print("%i trials, start error mean %.0f us, sd %.0f us, max %.0f us, %i late uploads"
+              % (summary["n"], summary["mean"] * 1e6, summary["sd"] * 1e6,
+                 summary["max"] * 1e6, summary["late_uploads"]))
+
+    return 0 if summary["n"] == len(scheduler.trials) else 1
+
+
+def run_ramp(pool, indices, args):
+
+    try:
+        voltages = ramp_voltages(args.start_mv, args.end_mv, args.steps, args.shape)
+        ramps = [VoltageRamp(pool, i, voltages, args.interval_ms / 1000, timeout=args.timeout,
+                             ceiling_mv=args.ceiling_mv) for i in indices]
+
+    except ValueError as error:
+        raise SystemExit(error)
+
+    with pool.streaming(indices) if args.display_off else nullcontext():
+
+        for ramp in ramps:
+            ramp.start()
+
+        try:
+            while any(ramp.is_alive() for ramp in ramps):
+                ramps[0].join(0.1)
+
+        except KeyboardInterrupt:
+            for ramp in ramps:
+                ramp.stop()
+            pool.emergency_stop()
+
+        for ramp in ramps:
+            ramp.join()
+
+    if args.records:
+
+        with open(args.records, "w", newline="") as file:
+
+            writer = csv.writer(file)
+            writer.writerow(("dac", "step", "voltage_mv", "planned_s", "actual_s", "error_us", "confirmed"))
+
+            for ramp in ramps:
+                for step in ramp.steps:
+                    writer.writerow((ramp.dac + 1, step.index + 1, step.voltage_mv, "%.6f" % step.planned,
+                                     "%.6f" % step.actual, "%.1f" % ((step.actual - step.planned) * 1e6),
+                                     int(step.ticket.confirmed)))
+
+    for ramp in ramps:
+
+        summary = ramp.summary()
+
+        if summary["n"]:
+            print("%s: %i of %i steps, %.0f steps/s, error mean %.0f us, max %.0f us, reply p50 %s, "
+                  "%i unconfirmed%s"
+                  % (pool[ramp.dac].name, summary["n"], len(voltages), summary["steps_per_s"] or 0,
+                     summary["mean"] * 1e6, summary["max"] * 1e6,
+                     "%.2f ms" % (summary["latency"] * 1e3) if summary["latency"] else "-",
+                     summary["unconfirmed"], ", aborted" if ramp.aborted else ""))
+
+    return 1 if any(ramp.aborted for ramp in ramps) else 0
+
+
+def run_closed_loop(pool, indices, args):
+
+    try:
+        signal = SignalInput(args.source, args.column)
+
+    except (OSError, ValueError) as error:
+        raise SystemExit("cannot open %s: %s" % (args.source, error))
+
+    try:
+        controllers = [AmplitudeController(pool, i, signal, args.rate_hz, args.gain_mv, args.offset_mv,
+                                           floor_mv=args.floor_mv, ceiling_mv=args.ceiling_mv,
+                                           slew_mv_s=args.slew_mv_s, stale=args.stale_ms / 1000,
+                                           duration=args.duration, timeout=args.timeout)
+                       for i in indices]
+
+    except ValueError as error:
+        signal.close()
+        raise SystemExit(error)
+
+    signal.start()
+
+    with pool.streaming(indices) if args.display_off else nullcontext():
+
+        for controller in controllers:
+            controller.start()
+
+        try:
+            while any(controller.is_alive() for controller in controllers):
+                controllers[0].join(0.1)
+
+        except KeyboardInterrupt:
+            for controller in controllers:
+                controller.stop()
+
+        for controller in controllers:
+            controller.join()
+
+    signal.close()
+
+    if args.records:
+
+        with open(args.records, "w", newline="") as file:
+
+            writer = csv.writer(file)
+            writer.writerow(("dac", "tick", "planned_s", "actual_s", "input_s", "value", "target_mv",
+                             "command_mv", "state", "confirmed_s"))
+
+            for controller in controllers:
+                for tick in controller.ticks:
+                    writer.writerow((controller.dac + 1, tick.index, "%.6f" % tick.planned, "%.6f" % tick.actual,
+                                     "" if tick.input_t is None else "%.6f" % tick.input_t,
+                                     "" if tick.value is None else tick.value, tick.target_mv,
+                                     "" if tick.command_mv is None else tick.command_mv, tick.state,
+                                     "%.6f" % tick.ticket.received if tick.ticket and tick.ticket.confirmed
+                                     else ""))
+
+    for controller in controllers:
+
+        summary = controller.summary()
+
+        if summary["n"]:
+            print("%s: %i ticks at %.1f Hz, error mean %.0f us, max %.0f us, %i commands, %i busy, "
+                  "%i missed, %i stale, input-to-reply p50 %s, p95 %s%s"
+                  % (pool[controller.dac].name, summary["n"], summary["rate_hz"] or 0, summary["mean"] * 1e6,
+                     summary["max"] * 1e6, summary["commands"], summary["busy"], summary["missed"],
+                     summary["stale"],
+                     *("%.2f ms" % (t * 1e3) if t is not None else "-"
+                       for t in (summary["input_to_reply"]["p50"], summary["input_to_reply"]["p95"])),
+                     ", aborted" if controller.aborted else ""))
+
+    return 1 if any(controller.aborted for controller in controllers) else 0
+
+
+def run_plan(args):
+
+    from .planner import plan_trials    # Needs NumPy
+
+    plan = plan_trials(load_trials(args.trials), args.start_delay, not args.monopolar, args.gain)
+    summary = plan.summary()
+
+    if not summary["trials"]:
+        print("no trials")
+        return 0
+
+    print("%i trials, %.3f s (%.3f to %.3f s)"
+          % (summary["trials"], summary["session_s"], summary["start_s"], summary["end_s"]))
+
+    for name, device in summary["devices"].items():
+
+        line = ("%s: %i trains, %i pulses, busy %.3f s, duty cycle %.2f %%, %i conflicts"
+                % (name, device["trains"], device["pulses"], device["busy_s"],
+                   device["duty_cycle"] * 100, device["conflicts"]))
+
+        if "max_phase_charge_uc" in device:
+            line += (", max %.3f uC/phase, max %.3f uC/train"
+                     % (device["max_phase_charge_uc"], device["max_train_charge_uc"]))
+
+        print(line)
+
+    for index in plan.conflict.nonzero()[0]:
+        print("trial %i: DAC%i is still running the previous train (the start will be late)"
+              % (index + 1, plan.dac[index] + 1), file=sys.stderr)
+
+    if args.pulses:
+
+        onsets, offsets, trials = plan.pulses()
+
+        with open(args.pulses, "w", newline="") as file:
+
+            writer = csv.writer(file)
+            writer.writerow(("trial", "dac", "onset_s", "offset_s"))
+            writer.writerows(zip(trials + 1, plan.dac[trials] + 1, ("%.6f" % t for t in onsets),
+                                 ("%.6f" % t for t in offsets)))
+
+    return 1 if plan.conflict.any() else 0
+
+
+COMMANDS = {
+    "start": run_start,
+    "query": run_query,
+    "run-protocol": run_protocol,
+    "ramp": run_ramp,
+    "closed-loop": run_closed_loop,
+}
+
+##################################################################################################################################
+
+
+def main(argv=None):
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == "plan":
+        return run_plan(args)
+
+    if not args.ports:
+        parser.error("the following arguments are required: -p/--port")
+
+    dacs = getattr(args, "dacs", None) or range(1, len(args.ports) + 1)
+    indices = [dac - 1 for dac in dacs]
+
+    for i in indices:
+        if not 0 <= i < len(args.ports):
+            raise SystemExit("no DAC%i: only %i port(s) given" % (i + 1, len(args.ports)))
+
+    pool = StimulatorPool.open(args.ports, args.baudrate, args.boot_timeout)
+
+    try:
+        return COMMANDS[args.command](pool, indices, args)
+
+    except RuntimeError as error:
+        raise SystemExit(error)
+
+    finally:
+        pool.close()
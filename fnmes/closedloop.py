@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Closed-loop amplitude control from a streaming signal
+# -----------------------------------------------------------------------------
+# Description:
+# A SignalInput reads a live signal (e.g. an EMG envelope or a force sensor)
+# as text lines from a pipe, a file that is being written, stdin or a local
+# UDP/TCP socket and keeps the latest sample. An AmplitudeController turns
+# it into Set Voltage (0x53) commands for one DAC on a fixed-rate loop: the
+# target voltage is clamped to a hard ceiling and its change per second is
+# limited, at most one command waits for its reply (a tick is skipped rather
+# than queued), and a stale input takes the voltage back to the floor. Every
+# tick records its timing and the input-to-command and input-to-reply
+# latency.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import math
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from .protocol import encode_voltage
+from .ramp import VOLTAGE_MAX_MV
+from .timing import TimedThread, percentile
+
+##################################################################################################################################
+
+# Input
+#   One sample per line, as text; with several fields (separated by spaces, commas, tabs or
+#   semicolons) the column given is used (default the last one). Lines that are not a finite
+#   number are counted and ignored.
+
+
+def parse_sample(line, column=-1):
+
+    fields = line.replace(b",", b" ").replace(b";", b" ").split()
+
+    value = float(fields[column])   # ValueError / IndexError for a malformed line
+
+    if not math.isfinite(value):
+        raise ValueError("not a finite sample: %r" % line)
+
+    return value
+
+
+class SignalInput(threading.Thread):
+
+    def __init__(self, source, column=-1, poll=0.001):
+
+        # source: "-" (stdin), "udp:[HOST:]PORT" (bind and receive datagrams), "tcp:HOST:PORT"
+        # (connect and read a stream) or a path. Opening a FIFO waits for its writer, and it is
+        # read until the writer closes it; a regular file is followed from its current end (as
+        # tail -f), polling every poll s.
+
+        super().__init__(daemon=True)
+
+        self.source = source
+        self.column = column
+        self.poll = poll
+
+        self.lock = threading.Lock()
+        self.value = None
+        self.t = None               # perf_counter() time the latest sample arrived
+        self.samples = 0            # Lines received
+        self.errors = 0             # Malformed lines
+        self.stopped = threading.Event()
+
+        self.socket = None
+        self.fd = None
+        self.tail = False
+        self.datagrams = False
+
+        kind, _, address = source.partition(":")
+
+        if source == "-":
+            self.fd = sys.stdin.fileno()
+
+        elif kind in ("udp", "tcp") and address:
+
+            host, _, port = address.rpartition(":")
+
+            if kind == "udp":
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.socket.bind((host or "127.0.0.1", int(port)))
+                self.datagrams = True
+
+            else:
+                self.socket = socket.create_connection((host or "127.0.0.1", int(port)))
+
+            self.socket.settimeout(0.1)     # So that stop() is seen
+
+        else:
+
+            self.fd = os.open(source, os.O_RDONLY)
+
+            if os.path.isfile(source):
+                os.lseek(self.fd, 0, os.SEEK_END)
+                self.tail = True
+
+    def latest(self):
+
+        # (value, arrival time, samples received); value and time are None before the first sample
+
+        with self.lock:
+            return self.value, self.t, self.samples
+
+    def _read(self):
+
+        # Next bytes; None if nothing arrived yet, b"" at the end of the input
+
+        if self.socket is not None:
+
+            try:
+                data = self.socket.recv(65536)
+
+            except socket.timeout:
+                return None
+
+            if self.datagrams and not data.endswith(b"\n"):
+                data += b"\n"   # A datagram is a complete line
+
+            return data
+
+        data = os.read(self.fd, 65536)
+
+        if not data and self.tail:
+            time.sleep(self.poll)
+            return None
+
+        return data
+
+    def run(self):
+
+        buffer = b""
+
+        try:
+            while not self.stopped.is_set():
+
+                data = self._read()
+
+                if data is None:
+                    continue
+
+                if not data:
+                    break
+
+                t = time.perf_counter()
+                lines = (buffer + data).split(b"\n")
+                buffer = lines.pop()
+                lines = [line for line in lines if line.strip()]
+
+                if not lines:
+                    continue
+
+                value = None
+                errors = 0
+
+                for line in reversed(lines):    # Only the newest valid sample is kept
+
+                    try:
+                        value = parse_sample(line, self.column)
+                        break
+
+                    except (ValueError, IndexError):
+                        errors += 1
+
+                with self.lock:
+
+                    self.samples += len(lines)
+                    self.errors += errors
+
+                    if value is not None:
+                        self.value = value
+                        self.t = t
+
+        except OSError:
+            pass    # Closed
+
+        finally:
+            self.stopped.set()
+
+    def stop(self):
+
+        self.stopped.set()
+
+    def close(self):
+
+        self.stop()
+
+        if self.socket is not None:
+            self.socket.close()
+
+        elif self.fd is not None and self.source != "-":
+            os.close(self.fd)
+
+##################################################################################################################################
+
+# Tick records
+#   planned / actual: perf_counter() time the tick was due / ran
+#   input_t, value: arrival time and value of the sample used (None before the first one)
+#   target_mv: voltage asked for by the control law (after the floor and ceiling)
+#   command_mv, ticket: voltage sent and its ticket, None if no command was sent on this tick
+#   state: "sent", "hold" (change below the resolution), "busy" (the previous command was not
+#     confirmed yet) or "stale" (sent or held while the input was stale)
+
+ControlTick = namedtuple("ControlTick", ("index", "planned", "actual", "input_t", "value", "target_mv",
+                                         "command_mv", "ticket", "state"))
+
+
+def control_summary(ticks):
+
+    # Tick timing error (actual - planned) and interval in seconds, the achieved rate, the
+    # input-to-write and input-to-reply latency (median, 95th percentile, max) of the commands
+    # sent, and the number of ticks in each state
+
+    if not ticks:
+        return {"n": 0}
+
+    errors = [tick.actual - tick.planned for tick in ticks]
+    intervals = [b.actual - a.actual for a, b in zip(ticks, ticks[1:])]
+    sent = [tick for tick in ticks if tick.ticket is not None]
+    fresh = [tick for tick in sent if tick.state == "sent"]    # Not from a stale sample
+    written = [tick.ticket.written - tick.input_t for tick in fresh if tick.ticket.written is not None]
+    replied = [tick.ticket.received - tick.input_t for tick in fresh if tick.ticket.confirmed]
+    elapsed = ticks[-1].actual - ticks[0].actual
+
+    summary = {"n": len(ticks),
+               "rate_hz": (len(ticks) - 1) / elapsed if elapsed > 0 else None,
+               "mean": statistics.fmean(errors),
+               "sd": statistics.pstdev(errors),
+               "max": max(errors),
+               "interval_max": max(intervals) if intervals else None,
+               "commands": len(sent),
+               "unconfirmed": sum(not tick.ticket.confirmed for tick in sent)}
+
+    for state in ("hold", "busy", "stale"):
+        summary[state] = sum(tick.state == state for tick in ticks)
+
+    for name, values in (("input_to_write", written), ("input_to_reply", replied)):
+        values = sorted(values)
+        summary[name] = {"p50": percentile(values, 50) if values else None,
+                         "p95": percentile(values, 95) if values else None,
+                         "max": values[-1] if values else None}
+
+    return summary
+
+##################################################################################################################################
+
+# Controller
+
+
+class AmplitudeController(TimedThread):
+
+    def __init__(self, pool, dac, signal, rate_hz=100.0, gain_mv=1.0, offset_mv=0.0, law=None,
+                 floor_mv=0.0, ceiling_mv=VOLTAGE_MAX_MV, slew_mv_s=None, stale=0.1, duration=None,
+                 park_mv=0.0, spin=0.002, timeout=1.0, on_tick=None):
+
+        # signal: a SignalInput (or anything with latest()). The target voltage is
+        # offset_mv + gain_mv x sample, or law(sample) in mV, clamped to floor_mv-ceiling_mv.
+        # slew_mv_s: largest change per second (None: unlimited). A sample older than stale s
+        # (or none yet) takes the target to floor_mv. duration: end after this time (s; None:
+        # until stop()). park_mv: voltage sent when the loop ends (None: leave the last one).
+        # A command not confirmed within the timeout ends the loop.
+
+        if not 0 <= dac < len(pool):
+            raise ValueError("controller for DAC%i, but the pool has %i devices" % (dac + 1, len(pool)))
+
+        if not 0 < rate_hz <= 1000:
+            raise ValueError("control rate %r Hz is outside 0-1000 Hz" % rate_hz)
+
+        ceiling_mv = min(ceiling_mv, VOLTAGE_MAX_MV)
+
+        if not 0 <= floor_mv <= ceiling_mv or math.ceil(2 * floor_mv) > math.floor(2 * ceiling_mv):
+            raise ValueError("floor %r mV is outside 0-%r mV (in 0.5 mV steps)" % (floor_mv, ceiling_mv))
+
+        if park_mv is not None and not 0 <= park_mv <= ceiling_mv:
+            raise ValueError("park voltage %r mV is outside 0-%r mV" % (park_mv, ceiling_mv))
+
+        super().__init__(pool, spin)
+
+        self.dac = dac
+        self.signal = signal
+        self.period = 1.0 / rate_hz
+        self.law = law if law is not None else lambda value: offset_mv + gain_mv * value
+        self.floor_mv = floor_mv
+        self.ceiling_mv = ceiling_mv
+        self.max_step = slew_mv_s * self.period if slew_mv_s is not None else math.inf
+        self.stale = stale
+        self.duration = duration
+        self.park_mv = park_mv
+        self.timeout = timeout
+        self.on_tick = on_tick                  # on_tick(tick), called from the controller thread
+        self.ticks = []
+        self.missed = 0                         # Ticks skipped because the loop ran late
+        self.clamped = 0                        # Targets cut to the floor or ceiling
+        self.limited = 0                        # Commands cut by the slew limit
+        self.voltage_mv = None                  # Last voltage sent
+        self.aborted = False                    # Ended by an emergency stop or an unconfirmed command
+
+    def target(self, value):
+
+        # Voltage asked for by the control law for a sample, within the floor and ceiling
+
+        voltage = self.law(value)
+
+        if not math.isfinite(voltage):
+            voltage = self.floor_mv
+
+        if not self.floor_mv <= voltage <= self.ceiling_mv:
+            self.clamped += 1
+            voltage = min(max(voltage, self.floor_mv), self.ceiling_mv)
+
+        return voltage
+
+    def step(self, target):
+
+        # Voltage to send next: the target, moved at most max_step from the last voltage sent
+        # (from the floor for the first command), rounded down to 0.5 mV and then kept within
+        # the floor and ceiling (rounding must not take it below the floor)
+
+        previous = self.floor_mv if self.voltage_mv is None else self.voltage_mv
+
+        if abs(target - previous) > self.max_step:
+            self.limited += 1
+            target = previous + math.copysign(self.max_step, target - previous)
+
+        return min(max(math.floor(2 * target) / 2, math.ceil(2 * self.floor_mv) / 2),
+                   math.floor(2 * self.ceiling_mv) / 2)
+
+    def run(self):
+
+        stimulator = self.pool[self.dac]
+        self.stop_count = self.pool.stop_count
+
+        start = time.perf_counter()
+        end = start + self.duration if self.duration is not None else math.inf
+        ticket = None
+        sent = start
+        index = 0
+
+        while self.running():
+
+            planned = start + index * self.period
+
+            if planned >= end or not self.wait_until(planned):
+                break
+
+            actual = time.perf_counter()
+            value, input_t, _ = self.signal.latest()
+
+            stale = input_t is None or actual - input_t > self.stale
+            target = self.floor_mv if stale else self.target(value)
+
+            if ticket is not None and not ticket.done:
+
+                state = "busy"
+                command_mv = None
+
+                if actual - sent > self.timeout:
+                    self.aborted = True
+                    break
+
+            elif ticket is not None and not ticket.confirmed:
+                self.aborted = True
+                break
+
+            else:
+
+                command_mv = self.step(target)
+
+                if self.voltage_mv is not None and command_mv == self.voltage_mv:
+                    state = "hold"
+                    command_mv = None
+
+                else:
+
+                    # Written under the write lock only while the loop runs (once the DAC is idle)
+                    frame = encode_voltage(command_mv)
+                    tickets, codes = stimulator.prepare(frame)
+
+                    if self.release(stimulator, frame, tickets, codes) is None:
+                        break
+
+                    state = "sent"
+                    ticket = tickets[0]
+                    sent = actual
+                    self.voltage_mv = command_mv
+
+                if stale:
+                    state = "stale"
+
+            tick = ControlTick(index=index, planned=planned, actual=actual,
+                               input_t=input_t,
+                               value=value, target_mv=target, command_mv=command_mv,
+                               ticket=ticket if command_mv is not None else None, state=state)
+
+            self.ticks.append(tick)
+
+            if self.on_tick is not None:
+                self.on_tick(tick)
+
+            # Skip the ticks that are already over instead of running them back to back
+            late = int((time.perf_counter() - planned) / self.period)
+            self.missed += late
+            index += 1 + late
+
+        self.aborted = self.aborted or self.pool.stop_count != self.stop_count
+
+        if ticket is not None:
+            ticket.wait(self.timeout)
+
+        if self.park_mv is not None and self.voltage_mv is not None and self.voltage_mv != self.park_mv:
+
+            # Not after an emergency stop (checked under the write lock)
+            frame = encode_voltage(self.park_mv)
+            tickets, codes = stimulator.prepare(frame)
+
+            if self.release(stimulator, frame, tickets, codes,
+                            lambda: self.pool.stop_count == self.stop_count) is not None:
+                tickets[0].wait(self.timeout)
+                self.voltage_mv = self.park_mv
+
+    def summary(self):
+
+        summary = control_summary(self.ticks)
+        summary.update(missed=self.missed, clamped=self.clamped, limited=self.limited)
+
+        return summary
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Command queue between a Tk window and the stimulators
+# -----------------------------------------------------------------------------
+# Description:
+# Button callbacks hand their work to this queue and return at once; nothing
+# that touches a serial port runs on the Tk thread. Work for one device goes
+# to that device's worker, work for several devices (synchronized start,
+# close) to a thread of its own, and the emergency stop to another one that
+# first drops everything still queued. Requests that supersede each other
+# (parameter uploads, display on/off, pulse mode) are coalesced while they
+# wait. Results are handed back to Tk and the callbacks run in the Tk thread.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import queue
+
+from .pool import PortWorker
+
+##################################################################################################################################
+
+
+class CommandQueue:
+
+    def __init__(self, pool, root, interval=20, on_error=None):
+
+        # root: Tk window whose after() polls for finished work every interval ms.
+        # on_error(error) is called in the Tk thread for work that failed.
+
+        self.pool = pool
+        self.root = root
+        self.interval = interval
+        self.on_error = on_error
+        self.finished = queue.Queue()   # (future, callback) of finished work, emptied by poll()
+        self.watched = set()            # Futures that already have a callback
+        self.worker = PortWorker(None)  # Work for several devices (not bound to one port)
+        self.stopper = PortWorker(None) # Emergency stops only
+        self.closed = False
+
+        self.worker.start()
+        self.stopper.start()
+
+        self.root.after(self.interval, self.poll)
+
+    ##############################################################################################################################
+
+    # Work for one device (on the device's worker)
+
+    def device(self, index, method, *args, callback=None, key=None, **kwargs):
+
+        # Call stimulator.<method>(*args, **kwargs); with a key, a queued call with the
+        # same key is replaced instead of queuing another one
+
+        if key is None:
+            future = self.pool.submit(index, method, *args, **kwargs)
+
+        else:
+            future = self.pool.replace(index, key, method, *args, **kwargs)
+
+        return self._watch(future, callback)
+
+    def send(self, index, frame, callback=None, key=None):
+
+        return self._watch(self.pool.send(index, frame, key), callback)
+
+    def broadcast(self, frame, indices=None, callback=None, key=None):
+
+        return [self._watch(future, callback) for future in self.pool.broadcast(frame, indices, key)]
+
+    def send_parameters(self, index, callback=None, **parameters):
+
+        # Only the latest parameters of repeated requests are uploaded
+        return self._watch(self.pool.send_parameters(index, **parameters), callback)
+
+    ##############################################################################################################################
+
+    # Work for several devices
+
+    def run(self, function, *args, callback=None, key=None, **kwargs):
+
+        # Call function(*args, **kwargs) on the queue's own thread
+
+        if key is None:
+            future = self.worker.submit(function, *args, **kwargs)
+
+        else:
+            future = self.worker.replace(key, function, *args, **kwargs)
+
+        return self._watch(future, callback)
+
+    def start_synchronized(self, indices=None, callback=None):
+
+        # Repeated clicks while a start is waiting result in one start
+        return self.run(self.pool.start_synchronized, indices, callback=callback, key="start")
+
+    def stop(self, callback=None):
+
+        # Highest priority: starts and other work still queued here and on every port are
+        # dropped, and the stop bytes are written from a thread that only sends stops
+
+        self.worker.cancel()
+
+        return self._watch(self.stopper.replace("stop", self.pool.emergency_stop), callback)
+
+    def close(self, callback=None):
+
+        # Close the ports after the queued work, then stop the threads
+
+        def close():
+
+            self.pool.close()
+            self.stopper.stop()
+            self.worker.stop()
+
+        self.closed = True
+
+        return self.run(close, callback=callback)
+
+    ##############################################################################################################################
+
+    # Results (Tk thread)
+
+    def _watch(self, future, callback):
+
+        # A coalesced request returns the future of the queued one: one callback is enough
+
+        if future not in self.watched:
+            self.watched.add(future)
+            future.add_done_callback(lambda future: self.finished.put((future, callback)))
+
+        return future
+
+    def poll(self):
+
+        # Run the callbacks of finished work (callback(result); errors go to on_error)
+
+        while True:
+
+            try:
+                future, callback = self.finished.get_nowait()
+
+            except queue.Empty:
+                break
+
+            self.watched.discard(future)
+
+            if future.cancelled():
+                continue
+
+            error = future.exception()
+
+            if error is not None:
+                if self.on_error is not None:
+                    self.on_error(error)
+
+            elif callback is not None:
+                callback(future.result())
+
+        if not (self.closed and not self.watched):
+            self.root.after(self.interval, self.poll)
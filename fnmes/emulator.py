@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: DS5 Controller firmware emulator (Linux pseudo-terminal)
+# -----------------------------------------------------------------------------
+# Description:
+# Emulates the serial protocol of DS5_Controller.ino on a pseudo-terminal, so
+# the GUIs, the command line and the fnmes API can be run and benchmarked
+# without a stimulator. Opening the port resets the emulated Arduino like the
+# real one. It covers every case in loop(), the 14-byte query record, the
+# pulse-train duration, the Serial.peek() == 33 abort rule, the 100 ms
+# readBytes timeout, the 64-byte receive buffer, the byte time at the
+# emulated baud rate and the baud rate change of firmware v0.95.
+# Run as: python -m fnmes.emulator [-n DEVICES]
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import argparse
+import math
+import os
+import select
+import threading
+import time
+import tty
+from collections import deque, namedtuple
+
+from .link import BAUDRATE, SWITCH_TIMEOUT
+from .protocol import BAUD_CONFIRM, BAUDRATES
+
+##################################################################################################################################
+
+# Timing of the emulated hardware (seconds)
+
+BOOT_TIME = 0.5             # Bootloader after the reset caused by opening the port
+SPLASH_TIME = 2.0           # delay(2000) after the start screen (commands are buffered)
+READ_TIMEOUT = 0.1          # Serial.setTimeout(100)
+DISPLAY_UPDATE_TIME = 0.025 # update_display() with the display on (approx. 4 lines over I2C)
+DISPLAY_CLEAR_TIME = 0.002  # lcd.clear() (update_display() with the display off)
+BLINK_TIME = 4.0            # 10 x BACKBLINK (2 x delay(200))
+RX_BUFFER = 64              # Arduino serial receive buffer (further bytes are lost)
+
+# Firmware defaults (DS5_Controller.ino)
+
+DEFAULTS = dict(voltage=4000, width=50000, trigger=3, repeat=1, period=1000000, count=0,
+                started=False, display_on=True, bipolar=True, opamp_enabled=True)
+
+# One pulse train: start and end (perf_counter), pulses delivered, stopped early, and the
+# settings it was run with
+
+TrainRecord = namedtuple("TrainRecord", ("start", "end", "pulses", "aborted", "voltage",
+                                         "width", "period", "trigger", "bipolar"))
+
+
+def _int16(value):
+
+    # Value stored in an Arduino int
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+class _Reset(Exception):
+
+    pass
+
+
+class _Closed(Exception):
+
+    pass
+
+##################################################################################################################################
+
+# Emulator
+
+
+class FirmwareEmulator:
+
+    def __init__(self, baudrate=BAUDRATE, boot_time=BOOT_TIME, splash_time=SPLASH_TIME,
+                 display_time=DISPLAY_UPDATE_TIME, clear_time=DISPLAY_CLEAR_TIME,
+                 blink_time=BLINK_TIME, baudrates=BAUDRATES):
+
+        # baudrate: Serial.begin() after reset; baudrates: offered by command 66
+        # (empty for firmware before v0.95)
+
+        self.boot_baudrate = baudrate
+        self.baudrates = baudrates
+        self.baudrate = baudrate
+        self.byte_time = 10 / baudrate      # Start bit, 8 data bits, stop bit
+        self.boot_time = boot_time
+        self.splash_time = splash_time
+        self.display_time = display_time
+        self.clear_time = clear_time
+        self.blink_time = blink_time
+
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        os.close(slave)  # Only the host keeps the slave side open (used to detect open/close)
+
+        self.cond = threading.Condition()
+        self.rx = deque()           # (arrival time, byte) in the receive buffer or on the wire
+        self.rx_free = 0.0          # Time the host-to-device line is free again
+        self.tx = deque()           # (departure time, byte) not yet sent to the host
+        self.tx_free = 0.0
+        self.lost = 0               # Bytes lost to a full receive buffer
+        self.connected = False
+        self.resets = 0
+        self.closed = False
+        self.trains = []
+        self._resets = 0
+
+        self.__dict__.update(DEFAULTS)      # voltage, width, ... as in the firmware
+
+        self.threads = [threading.Thread(target=target, daemon=True)
+                        for target in (self._line, self._transmit, self._firmware)]
+
+        for thread in self.threads:
+            thread.start()
+
+    def __repr__(self):
+
+        return "FirmwareEmulator(%r)" % self.port
+
+    def close(self):
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+        os.close(self.master)
+
+    ##############################################################################################################################
+
+    # Serial line (host side): reset on open, byte timing and receive buffer
+
+    def _line(self):
+
+        poller = select.poll()
+        poller.register(self.master, select.POLLIN)
+
+        while not self.closed:
+
+            events = poller.poll(10)
+            hangup = any(event & select.POLLHUP for _, event in events)
+
+            if hangup:
+                if self.connected:
+                    with self.cond:
+                        self.connected = False
+                time.sleep(0.01)
+                continue
+
+            if not self.connected:
+
+                # Host opened the port: DTR resets the Arduino
+                with self.cond:
+                    self.connected = True
+                    self.resets += 1
+                    self.rx.clear()
+                    self.tx.clear()
+                    self.cond.notify_all()
+
+            if not any(event & select.POLLIN for _, event in events):
+                continue
+
+            try:
+                data = os.read(self.master, 1024)
+
+            except OSError:
+                continue
+
+            now = time.perf_counter()
+
+            with self.cond:
+
+                for byte in data:
+
+                    self.rx_free = max(now, self.rx_free) + self.byte_time
+
+                    if len(self.rx) >= RX_BUFFER:
+                        self.lost += 1
+                        continue
+
+                    self.rx.append((self.rx_free, byte))
+
+                self.cond.notify_all()
+
+    def _transmit(self):
+
+        while True:
+
+            with self.cond:
+
+                while not self.tx and not self.closed:
+                    self.cond.wait()
+
+                if self.closed:
+                    return
+
+                departure, byte = self.tx[0]
+                delay = departure - time.perf_counter()
+
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+
+                self.tx.popleft()
+                connected = self.connected
+
+            if connected:
+                try:
+                    os.write(self.master, bytes((byte,)))
+
+                except OSError:
+                    pass
+
+    ##############################################################################################################################
+
+    # Arduino primitives (run on the firmware thread)
+
+    def _check(self, resets):
+
+        if self.closed:
+            raise _Closed()
+
+        if self.resets != resets:
+            raise _Reset()
+
+    def delay(self, duration):
+
+        deadline = time.perf_counter() + duration
+
+        with self.cond:
+
+            while True:
+
+                self._check(self._resets)
+                remaining = deadline - time.perf_counter()
+
+                if remaining <= 0:
+                    return
+
+                self.cond.wait(remaining)
+
+    def read(self, timeout=None):
+
+        # Next received byte; None if nothing arrived within the timeout (Serial.read with
+        # Serial.available(), or one byte of Serial.readBytes)
+
+        deadline = None if timeout is None else time.perf_counter() + timeout
+
+        with self.cond:
+
+            while True:
+
+                self._check(self._resets)
+                now = time.perf_counter()
+
+                if self.rx and self.rx[0][0] <= now:
+                    return self.rx.popleft()[1]
+
+                if deadline is not None and now >= deadline:
+                    return None
+
+                wait = None if deadline is None else deadline - now
+
+                if self.rx:
+                    wait = min(wait, self.rx[0][0] - now) if wait is not None else self.rx[0][0] - now
+
+                self.cond.wait(wait)
+
+    def read_bytes(self, length):
+
+        # Serial.readBytes: every byte may take up to READ_TIMEOUT
+        data = bytearray()
+
+        while len(data) < length:
+
+            byte = self.read(READ_TIMEOUT)
+
+            if byte is None:
+                break
+
+            data.append(byte)
+
+        return bytes(data)
+
+    def write(self, *values):
+
+        # Serial.write: bytes leave one byte time apart
+        with self.cond:
+
+            for value in values:
+                self.tx_free = max(time.perf_counter(), self.tx_free) + self.byte_time
+                self.tx.append((self.tx_free, value & 0xFF))
+
+            self.cond.notify_all()
+
+    def set_baudrate(self, baudrate):
+
+        # Serial.end() and Serial.begin(baudrate)
+        with self.cond:
+            self.baudrate = baudrate
+            self.byte_time = 10 / baudrate
+
+    def flush(self):
+
+        # Serial.flush: wait until everything written has left
+        self.delay(self.tx_free - time.perf_counter())
+
+    def update_display(self):
+
+        self.delay(self.display_time if self.display_on else self.clear_time)
+
+    ##############################################################################################################################
+
+    # setup() and loop()
+
+    def _firmware(self):
+
+        resets = 0
+
+        while True:
+
+            with self.cond:
+
+                while self.resets == resets and not self.closed:
+                    self.cond.wait()
+
+                if self.closed:
+                    return
+
+                resets = self._resets = self.resets
+
+            try:
+                self.setup()
+
+                while True:
+                    self.loop()
+
+            except _Reset:
+                continue
+
+            except _Closed:
+                return
+
+    def setup(self):
+
+        self.__dict__.update(DEFAULTS)
+        self.set_baudrate(self.boot_baudrate)
+        self.delay(self.boot_time)
+        self.write(101)             # Serial port ready
+        self.delay(self.splash_time)
+
+    def loop(self):
+
+        command = self.read()
+
+        if not self.started:
+
+            if command == 255:      # Start device (TriggerMode)
+                self.started = True
+                self.update_display()
+
+            elif command == 99:     # Identify device by blinking display
+                self.delay(self.blink_time)
+
+            return
+
+        if command == 99:           # Identify device by blinking display
+            self.delay(self.blink_time)
+
+        elif command in (98, 97, 96):   # Pulse mode
+            self.bipolar = command == 98
+            self.opamp_enabled = command != 96
+            self.update_display()
+            self.write(command + 100)
+
+        elif command == 90:         # Set triggers
+            data = self.read_bytes(1)
+            if len(data) == 1:
+                self.trigger = min(data[0], 3)
+                self.update_display()
+                self.write(130)
+
+        elif command == 89:         # Set pulse repetition times
+            data = self.read_bytes(2)
+            if len(data) == 2:
+                self.repeat = max(_int16(data[0] * 256 + data[1]), 1)
+                self.update_display()
+                self.write(120)
+
+        elif command in (88, 87):   # Set period / width (* 0.1ms)
+            data = self.read_bytes(2)
+            if len(data) == 2:
+                value = min(max(100 * (data[0] * 256 + data[1]), 100), 9999900)
+                self._set_time(command == 88, value)
+
+        elif command in (58, 57):   # Set period / width (* 1us)
+            data = self.read_bytes(2)
+            if len(data) == 2:
+                value = min(max(data[0] * 256 + data[1], 10), 9999)
+                self._set_time(command == 58, value)
+
+        elif command == 83:         # Set output voltage
+            data = self.read_bytes(2)
+            if len(data) == 2:
+                self.voltage = _int16(data[0] * 256 + data[1])
+                if not self.opamp_enabled:
+                    self.voltage = min(self.voltage, 4095)
+                self.update_display()
+                self.write(110)
+
+        elif command == 80:         # Pulse train
+            self.pulse()
+
+        elif command == 78:         # Zeroing pulse count
+            self.count = 0
+            self.update_display()
+            self.write(112)
+
+        elif command in (69, 68):   # 69+1 turns the display on, 68+0 turns it off
+            data = self.read_bytes(1)
+            if len(data) == 1:
+                if command == 69 and data[0] == 1:
+                    self.display_on = True
+                    self.update_display()
+                elif command == 68 and data[0] == 0:
+                    self.display_on = False
+                    self.update_display()
+                self.write(114 if command == 69 else 113)
+
+        elif command == 66:         # Set baud rate
+            data = self.read_bytes(1)
+            if len(data) == 1:
+                if data[0] < len(self.baudrates):
+                    self.write(115)
+                    self.change_baudrate(self.baudrates[data[0]])
+                else:
+                    self.write(117)
+
+        elif command == 65:         # Query data
+            self.write(1, self.voltage >> 8, self.voltage, self.width >> 8, self.width,
+                       self.count >> 8, self.count, self.repeat >> 8, self.repeat,
+                       self.period >> 8, self.period, self.trigger, int(self.bipolar),
+                       int(self.opamp_enabled))
+
+        elif command == 255:        # Stop device
+            self.started = False
+            self.update_display()
+
+        # Any other byte (e.g. a stop byte after its train has ended) is ignored
+
+    def change_baudrate(self, baudrate):
+
+        # Keep the new baud rate only if the host confirms at the new rate within 500ms
+
+        self.flush()
+        self.set_baudrate(baudrate)
+
+        deadline = time.perf_counter() + SWITCH_TIMEOUT
+
+        while True:
+
+            byte = self.read(max(0, deadline - time.perf_counter()))
+
+            if byte is None:
+                break
+
+            if byte == BAUD_CONFIRM:
+                self.write(116)
+                return
+
+        self.set_baudrate(self.boot_baudrate)
+
+    def _set_time(self, period, value):
+
+        if period:
+            self.period = value
+            reply = 121
+        else:
+            self.width = value
+            reply = 111
+
+        self.update_display()
+        self.write(reply)
+
+    def pulse(self):
+
+        # Pulse i starts at start + i * period and ends width later. After every pulse but
+        # the last, the train stops if Serial.peek() == 33, i.e. if a stop byte has arrived
+        # and is the first byte in the receive buffer.
+
+        start = time.perf_counter()
+        period = max(self.period, self.width) / 1e6
+        width = self.width / 1e6
+        pulses = max(self.repeat, 1)
+        end = start + (pulses - 1) * period + width
+        aborted = False
+
+        with self.cond:
+
+            while True:
+
+                self._check(self._resets)
+
+                if self.rx:
+
+                    arrival, byte = self.rx[0]
+
+                    if byte == 33:
+
+                        # First pulse that ends after the stop byte has arrived
+                        i = max(0, math.ceil((arrival - start - width) / period))
+
+                        if i < pulses - 1:
+                            pulses = i + 1
+                            aborted = True
+                            end = start + i * period + width
+
+                    break   # Any other first byte hides a later stop byte until the end
+
+                remaining = end - time.perf_counter()
+
+                if remaining <= 0:
+                    break
+
+                self.cond.wait(remaining)
+
+        self.delay(end - time.perf_counter())
+
+        self.trains.append(TrainRecord(start=start, end=end, pulses=pulses, aborted=aborted,
+                                       voltage=self.voltage, width=self.width, period=self.period,
+                                       trigger=self.trigger, bipolar=self.bipolar))
+
+        self.count = _int16(self.count + 1)
+        self.update_display()
+        self.write(100)             # End of sequence
+
+##################################################################################################################################
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m fnmes.emulator",
+                                     description="Emulate DS5 Controllers on pseudo-terminals.")
+
+    parser.add_argument("-n", "--devices", type=int, default=1)
+    parser.add_argument("--baudrate", type=int, default=BAUDRATE,
+                        help="baud rate after reset (Serial.begin)")
+    parser.add_argument("--fast", action="store_true",
+                        help="no bootloader, start screen or display delays")
+
+    args = parser.parse_args(argv)
+
+    options = dict(boot_time=0, splash_time=0, display_time=0, clear_time=0) if args.fast else {}
+
+    emulators = [FirmwareEmulator(args.baudrate, **options) for _ in range(args.devices)]
+
+    for i, emulator in enumerate(emulators):
+        print("DAC%i: %s" % (i + 1, emulator.port), flush=True)
+
+    try:
+        while True:
+            time.sleep(1)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for emulator in emulators:
+            emulator.close()
+
+
+if __name__ == "__main__":
+    main()
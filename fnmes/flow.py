@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Credit-based flow control for the Arduino receive buffer
+# -----------------------------------------------------------------------------
+# Description:
+# The firmware handles one command per loop() pass and redraws the LCD before
+# it replies, while further bytes wait in the 64-byte receive buffer (bytes
+# beyond it are lost, and a lost argument byte shifts every later command).
+# A CreditWindow limits the commands and bytes a port has in flight: a
+# command holds its credit until its reply shows that the firmware has read
+# it, and nothing is sent while a pulse train runs, so a stop byte is never
+# queued behind other commands. The window grows while the turnaround stays
+# close to the fastest one seen and shrinks when commands queue up on the
+# device or go unanswered, so uploads are pipelined as far as the device
+# keeps up.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import threading
+import time
+from collections import deque
+
+from .protocol import BLINK, START_PULSE
+
+##################################################################################################################################
+
+# Defaults
+
+MAX_BYTES = 48          # Bytes in flight; the rest of the 64-byte buffer is left for a stop byte and
+                        # commands sent without flow control (emergency stop, baud rate change)
+WINDOW = 4              # Initial window (commands)
+MAX_WINDOW = 16
+CREDIT_TIMEOUT = 1.0    # An unanswered command gives back its credit after this time (s)
+HOLD = 0.1              # Credit held by a command without a reply (s), unless a later reply comes first
+HOLDS = {BLINK: 4.5}    # The firmware blinks for 4 s before it reads the next command
+TRAIN_TIMEOUT = 60.0    # A start command gives back its credit after this time (s) if neither its
+                        # end-of-sequence byte nor the train's predicted end resolves it
+
+# Commands queued on the device (window x (1 - fastest turnaround / turnaround)): the window
+# grows below ALPHA and shrinks above BETA (one command per window of replies)
+ALPHA = 1.0
+BETA = 3.0
+
+##################################################################################################################################
+
+
+class CreditWindow:
+
+    def __init__(self, window=WINDOW, min_window=1, max_window=MAX_WINDOW, max_bytes=MAX_BYTES,
+                 timeout=CREDIT_TIMEOUT, alpha=ALPHA, beta=BETA, train_timeout=TRAIN_TIMEOUT):
+
+        self.window = float(window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.train_timeout = train_timeout
+        self.alpha = alpha
+        self.beta = beta
+
+        self.cond = threading.Condition()
+        self.entries = deque()      # [code, size, ticket or None, perf_counter() time] in the order sent
+        self.used = 0               # Bytes in flight
+        self.base = None            # Fastest turnaround seen (s)
+        self.trains = 0             # Start commands in flight
+
+        self.acked = 0              # Credits given back by a reply
+        self.lost = 0               # Commands the firmware did not confirm
+        self.expired = 0            # Credits given back after the timeout
+        self.waits = 0              # Acquisitions that had to wait for a credit
+        self.wait_time = 0.0        # Total time spent waiting (s)
+
+    def __repr__(self):
+
+        return "CreditWindow(window=%.1f, in_flight=%i, bytes=%i)" % (self.window, len(self.entries),
+                                                                      self.used)
+
+    @property
+    def in_flight(self):
+
+        return len(self.entries)
+
+    def acquire(self, commands):
+
+        # commands: (code, size, ticket or None) of the commands still to be sent, in order.
+        # Blocks until the first one fits and takes credits for as many as fit (at least one);
+        # returns how many. A ticket gives its credit back once it is resolved.
+
+        with self.cond:
+
+            taken = self._fit(commands)
+
+            if not taken:
+
+                self.waits += 1
+                t = time.perf_counter()
+
+                while True:
+
+                    wait = self._expire()   # Credits held too long are given back first
+                    taken = self._fit(commands)
+
+                    if taken:
+                        break
+
+                    self.cond.wait(wait)
+
+                self.wait_time += time.perf_counter() - t
+
+            self.register(commands[:taken])
+
+        return taken
+
+    def register(self, commands):
+
+        # Take credits for commands that are sent without waiting (e.g. a synchronized start);
+        # the window and the byte limit may be exceeded
+
+        t = time.perf_counter()
+        entries = [[code, size, ticket, t] for code, size, ticket in commands]
+
+        with self.cond:
+            self.entries.extend(entries)
+            self.used += sum(entry[1] for entry in entries)
+            self.trains += sum(entry[0] == START_PULSE for entry in entries)
+
+        for entry in entries:
+            if entry[2] is not None:
+                entry[2].add_done_callback(self._release)
+
+    def _fit(self, commands):
+
+        # Number of commands that fit into the window now (one oversized command may be
+        # sent on an empty window). None of them while a train runs: the firmware only looks for a
+        # stop byte at the head of its receive buffer.
+
+        if self.trains:
+            return 0
+
+        free = int(self.window) - len(self.entries)
+        room = self.max_bytes - self.used
+        taken = 0
+
+        for code, size, ticket in commands[:max(free, 0)]:
+
+            if size > room and (taken or self.entries):
+                break
+
+            room -= size
+            taken += 1
+
+        return taken
+
+    def _expire(self):
+
+        # Give back the credit of the oldest command if it has been held too long; returns
+        # the time until that happens. A start command normally gives its credit back at the
+        # end of the train (reply or predicted end), at the latest after train_timeout.
+
+        while self.entries:
+
+            code, size, ticket, t = self.entries[0]
+
+            if code == START_PULSE:
+                hold = self.train_timeout
+            else:
+                hold = HOLDS.get(code, HOLD) if ticket is None else self.timeout
+
+            left = t + hold - time.perf_counter()
+
+            if left > 0:
+                return left
+
+            self.entries.popleft()
+            self.used -= size
+            self.trains -= code == START_PULSE
+
+            if ticket is not None:
+                self.expired += 1
+                self.window = max(self.min_window, self.window / 2)
+
+        return None
+
+    def _release(self, ticket):
+
+        # Called from the reader thread: the firmware has read this command and every
+        # command sent before it
+
+        with self.cond:
+
+            for i, entry in enumerate(self.entries):
+                if entry[2] is ticket:
+                    break
+
+            else:
+                return  # Expired or reset
+
+            queued = len(self.entries)
+
+            for _ in range(i + 1):
+
+                code, size = self.entries.popleft()[:2]
+                self.used -= size
+                self.trains -= code == START_PULSE
+
+            if not ticket.confirmed:
+
+                self.lost += 1
+                self.window = max(self.min_window, self.window / 2)
+
+            else:
+
+                self.acked += 1
+
+                if ticket.code != START_PULSE:  # Its turnaround includes the train
+                    self._adapt(ticket.latency, queued)
+
+            self.cond.notify_all()
+
+    def _adapt(self, turnaround, queued):
+
+        self.base = turnaround if self.base is None else min(self.base, turnaround)
+
+        # Commands waiting on the device, estimated from the extra turnaround
+        waiting = min(queued, self.window) * (1 - self.base / turnaround)
+
+        if waiting < self.alpha:
+            self.window = min(self.max_window, self.window + 1 / self.window)
+
+        elif waiting > self.beta:
+            self.window = max(self.min_window, self.window - 1 / self.window)
+
+    def reset(self):
+
+        # Forget all credits (the device was reset and its receive buffer is empty)
+
+        with self.cond:
+
+            self.entries.clear()
+            self.used = 0
+            self.trains = 0
+            self.cond.notify_all()
+
+    def stats(self):
+
+        with self.cond:
+
+            return {"window": self.window, "in_flight": len(self.entries), "bytes": self.used,
+                    "turnaround": self.base, "acked": self.acked, "lost": self.lost,
+                    "expired": self.expired, "waits": self.waits, "wait_time": self.wait_time}
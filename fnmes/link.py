@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Opening and waking up DS5 Controller ports
+# -----------------------------------------------------------------------------
+# Description:
+# Opens the serial ports of all stimulators concurrently. Each port is ready as
+# soon as the Arduino reports that its bootloader reset has finished (ready
+# byte 0x65). Firmware that does not send the ready byte falls back to the
+# fixed 2 s wait used by the GUIs before. Ports start at 19200 baud and can
+# then be switched to a faster rate that both sides confirm. A port is
+# returned once the firmware has left its start screen and answers commands,
+# so the first command does not wait out the 2 s splash.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import threading
+import time
+
+from .protocol import (BAUD_ACCEPTED, BAUD_CONFIRM, BAUD_CONFIRMED, QUERY, QUERY_HEADER,
+                       QUERY_RECORD_SIZE, READY, START_DEVICE, command, encode_baudrate)
+
+##################################################################################################################################
+
+BAUDRATE = 19200            # Serial.begin(19200) in DS5_Controller.ino (after every reset)
+
+BOOT_TIMEOUT = 2.0          # Fallback wait (s) when no ready byte arrives
+
+SWITCH_TIMEOUT = 0.5        # The firmware waits 500ms for the confirmation of a new baud rate
+
+SYNC_TIMEOUT = 3.0          # The firmware reads commands only after delay(2000) behind the ready byte
+
+##################################################################################################################################
+
+# Wait for the ready byte sent by the firmware after a reset
+
+
+def wait_ready(ser, timeout=BOOT_TIMEOUT):
+
+    # Returns True as soon as the ready byte arrived, False once the fallback wait is over
+    return wait_byte(ser, READY, timeout)
+
+
+def wait_byte(ser, value, timeout):
+
+    # Read until the given byte arrives (True) or the timeout is over (False)
+
+    deadline = time.monotonic() + timeout
+
+    previous_timeout = ser.timeout
+
+    ser.timeout = 0.01  # Short blocking reads instead of spinning on timeout=0
+
+    try:
+
+        while True:
+
+            data = ser.read(ser.in_waiting or 1)
+
+            if value in data:
+                return True
+
+            if time.monotonic() >= deadline:
+                return False
+
+    finally:
+
+        ser.timeout = previous_timeout
+
+
+def sync(ser, timeout=SYNC_TIMEOUT):
+
+    # Wait until the firmware reads commands (after its start screen): send Query Data and
+    # read the whole record, so that no reply is left for the reply reader. True if it arrived.
+
+    previous_timeout = ser.timeout
+    ser.timeout = 0.01
+
+    deadline = time.monotonic() + timeout
+    data = b""
+
+    try:
+
+        ser.write(command(QUERY))
+
+        while time.monotonic() < deadline:
+
+            data += ser.read(ser.in_waiting or 1)
+            start = data.find(bytes((QUERY_HEADER,)))
+
+            if start >= 0 and len(data) - start >= QUERY_RECORD_SIZE:
+                return True
+
+        return False
+
+    finally:
+
+        ser.timeout = previous_timeout
+
+
+# Faster baud rates (firmware v0.95)
+
+
+def negotiate_baudrate(ser, baudrate, timeout=SWITCH_TIMEOUT):
+
+    # Switch a device from 19200 baud to a faster rate and return the rate in use afterwards.
+    # The firmware acknowledges at the old rate and changes its rate; the host changes its rate
+    # and confirms. Without the confirmation (or with older firmware, which ignores the
+    # command) both sides stay at or go back to 19200. The device must already be reading
+    # commands (see sync): during its start screen the reply cannot come in time, and the
+    # firmware would switch later, while the host stays at 19200.
+
+    frame = encode_baudrate(baudrate)   # ValueError for rates the firmware does not offer
+
+    if baudrate == ser.baudrate:
+        return baudrate
+
+    ser.reset_input_buffer()
+    ser.write(frame)
+
+    if not wait_byte(ser, BAUD_ACCEPTED, timeout):
+        return ser.baudrate         # Firmware before v0.95
+
+    ser.baudrate = baudrate
+    ser.write(command(BAUD_CONFIRM))
+
+    if wait_byte(ser, BAUD_CONFIRMED, timeout):
+        return baudrate
+
+    # Not confirmed: the firmware goes back to 19200 once its wait is over
+    ser.baudrate = BAUDRATE
+    time.sleep(timeout)
+    ser.reset_input_buffer()
+
+    return BAUDRATE
+
+
+def open_device(port, baudrate=BAUDRATE, boot_timeout=BOOT_TIMEOUT):
+
+    # Open and start a device at 19200 baud, wait until it answers commands, then switch to
+    # the given baud rate (ser.baudrate is 19200 if the device could not switch)
+
+    import serial  # pyserial is only needed once a port is opened
+
+    ser = serial.Serial(port, BAUDRATE, timeout=0, writeTimeout=0)
+
+    wait_ready(ser, boot_timeout)
+
+    ser.write(command(START_DEVICE))  # Start device
+
+    if sync(ser) and baudrate != BAUDRATE:
+        negotiate_baudrate(ser, baudrate)
+
+    return ser
+
+
+def open_devices(ports, baudrate=BAUDRATE, boot_timeout=BOOT_TIMEOUT):
+
+    # Open and wake up all ports at the same time, so that startup takes as long
+    # as the slowest device instead of the sum of all devices
+
+    devices = [None] * len(ports)
+    errors = []
+
+    def worker(i, port):
+
+        try:
+            devices[i] = open_device(port, baudrate, boot_timeout)
+
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(i, port), daemon=True)
+               for i, port in enumerate(ports)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+
+        for ser in devices:
+            if ser is not None:
+                ser.close()
+
+        raise errors[0]
+
+    return devices
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Event markers for EEG/EMG synchronization
+# -----------------------------------------------------------------------------
+# Description:
+# Publishes a compact binary event over a localhost UDP or Unix domain
+# datagram socket the moment a start or stop byte is written, and when the
+# firmware reports the end of a pulse train. Events carry the write time, the
+# device and its confirmed parameters. The socket is non-blocking: an event
+# that cannot be sent right away is dropped instead of delaying stimulation.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import socket
+import struct
+import threading
+from collections import namedtuple
+
+from .protocol import (SET_COUNT, SET_PERIOD_MS, SET_PERIOD_US, SET_TRIGGER, SET_VOLTAGE,
+                       SET_WIDTH_MS, SET_WIDTH_US, START_PULSE, STOP, command)
+
+##################################################################################################################################
+
+# Event format (27 bytes, little endian):
+#   kind, device, sequence number, t_ns (perf_counter_ns of the write or of the reply),
+#   count, period (us), width (us), voltage (0.5mV steps), trigger
+# Parameters that were never confirmed by the device are 0 (trigger: 255).
+
+START = 1                   # Start byte written
+END = 2                     # End-of-sequence byte (100) received
+STOPPED = 3                 # Stop byte written
+
+MARKER = struct.Struct("<BBIQHIIHB")
+
+Marker = namedtuple("Marker", ("kind", "device", "sequence", "t_ns", "count", "period_us",
+                               "width_us", "voltage", "trigger"))
+
+
+def decode_marker(data):
+
+    return Marker(*MARKER.unpack(data))
+
+
+def _word(shadow, code, scale=1):
+
+    payload = shadow.get(code)
+
+    return None if payload is None else (payload[0] << 8 | payload[1]) * scale
+
+
+def confirmed_parameters(stimulator):
+
+    # count, period (us), width (us), voltage (0.5mV), trigger from the confirmed values
+
+    with stimulator.shadow_lock:
+        shadow = dict(stimulator.shadow)
+
+    period = _word(shadow, SET_PERIOD_US)
+    width = _word(shadow, SET_WIDTH_US)
+
+    if period is None:
+        period = _word(shadow, SET_PERIOD_MS, 100)
+
+    if width is None:
+        width = _word(shadow, SET_WIDTH_MS, 100)
+
+    trigger = shadow.get(SET_TRIGGER)
+
+    return (_word(shadow, SET_COUNT) or 0, period or 0, width or 0,
+            _word(shadow, SET_VOLTAGE) or 0, trigger[0] if trigger else 255)
+
+##################################################################################################################################
+
+# Publisher
+
+
+class MarkerPublisher:
+
+    def __init__(self, address=("127.0.0.1", 5005)):
+
+        # address: (host, port) for UDP or a path for a Unix domain datagram socket
+
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+        self.address = address
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.ids = {}               # Stimulator -> device id
+        self.started = {}           # Stimulator -> parameters of its latest start
+        self.sequence = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def attach(self, stimulator):
+
+        # Publish markers for this stimulator (device id = order attached)
+        self.ids[stimulator] = len(self.ids)
+        stimulator.observers.append(self)
+
+    def detach(self, stimulator):
+
+        if self in stimulator.observers:
+            stimulator.observers.remove(self)
+
+    def publish(self, kind, stimulator, t, parameters):
+
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+
+        data = MARKER.pack(kind, self.ids[stimulator], sequence & 0xFFFFFFFF, round(t * 1e9),
+                           *parameters)
+
+        try:
+            self.socket.sendto(data, self.address)
+
+        except OSError:
+            self.dropped += 1   # No listener, or the socket buffer is full
+
+    # Observer interface (see Stimulator)
+
+    def sent(self, stimulator, frame, tickets, t):
+
+        # Stop and end events repeat the parameters of the start (an emergency stop clears
+        # the confirmed values)
+
+        if frame == command(STOP):
+            self.publish(STOPPED, stimulator, t, self._parameters(stimulator))
+            return
+
+        for ticket in tickets:
+
+            if ticket.code == START_PULSE:
+
+                parameters = self.started[stimulator] = confirmed_parameters(stimulator)
+
+                self.publish(START, stimulator, t, parameters)
+                ticket.add_done_callback(lambda ticket: self._ended(stimulator, ticket, parameters))
+
+    def received(self, stimulator, data, t):
+
+        pass
+
+    def _parameters(self, stimulator):
+
+        return self.started.get(stimulator) or confirmed_parameters(stimulator)
+
+    def _ended(self, stimulator, ticket, parameters):
+
+        if ticket.confirmed:
+            self.publish(END, stimulator, ticket.received, parameters)
+
+    def close(self):
+
+        self.socket.close()
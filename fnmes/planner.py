@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Pulse timeline and session planner (NumPy)
+# -----------------------------------------------------------------------------
+# Description:
+# Expands a whole protocol into the pulse trains the firmware will produce:
+# start, end and pulse onsets/offsets of every train, the windows in which
+# each DAC is busy, trains that are due while their DAC is still busy, and
+# the session length, duty cycle and charge per train. Parameters that a
+# trial does not set are not sent, so they carry over from the DAC's previous
+# trial, as on the device. Thousands of trials are planned in one pass,
+# before a session.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import numpy as np
+
+##################################################################################################################################
+
+# Firmware defaults and limits (DS5_Controller.ino)
+
+DEFAULT_COUNT = 1
+DEFAULT_PERIOD_US = 1000000
+DEFAULT_WIDTH_US = 50000
+DEFAULT_VOLTAGE_MV = 2000.0
+PERIOD_US_RANGE = (10, 9999)          # 0x3A / 0x39
+PERIOD_MS_RANGE = (100, 9999900)      # 0x58 / 0x57 (in us)
+
+##################################################################################################################################
+
+# Trial lists
+
+
+def _time_us(parameters, ms_name, us_name):
+
+    # Period or width as the firmware stores it (us); -1 if the trial does not set it.
+    # A non-zero us value is sent after the ms value and wins (see parameter_commands).
+
+    us = parameters.get(us_name) or 0
+    ms = parameters.get(ms_name) or 0
+
+    if us > 0:
+        return min(max(int(us), PERIOD_US_RANGE[0]), PERIOD_US_RANGE[1])
+
+    if ms > 0:
+        return min(max(100 * round(ms * 10), PERIOD_MS_RANGE[0]), PERIOD_MS_RANGE[1])
+
+    return -1
+
+
+def _count(parameters):
+
+    # Pulses per train as the firmware stores them (at least one); -1 if the trial does not set it
+
+    count = parameters.get("count")
+
+    return -1 if count is None else max(int(count), 1)
+
+
+def _voltage_mv(parameters):
+
+    # Voltage in 0.5mV steps (rounded down like encode_voltage); -1 if the trial does not set it
+
+    voltage_mv = parameters.get("voltage_mv")
+
+    return -1.0 if voltage_mv is None else min(int(voltage_mv * 2), 4095) / 2
+
+
+def trial_arrays(trials, start_delay=0.0):
+
+    # Arrays for ProtocolPlan from Trial tuples (see scheduler.load_trials): the planned start of
+    # each trial (s, as run by ProtocolScheduler) and its settings, -1 where the trial does not
+    # set them (send_parameters leaves them out)
+
+    trials = list(trials)
+    n = len(trials)
+
+    iti = np.fromiter((trial.iti for trial in trials), np.float64, n)
+    start = start_delay + np.concatenate(([0.0], np.cumsum(iti)[:-1])) if n else iti
+
+    return dict(dac=np.fromiter((trial.dac for trial in trials), np.int64, n),
+                start=start,
+                count=np.fromiter((_count(trial.parameters) for trial in trials), np.int64, n),
+                period_us=np.fromiter((_time_us(trial.parameters, "period_ms", "period_us")
+                                       for trial in trials), np.int64, n),
+                width_us=np.fromiter((_time_us(trial.parameters, "width_ms", "width_us")
+                                      for trial in trials), np.int64, n),
+                voltage_mv=np.fromiter((_voltage_mv(trial.parameters) for trial in trials),
+                                       np.float64, n))
+
+
+def plan_trials(trials, start_delay=0.0, bipolar=True, gain=None):
+
+    return ProtocolPlan(bipolar=bipolar, gain=gain, **trial_arrays(trials, start_delay))
+
+##################################################################################################################################
+
+# Plan
+
+
+def _carry_over(values, dac, order, default):
+
+    # Replace negative values (not set by the trial) by the DAC's previous value, or by
+    # the firmware default for a DAC's first trial
+
+    values = values[order]
+    dac = dac[order]
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = dac[1:] != dac[:-1]
+
+    values = np.where(first & (values < 0), default, values)
+    positions = np.where(values >= 0, np.arange(len(values)), 0)
+    filled = values[np.maximum.accumulate(positions)]
+
+    result = np.empty_like(filled)
+    result[order] = filled
+
+    return result
+
+
+class ProtocolPlan:
+
+    # Arrays with one entry per trial (in trial order):
+    #   dac, start (s), count, period_us, width_us, voltage_mv: the train's settings (a negative
+    #     count, period, width or voltage is carried over from the DAC's previous trial)
+    #   duration, end (s): (count - 1) x period + width after the start
+    #   conflict: the train is due while the same DAC is still running the previous one (the
+    #     firmware reads the start byte only after that train, so the train would start late)
+    #   phase_charge_uc, charge_uc: charge per phase and per train (absolute), if a gain is given
+    #
+    # bipolar: pulse mode of all DACs, or one flag per DAC (bipolar pulses are a positive and a
+    # negative phase of half the width). gain: stimulator gain in mA/V (the DS5 turns the DAC
+    # voltage into a current); without it no charge is computed.
+
+    def __init__(self, dac, start, count, period_us, width_us, voltage_mv, bipolar=True, gain=None):
+
+        self.dac = np.asarray(dac, dtype=np.int64)
+        self.start = np.asarray(start, dtype=np.float64)
+        n = len(self.dac)
+
+        order = np.lexsort((np.arange(n), self.dac))    # By DAC, then in trial order
+        self.order = order
+
+        self.count = _carry_over(np.broadcast_to(np.asarray(count, dtype=np.int64), n),
+                                 self.dac, order, DEFAULT_COUNT)
+        self.period_us = _carry_over(np.broadcast_to(np.asarray(period_us, dtype=np.int64), n),
+                                     self.dac, order, DEFAULT_PERIOD_US)
+        self.width_us = _carry_over(np.broadcast_to(np.asarray(width_us, dtype=np.int64), n),
+                                    self.dac, order, DEFAULT_WIDTH_US)
+        self.voltage_mv = _carry_over(np.broadcast_to(np.asarray(voltage_mv, dtype=np.float64), n),
+                                      self.dac, order, DEFAULT_VOLTAGE_MV)
+
+        # The next pulse cannot start before the previous one has ended
+        self.pulse_period_us = np.maximum(self.period_us, self.width_us)
+
+        self.duration = ((self.count - 1) * self.pulse_period_us + self.width_us) / 1e6
+        self.end = self.start + self.duration
+
+        sorted_dac = self.dac[order]
+        same = sorted_dac[1:] == sorted_dac[:-1]
+        self.conflict = np.zeros(n, dtype=bool)
+        self.conflict[order[1:]] = same & (self.start[order[1:]] < self.end[order[:-1]])
+
+        bipolar = np.asarray(bipolar, dtype=bool)
+        self.bipolar = bipolar[self.dac] if bipolar.ndim else np.full(n, bool(bipolar))
+
+        self.gain = gain
+        self.phase_charge_uc = None
+        self.charge_uc = None
+
+        if gain is not None:
+            pulse_charge = self.voltage_mv / 1000 * gain * self.width_us / 1000    # mA x us = nC -> uC
+            self.phase_charge_uc = np.where(self.bipolar, pulse_charge / 2, pulse_charge)
+            self.charge_uc = pulse_charge * self.count
+
+    def __len__(self):
+
+        return len(self.dac)
+
+    def devices(self):
+
+        return np.unique(self.dac)
+
+    def _trials(self, dac):
+
+        return np.arange(len(self.dac)) if dac is None else np.flatnonzero(self.dac == dac)
+
+    def pulses(self, dac=None):
+
+        # Onset and offset (s) of every pulse of all (or one DAC's) trains, and the trial
+        # each pulse belongs to
+
+        trials = self._trials(dac)
+        counts = self.count[trials]
+
+        trial = np.repeat(trials, counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        k = np.arange(len(trial)) - first   # Pulse number within its train
+
+        onsets = self.start[trial] + k * self.pulse_period_us[trial] / 1e6
+        offsets = onsets + self.width_us[trial] / 1e6
+
+        return onsets, offsets, trial
+
+    def busy_windows(self, dac):
+
+        # Start and end (s) of the periods in which the DAC runs trains (overlapping and
+        # touching trains are merged)
+
+        trials = self._trials(dac)
+        trials = trials[np.argsort(self.start[trials], kind="stable")]
+
+        starts = self.start[trials]
+        ends = np.maximum.accumulate(self.end[trials])
+
+        new = np.ones(len(trials), dtype=bool)
+        new[1:] = starts[1:] > ends[:-1]
+
+        last = np.append(np.flatnonzero(new)[1:] - 1, len(trials) - 1)
+
+        return starts[new], ends[last]
+
+    def summary(self):
+
+        # Session length and per DAC: trains, pulses, busy time, stimulation time, duty cycle
+        # (stimulation time / session length), conflicts and charge
+
+        if not len(self.dac):
+            return {"trials": 0}
+
+        session = float(self.end.max() - self.start.min())
+        devices = {}
+
+        for dac in self.devices():
+
+            trials = self._trials(dac)
+            starts, ends = self.busy_windows(dac)
+            stimulation = float(np.sum(self.count[trials] * self.width_us[trials]) / 1e6)
+
+            device = {"trains": len(trials),
+                      "pulses": int(self.count[trials].sum()),
+                      "busy_s": float(np.sum(ends - starts)),
+                      "stimulation_s": stimulation,
+                      "duty_cycle": stimulation / session if session > 0 else 0.0,
+                      "conflicts": int(self.conflict[trials].sum())}
+
+            if self.charge_uc is not None:
+                device["max_phase_charge_uc"] = float(self.phase_charge_uc[trials].max())
+                device["max_train_charge_uc"] = float(self.charge_uc[trials].max())
+                device["total_charge_uc"] = float(self.charge_uc[trials].sum())
+
+            devices["DAC%i" % (dac + 1)] = device
+
+        return {"trials": len(self.dac),
+                "session_s": session,
+                "start_s": float(self.start.min()),
+                "end_s": float(self.end.max()),
+                "devices": devices}
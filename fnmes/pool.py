@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Pool of DS5 Controllers
+# -----------------------------------------------------------------------------
+# Description:
+# Holds any number of stimulators and gives each port its own I/O worker
+# thread. Commands for several devices (e.g. stop, start, display on/off) are
+# handed to all workers at once and written concurrently, so broadcast latency
+# does not grow with the number of devices. A synchronized start arms all ports
+# and writes the start byte to each of them back to back, recording the time
+# of every write and the resulting inter-device skew. The emergency stop has its
+# own parked thread per port and never waits behind queued work.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import CancelledError, Future, wait
+from contextlib import contextmanager
+
+from .flow import CreditWindow
+from .link import BAUDRATE, BOOT_TIMEOUT, open_devices
+from .protocol import START_PULSE, command, encode_display
+from .replies import wait_all
+from .stimulator import Stimulator
+
+##################################################################################################################################
+
+# One synchronized start: device names, perf_counter() time each start byte was written,
+# skew (latest minus earliest write, in seconds) and the start tickets (confirmed by the
+# end-of-sequence byte)
+
+StartReport = namedtuple("StartReport", ("names", "written", "skew", "tickets"))
+
+# One emergency stop: device names, perf_counter() time of the request, time each stop byte
+# was written, write latency per device (seconds) and the tickets of the interrupted trains
+# (None for idle devices; received - requested is the latency up to the end-of-sequence byte)
+
+StopReport = namedtuple("StopReport", ("names", "requested", "written", "latency", "trains"))
+
+##################################################################################################################################
+
+# I/O worker (one per port)
+
+
+class PortWorker(threading.Thread):
+
+    def __init__(self, stimulator):
+
+        super().__init__(daemon=True)
+
+        self.stimulator = stimulator
+        self.jobs = queue.Queue()
+        self.queued = {}            # key -> job that has not started yet (see replace)
+        self.coalesced = 0          # Jobs replaced before they started
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+
+        future = Future()
+
+        self.jobs.put([future, function, args, kwargs, None])
+
+        return future
+
+    def replace(self, key, function, *args, **kwargs):
+
+        # As submit, but if a job with the same key is still queued, it is updated in place
+        # and its future is returned: only the latest of several quick requests is carried
+        # out (e.g. parameter uploads of repeated clicks on "Set DAC1")
+
+        with self.lock:
+
+            job = self.queued.get(key)
+
+            if job is not None and not job[0].cancelled():
+                job[1:4] = function, args, kwargs
+                self.coalesced += 1
+                return job[0]
+
+            future = Future()
+            job = self.queued[key] = [future, function, args, kwargs, key]
+
+            self.jobs.put(job)
+
+        return future
+
+    def run(self):
+
+        while True:
+
+            job = self.jobs.get()
+
+            if job is None:
+                break
+
+            with self.lock:
+
+                if self.queued.get(job[4]) is job:
+                    del self.queued[job[4]]
+
+                future, function, args, kwargs, _ = job
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(function(*args, **kwargs))
+
+            except Exception as error:
+                future.set_exception(error)
+
+    def cancel(self):
+
+        # Drop queued jobs that have not started yet (their futures are cancelled)
+
+        with self.lock:
+            self.queued.clear()
+
+        while True:
+
+            try:
+                job = self.jobs.get_nowait()
+
+            except queue.Empty:
+                break
+
+            if job is None:
+                self.jobs.put(None)
+                break
+
+            job[0].cancel()
+            job[0].set_running_or_notify_cancel()  # Wakes up wait() on the future
+
+    def stop(self):
+
+        self.jobs.put(None)
+
+##################################################################################################################################
+
+# Stop line (one per port)
+
+
+class StopWorker(threading.Thread):
+
+    # Parked until an emergency stop, then writes the stop byte right away. It does not go
+    # through the port's job queue, so it never waits behind queued or blocked work.
+
+    def __init__(self, stimulator):
+
+        super().__init__(daemon=True)
+
+        self.stimulator = stimulator
+        self.trigger = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.closed = False
+
+    def fire(self):
+
+        self.result = None
+        self.done.clear()
+        self.trigger.set()
+
+    def run(self):
+
+        while True:
+
+            self.trigger.wait()
+            self.trigger.clear()
+
+            if self.closed:
+                break
+
+            try:
+                self.result = self.stimulator.emergency_stop()
+
+            except Exception as error:
+                self.result = error
+
+            self.done.set()
+
+    def stop(self):
+
+        self.closed = True
+        self.trigger.set()
+
+##################################################################################################################################
+
+# Pool
+
+
+class StimulatorPool:
+
+    def __init__(self, stimulators, history=1024):
+
+        self.stimulators = list(stimulators)
+        self.workers = [PortWorker(stimulator) for stimulator in self.stimulators]
+        self.stoppers = [StopWorker(stimulator) for stimulator in self.stimulators]
+        self.starts = deque(maxlen=history)  # StartReport of the latest synchronized starts
+        self.stops = deque(maxlen=history)   # StopReport of the latest emergency stops
+        self.stop_lock = threading.Lock()
+        self.stop_count = 0                  # Emergency stops so far (a start armed before one is not sent)
+
+        for worker in self.workers + self.stoppers:
+            worker.start()
+
+    @classmethod
+    def open(cls, ports, baudrate=BAUDRATE, boot_timeout=BOOT_TIMEOUT, names=None, flow=False,
+             gate=True):
+
+        # Open, wake up and wrap all ports (DAC1, DAC2, ... unless names are given). With
+        # flow, every port gets its own credit window (see flow.CreditWindow); with gate,
+        # frames sent during a train are held until it has ended (see Stimulator.hold).
+
+        names = names or ["DAC%i" % (i + 1) for i in range(len(ports))]
+
+        sers = open_devices(ports, baudrate, boot_timeout)
+
+        return cls(Stimulator(ser, name, flow=CreditWindow() if flow else None, gate=gate)
+                   for ser, name in zip(sers, names))
+
+    def __len__(self):
+
+        return len(self.stimulators)
+
+    def __getitem__(self, index):
+
+        return self.stimulators[index]
+
+    def __iter__(self):
+
+        return iter(self.stimulators)
+
+    def _indices(self, indices):
+
+        return range(len(self.stimulators)) if indices is None else indices
+
+    ##############################################################################################################################
+
+    # Work for one device, run on that device's worker
+
+    def submit(self, index, method, *args, **kwargs):
+
+        # Call stimulator.<method>(*args, **kwargs) on the device's own worker thread
+        return self.workers[index].submit(getattr(self.stimulators[index], method), *args, **kwargs)
+
+    def replace(self, index, key, method, *args, **kwargs):
+
+        # As submit, but replaces a queued job with the same key (see PortWorker.replace)
+        return self.workers[index].replace(key, getattr(self.stimulators[index], method), *args, **kwargs)
+
+    def send(self, index, frame, key=None):
+
+        # With a key, a queued frame with the same key is replaced (e.g. "display")
+
+        if key is None:
+            return self.submit(index, "send", frame)
+
+        return self.replace(index, key, "send", frame)
+
+    def send_parameters(self, index, **parameters):
+
+        # Uploads still queued for this device are superseded: only the latest parameters
+        # are compared with the confirmed values and sent
+        return self.replace(index, "parameters", "send_parameters", **parameters)
+
+    ##############################################################################################################################
+
+    # The same work for several devices at once
+
+    def broadcast(self, frame, indices=None, key=None):
+
+        # Send the same frame to all (or the given) devices concurrently
+        return [self.send(i, frame, key) for i in self._indices(indices)]
+
+    def map(self, method, indices=None, *args, **kwargs):
+
+        return [self.submit(i, method, *args, **kwargs) for i in self._indices(indices)]
+
+    @contextmanager
+    def streaming(self, indices=None, timeout=1.0):
+
+        # Turn the displays off for a batch of uploads or a protocol and back on afterwards.
+        # With the display off, update_display() after every command only clears the LCD
+        # instead of redrawing four lines over I2C, so each reply comes back sooner. Displays
+        # that were already off stay off. Yields the indices of the displays turned off; they
+        # are turned on again behind the work still queued for them. Raises RuntimeError (with
+        # the displays turned on again) if a display-off is not confirmed within the timeout.
+
+        indices = [i for i in self._indices(indices) if self.stimulators[i].display]
+
+        if not self.display(False, indices, timeout):
+
+            self.display(True, indices, timeout)
+
+            raise RuntimeError("display off was not confirmed by %s"
+                               % ", ".join(self.stimulators[i].name for i in indices))
+
+        try:
+            yield indices
+
+        finally:
+            self.display(True, indices, timeout)
+
+    def display(self, on, indices=None, timeout=1.0):
+
+        # Switch the displays and wait for the replies; False if one was not confirmed in time
+
+        futures = self.broadcast(encode_display(on), indices, key="display")
+        done, pending = wait(futures, timeout)
+
+        if pending or any(future.cancelled() or future.exception() for future in done):
+            return False
+
+        return wait_all([ticket for future in futures for ticket in future.result()], timeout)
+
+    def start_synchronized(self, indices=None, timeout=1.0):
+
+        # Start all (or the given) devices with the least possible skew. Arming: every worker
+        # finishes its queued work and drains its port, then all write locks are taken so
+        # that nothing else can be written in between. Release: the start byte is written to
+        # each port back to back from this thread, which is faster and more predictable than
+        # waking one thread per port. Skew left after that comes from the USB polling of
+        # each adapter and is not visible to the host. A device still running a train gets
+        # until the timeout to finish it; otherwise the start is refused (RuntimeError), since
+        # its start byte would be read only after that train and would hide a later stop byte.
+
+        indices = sorted(self._indices(indices))
+        stimulators = [self.stimulators[i] for i in indices]
+        stop_count = self.stop_count
+
+        try:
+            self.wait([self.submit(i, "drain") for i in indices], timeout)
+
+        except CancelledError:
+            raise RuntimeError("start cancelled by an emergency stop")
+
+        deadline = time.perf_counter() + timeout
+
+        for stimulator in stimulators:
+            stimulator.idle.wait(max(0.0, deadline - time.perf_counter()))
+
+        frame = command(START_PULSE)
+        prepared = [stimulator.prepare(frame) for stimulator in stimulators]
+
+        for stimulator in stimulators:
+            stimulator.write_lock.acquire()
+
+        try:
+
+            if self.stop_count != stop_count:
+                raise RuntimeError("start cancelled by an emergency stop")
+
+            for stimulator in stimulators:
+                if stimulator.busy:
+                    raise RuntimeError("%s is still running a pulse train" % stimulator.name)
+
+            written = [stimulator.transmit(frame, tickets, codes, notify=False)
+                       for stimulator, (tickets, codes) in zip(stimulators, prepared)]
+
+        finally:
+            for stimulator in stimulators:
+                stimulator.write_lock.release()
+
+        # Observers only after all start bytes are out
+        for stimulator, (tickets, _), t in zip(stimulators, prepared, written):
+            stimulator.notify_sent(frame, tickets, t)
+
+        report = StartReport(names=tuple(stimulator.name for stimulator in stimulators),
+                             written=tuple(written),
+                             skew=max(written) - min(written),
+                             tickets=tuple(tickets[0] for tickets, _ in prepared))
+
+        self.starts.append(report)
+
+        return report
+
+    def emergency_stop(self, indices=None, timeout=1.0):
+
+        # Stop all (or the given) devices as fast as possible; safe to call from any thread.
+        # Queued jobs are cancelled, output the host has not sent yet is discarded, and the
+        # stop byte is written to every port in parallel by the parked stop threads.
+
+        indices = list(self._indices(indices))
+
+        with self.stop_lock:
+
+            self.stop_count += 1
+
+            for i in indices:
+                self.workers[i].cancel()
+
+            requested = time.perf_counter()
+
+            for i in indices:
+                self.stoppers[i].fire()
+
+            for i in indices:
+                self.stoppers[i].done.wait(timeout)
+
+            results = [self.stoppers[i].result if self.stoppers[i].done.is_set() else None
+                       for i in indices]
+
+        for i, result in zip(indices, results):
+
+            if isinstance(result, Exception):
+                raise result
+
+            if result is None:
+                raise TimeoutError("%s: stop byte was not written" % self.stimulators[i].name)
+
+        report = StopReport(names=tuple(self.stimulators[i].name for i in indices),
+                            requested=requested,
+                            written=tuple(written for written, _ in results),
+                            latency=tuple(written - requested for written, _ in results),
+                            trains=tuple(train for _, train in results))
+
+        self.stops.append(report)
+
+        return report
+
+    @staticmethod
+    def wait(futures, timeout=None):
+
+        # Results in order (raises the first error, or TimeoutError if not all finished)
+        done, pending = wait(futures, timeout)
+
+        if pending:
+            raise TimeoutError("%i of %i devices did not finish" % (len(pending), len(futures)))
+
+        return [future.result() for future in futures]
+
+    def close(self):
+
+        futures = self.map("close")
+
+        for worker in self.workers + self.stoppers:
+            worker.stop()
+
+        wait(futures)
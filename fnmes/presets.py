@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Preset store (pre-encoded parameter frames)
+# -----------------------------------------------------------------------------
+# Description:
+# Named presets hold one parameter set per DAC, saved to disk together with
+# the byte frame each set encodes to. The store is memory-mapped when it is
+# opened, so recalling a preset sends its ready-made frames, one write per
+# port, without reading input fields or encoding anything.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .protocol import encode_parameters
+
+##################################################################################################################################
+
+# File layout
+#   Header: magic, version, size of the index
+#   Index (JSON): {name: {"saved": time, "devices": [{"parameters": {...}, "offset": o, "length": n}, ...]}}
+#   Frames: the encoded frames of all presets, back to back (offsets count from the end of the index)
+
+MAGIC = b"FNMESPRE"
+VERSION = 1
+
+HEADER = struct.Struct("<8sII")
+
+##################################################################################################################################
+
+
+class PresetStore:
+
+    def __init__(self, path):
+
+        # Opens (and maps) the store; a missing file is an empty store
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.map = None
+        self.base = 0
+        self.closed = False
+
+        if os.path.exists(path):
+            self._load()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+    def __contains__(self, name):
+
+        return name in self.index
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def _load(self):
+
+        with open(self.path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < HEADER.size or self.map[:len(MAGIC)] != MAGIC:
+            self._unmap()
+            raise ValueError("%s is not an fNMES preset file" % self.path)
+
+        magic, version, size = HEADER.unpack_from(self.map)
+
+        if version != VERSION:
+            self._unmap()
+            raise ValueError("%s is a version %i preset file (this version reads version %i)"
+                             % (self.path, version, VERSION))
+
+        self.base = HEADER.size + size
+        self.index = json.loads(bytes(self.map[HEADER.size:self.base]))
+
+    ##############################################################################################################################
+
+    # Reading
+
+    def names(self):
+
+        return sorted(self.index)
+
+    def parameters(self, name):
+
+        # Parameter set of each DAC (as given to save)
+        return [device["parameters"] for device in self.index[name]["devices"]]
+
+    def _check_open(self):
+
+        if self.closed:
+            raise ValueError("preset store is closed")
+
+    def frames(self, name):
+
+        # Encoded frame of each DAC, straight from the mapped file
+
+        self._check_open()
+
+        return [self.map[self.base + device["offset"]:self.base + device["offset"] + device["length"]]
+                for device in self.index[name]["devices"]]
+
+    def recall(self, pool, name, indices=None):
+
+        # Send the preset's frame to each DAC (one write per port, on the DACs' workers).
+        # An upload still queued for a DAC is replaced. Returns the futures (see pool.send).
+
+        frames = self.frames(name)
+        indices = range(min(len(frames), len(pool))) if indices is None else indices
+
+        return [pool.send(i, frames[i], key="parameters") for i in indices]
+
+    ##############################################################################################################################
+
+    # Writing
+
+    def save(self, name, parameters):
+
+        # parameters: one parameter set (dict for encode_parameters) per DAC. Raises
+        # ValueError for values that cannot be encoded; an existing preset is replaced.
+
+        self._check_open()
+
+        frames = [encode_parameters(**values) for values in parameters]
+
+        with self.lock:
+
+            index = dict(self.index)
+            index[name] = {"saved": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                           "devices": [{"parameters": dict(values)} for values in parameters]}
+
+            self._write(index, {name: frames})
+
+    def delete(self, name):
+
+        self._check_open()
+
+        with self.lock:
+
+            index = dict(self.index)
+            del index[name]
+
+            self._write(index, {})
+
+    def _write(self, index, new_frames):
+
+        # Write the whole store to a temporary file and replace the old one
+
+        blob = bytearray()
+
+        for name, preset in index.items():
+
+            frames = new_frames.get(name) or self.frames(name)
+            devices = []
+
+            for device, frame in zip(preset["devices"], frames):
+                devices.append(dict(device, offset=len(blob), length=len(frame)))
+                blob += frame
+
+            index[name] = dict(preset, devices=devices)
+
+        data = json.dumps(index, sort_keys=True).encode()
+        temporary = self.path + ".tmp"
+
+        with open(temporary, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(data)))
+            file.write(data)
+            file.write(blob)
+
+        self._unmap()  # A mapped file cannot be replaced on Windows
+        os.replace(temporary, self.path)
+        self._load()
+
+    def _unmap(self):
+
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def close(self):
+
+        # Frames can no longer be read (ValueError) once the store is closed
+
+        self.closed = True
+        self._unmap()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Serial command encoding for the Arduino DS5 Controller
+# -----------------------------------------------------------------------------
+# Description:
+# Command bytes and encoders for the serial protocol implemented by
+# DS5_Controller.ino. A whole parameter set for one device is encoded into a
+# single contiguous byte frame so that it can be sent with one write per port.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+##################################################################################################################################
+
+# Serial commands (see DS5_Controller.ino)
+
+START_DEVICE = 0xFF         # Start device (TriggerMode) - can also stop device
+BLINK = 0x63                # Identify device by blinking display
+MODE_BIPOLAR = 0x62         # Set pulse mode to bipolar (OpAmp enabled)
+MODE_MONOPOLAR_EN = 0x61    # Set pulse mode to monopolar (OpAmp enabled)
+MODE_MONOPOLAR_DIS = 0x60   # Set pulse mode to monopolar (OpAmp disabled)
+SET_TRIGGER = 0x5A          # + Byte: Set trigger mode (T0, T1, T2, T3)
+SET_COUNT = 0x59            # + HighByte + LowByte: Set pulse repetition count
+SET_PERIOD_MS = 0x58        # + HighByte + LowByte: Set pulse repetition period (* 0.1ms)
+SET_WIDTH_MS = 0x57         # + HighByte + LowByte: Set pulse width (* 0.1ms)
+SET_VOLTAGE = 0x53          # + HighByte + LowByte: Set output voltage (* 0.5mV)
+START_PULSE = 0x50          # Start pulse sequence (triggers and analog output)
+ZERO_COUNT = 0x4E           # Zero pulse count
+DISPLAY_ON = 0x45           # + 1: Turn on display
+DISPLAY_OFF = 0x44          # + 0: Turn off display
+SET_BAUDRATE = 0x42         # + Index: Set baud rate (firmware v0.95, see link.negotiate_baudrate)
+QUERY = 0x41                # Query data
+SET_PERIOD_US = 0x3A        # + HighByte + LowByte: Set pulse repetition period (* 1us)
+SET_WIDTH_US = 0x39         # + HighByte + LowByte: Set pulse width (* 1us)
+STOP = 0x21                 # Emergency stop pulse sequence
+
+# Serial feedback
+
+READY = 0x65                # Serial port ready (sent once after reset)
+QUERY_HEADER = 1            # First byte of the query data record
+QUERY_RECORD_SIZE = 14      # Header + voltage, width, count, repeat, period, trigger, bipolar, opamp
+END_OF_SEQUENCE = 100       # Pulse sequence finished (or stopped)
+
+# Baud rate change (command 0x42): accepted (at the old rate), confirmed (at the new rate),
+# index not supported. The host confirms with BAUD_CONFIRM at the new rate.
+BAUDRATES = (19200, 38400, 57600, 115200, 250000, 500000, 1000000)  # Index 0...6
+BAUD_ACCEPTED = 115
+BAUD_CONFIRMED = 116
+BAUD_UNSUPPORTED = 117
+BAUD_CONFIRM = 0x55
+
+# Reply byte sent by the firmware after each command (commands without an entry send nothing)
+REPLIES = {
+    MODE_BIPOLAR: 198,
+    MODE_MONOPOLAR_EN: 197,
+    MODE_MONOPOLAR_DIS: 196,
+    SET_TRIGGER: 130,
+    SET_COUNT: 120,
+    SET_PERIOD_MS: 121,
+    SET_WIDTH_MS: 111,
+    SET_VOLTAGE: 110,
+    START_PULSE: END_OF_SEQUENCE,
+    ZERO_COUNT: 112,
+    DISPLAY_ON: 114,
+    DISPLAY_OFF: 113,
+    QUERY: QUERY_HEADER,
+    SET_PERIOD_US: 121,
+    SET_WIDTH_US: 111,
+}
+
+# Number of argument bytes that follow each command byte
+PAYLOAD_SIZES = {
+    SET_TRIGGER: 1,
+    SET_COUNT: 2,
+    SET_PERIOD_MS: 2,
+    SET_WIDTH_MS: 2,
+    SET_VOLTAGE: 2,
+    DISPLAY_ON: 1,
+    DISPLAY_OFF: 1,
+    SET_PERIOD_US: 2,
+    SET_WIDTH_US: 2,
+}
+
+# Commands that set a stored parameter, and commands that set the same parameter
+# in different units (the last one received wins)
+PARAMETER_CODES = (SET_TRIGGER, SET_COUNT, SET_PERIOD_MS, SET_PERIOD_US,
+                   SET_WIDTH_MS, SET_WIDTH_US, SET_VOLTAGE)
+
+PARAMETER_GROUPS = {
+    SET_PERIOD_MS: (SET_PERIOD_MS, SET_PERIOD_US),
+    SET_PERIOD_US: (SET_PERIOD_MS, SET_PERIOD_US),
+    SET_WIDTH_MS: (SET_WIDTH_MS, SET_WIDTH_US),
+    SET_WIDTH_US: (SET_WIDTH_MS, SET_WIDTH_US),
+}
+
+# Parameters accepted by encode_parameters (in the order they are sent)
+PARAMETER_NAMES = ("trigger", "count", "period_ms", "period_us",
+                   "width_ms", "width_us", "voltage_mv")
+
+##################################################################################################################################
+
+# Single command encoders
+
+
+def command(code):
+
+    return bytes((code,))
+
+
+def encode_byte(code, value):
+
+    value = int(value)
+
+    if not 0 <= value <= 0xFF:
+        raise ValueError("value %r out of range for command 0x%02X" % (value, code))
+
+    return bytes((code, value))
+
+
+def encode_word(code, value):
+
+    value = int(value)
+
+    if not 0 <= value <= 0xFFFF:
+        raise ValueError("value %r out of range for command 0x%02X" % (value, code))
+
+    # Command byte followed by high byte and low byte
+    return bytes((code, value >> 8, value & 0xFF))
+
+
+def encode_trigger(trigger):
+
+    return encode_byte(SET_TRIGGER, trigger)  # Available inputs: 0,1,2,3
+
+
+def encode_count(count):
+
+    return encode_word(SET_COUNT, count)
+
+
+def encode_period_ms(period_ms):
+
+    return encode_word(SET_PERIOD_MS, round(period_ms * 10))  # 0.1ms steps
+
+
+def encode_period_us(period_us):
+
+    return encode_word(SET_PERIOD_US, period_us)
+
+
+def encode_width_ms(width_ms):
+
+    return encode_word(SET_WIDTH_MS, round(width_ms * 10))  # 0.1ms steps
+
+
+def encode_width_us(width_us):
+
+    return encode_word(SET_WIDTH_US, width_us)
+
+
+def encode_voltage(voltage_mv):
+
+    return encode_word(SET_VOLTAGE, int(voltage_mv * 2))  # 0.5mV steps
+
+
+def encode_display(on):
+
+    if on:
+        return encode_byte(DISPLAY_ON, 1)
+
+    return encode_byte(DISPLAY_OFF, 0)
+
+
+def encode_baudrate(baudrate):
+
+    if baudrate not in BAUDRATES:
+        raise ValueError("baud rate %r not supported (%s)" % (baudrate, ", ".join(map(str, BAUDRATES))))
+
+    return encode_byte(SET_BAUDRATE, BAUDRATES.index(baudrate))
+
+##################################################################################################################################
+
+# Parameter frames
+
+
+def parameter_commands(trigger=None, count=None, period_ms=0, period_us=0,
+                       width_ms=0, width_us=0, voltage_mv=None):
+
+    # Same order as the GUI: trigger, count, period (ms, us), width (ms, us), voltage.
+    # A trigger, count or voltage of None and periods and widths of 0 are not sent, so the
+    # firmware keeps its current value (a non-zero microsecond value overrides the
+    # millisecond value).
+
+    commands = []
+
+    if trigger is not None:
+        commands.append(encode_trigger(trigger))
+
+    if count is not None:
+        commands.append(encode_count(count))
+
+    if period_ms > 0:
+        commands.append(encode_period_ms(period_ms))
+
+    if period_us > 0:
+        commands.append(encode_period_us(period_us))
+
+    if width_ms > 0:
+        commands.append(encode_width_ms(width_ms))
+
+    if width_us > 0:
+        commands.append(encode_width_us(width_us))
+
+    if voltage_mv is not None:
+        commands.append(encode_voltage(voltage_mv))
+
+    return commands
+
+
+def build_frame(commands):
+
+    return b"".join(commands)
+
+
+def encode_parameters(**parameters):
+
+    # Whole parameter set for one device as one contiguous frame
+    return build_frame(parameter_commands(**parameters))
+
+
+def split_frame(frame):
+
+    # Yield (code, payload) for every command contained in a frame
+
+    frame = bytes(frame)
+    i = 0
+
+    while i < len(frame):
+
+        code = frame[i]
+        size = PAYLOAD_SIZES.get(code, 0)
+
+        if i + 1 + size > len(frame):
+            raise ValueError("truncated command 0x%02X in frame" % code)
+
+        yield code, frame[i + 1:i + 1 + size]
+
+        i += 1 + size
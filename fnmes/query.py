@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Query Data (0x41) decoding and device state polling
+# -----------------------------------------------------------------------------
+# Description:
+# The firmware answers Query Data with a fixed 14-byte record. This module
+# decodes that record and polls all stimulators at a configurable rate so
+# that an in-memory mirror of each device's settings is always available.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import threading
+from collections import namedtuple
+
+from .protocol import QUERY_HEADER, QUERY_RECORD_SIZE
+
+##################################################################################################################################
+
+# Query Data record (case 65 in DS5_Controller.ino):
+#   1, voltage (2 bytes), width (2), count (2), repeat (2), period (2), trigger, bipolar, opamp
+# Width and period are sent in microseconds and only their lowest 16 bits fit into the
+# record, so values above 65535us (65.5 ms) are reported modulo 65536.
+
+_DeviceState = namedtuple("DeviceState", ("voltage", "width", "count", "repeat",
+                                          "period", "trigger", "bipolar", "opamp_enabled"))
+
+
+class DeviceState(_DeviceState):
+
+    __slots__ = ()
+
+    @property
+    def voltage_mv(self):
+
+        return self.voltage / 2  # Voltage is stored in 0.5mV steps
+
+    def __str__(self):
+
+        mode = "bipolar" if self.bipolar else "monopolar"
+
+        return "%.1f mV, %i us, %i x %i us, trigger %i, %s, count %i" % (
+            self.voltage_mv, self.width, self.repeat, self.period,
+            self.trigger, mode, self.count)
+
+
+def decode_query(record):
+
+    record = bytes(record)
+
+    if len(record) != QUERY_RECORD_SIZE or record[0] != QUERY_HEADER:
+        raise ValueError("not a query data record: %r" % record)
+
+    return DeviceState(voltage=record[1] << 8 | record[2],
+                       width=record[3] << 8 | record[4],
+                       count=record[5] << 8 | record[6],
+                       repeat=record[7] << 8 | record[8],
+                       period=record[9] << 8 | record[10],
+                       trigger=record[11],
+                       bipolar=bool(record[12]),
+                       opamp_enabled=bool(record[13]))
+
+##################################################################################################################################
+
+# Periodic polling
+
+
+class StatePoller(threading.Thread):
+
+    # Sends one Query Data byte per device and interval. Devices running a pulse train are
+    # skipped until the train ends (end-of-sequence byte or deadline): a query byte waiting in
+    # the Arduino's receive buffer would also hide a following stop byte from Serial.peek().
+
+    def __init__(self, stimulators, interval=1.0):
+
+        super().__init__(daemon=True)
+
+        self.stimulators = list(stimulators)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+
+        while not self.stopped.wait(self.interval):
+
+            for stimulator in self.stimulators:
+
+                try:
+                    stimulator.request_state()
+
+                except Exception:
+                    pass  # Port closed; keep polling the others
+
+    def stop(self):
+
+        self.stopped.set()
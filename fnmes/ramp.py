@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Amplitude ramps streamed as voltage commands
+# -----------------------------------------------------------------------------
+# Description:
+# A voltage trajectory (e.g. a titration staircase or a ramp-up/ramp-down
+# comfort profile) is checked and encoded into Set Voltage (0x53) frames
+# before it starts. A dedicated thread then streams the frames to one DAC,
+# either on a fixed step interval or as fast as the replies come back, and
+# records the planned and actual write time and the confirmation of every
+# step. The ramp ends before its next write once it is stopped or the pool
+# makes an emergency stop (checked under the port's write lock).
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import math
+import statistics
+import threading
+import time
+from collections import namedtuple
+
+from .protocol import encode_voltage
+from .timing import TimedThread
+
+##################################################################################################################################
+
+# Trajectories
+
+VOLTAGE_MAX_MV = 2047.5     # Highest output voltage of the DAC (4095 x 0.5 mV)
+
+SHAPES = {
+    "linear": lambda x: x,
+    "cosine": lambda x: (1 - math.cos(math.pi * x)) / 2,     # Smooth start and end
+}
+
+
+def ramp_voltages(start_mv, end_mv, steps, shape="linear"):
+
+    # steps + 1 voltages from start_mv to end_mv (both included), rounded to 0.5 mV
+
+    if steps < 1:
+        raise ValueError("a ramp needs at least one step, not %r" % steps)
+
+    if shape not in SHAPES:
+        raise ValueError("unknown ramp shape %r (use %s)" % (shape, ", ".join(SHAPES)))
+
+    curve = SHAPES[shape]
+
+    return [round(2 * (start_mv + (end_mv - start_mv) * curve(i / steps))) / 2 for i in range(steps + 1)]
+
+
+def ramp_frames(voltages, ceiling_mv=VOLTAGE_MAX_MV):
+
+    # One Set Voltage frame per step; raises ValueError (before anything is sent) if a
+    # step is negative or above the ceiling
+
+    for i, voltage in enumerate(voltages):
+        if not 0 <= voltage <= min(ceiling_mv, VOLTAGE_MAX_MV):
+            raise ValueError("step %i: %r mV is outside 0-%r mV" % (i + 1, voltage,
+                                                                    min(ceiling_mv, VOLTAGE_MAX_MV)))
+
+    return [encode_voltage(voltage) for voltage in voltages]
+
+##################################################################################################################################
+
+# Step records
+#   planned / actual: perf_counter() time the step was due / written (as fast as the replies
+#   allow: due when the reply that made room for it arrived)
+#   ticket: resolved by the firmware's reply (reply 110)
+
+RampStep = namedtuple("RampStep", ("index", "voltage_mv", "planned", "actual", "ticket"))
+
+
+def ramp_summary(steps):
+
+    # Step timing error (actual - planned) and reply latency in seconds, steps per second,
+    # and the number of steps that were not confirmed
+
+    errors = [step.actual - step.planned for step in steps]
+
+    if not errors:
+        return {"n": 0}
+
+    latencies = [step.ticket.latency for step in steps if step.ticket.confirmed]
+    elapsed = steps[-1].actual - steps[0].actual
+
+    return {"n": len(errors),
+            "mean": statistics.fmean(errors),
+            "sd": statistics.pstdev(errors),
+            "max": max(errors),
+            "latency": statistics.median(latencies) if latencies else None,
+            "steps_per_s": (len(errors) - 1) / elapsed if elapsed > 0 else None,
+            "unconfirmed": len(errors) - len(latencies)}
+
+##################################################################################################################################
+
+# Ramp
+
+
+class VoltageRamp(TimedThread):
+
+    def __init__(self, pool, dac, voltages, interval=0.0, window=1, start_delay=0.0, spin=0.002,
+                 timeout=1.0, ceiling_mv=VOLTAGE_MAX_MV, on_step=None):
+
+        # interval: time between steps (s); 0 streams as fast as the replies allow. window:
+        # steps that may wait for their reply (1 = every step is confirmed before the next).
+        # A step that is not confirmed within the timeout ends the ramp.
+
+        if not 0 <= dac < len(pool):
+            raise ValueError("ramp for DAC%i, but the pool has %i devices" % (dac + 1, len(pool)))
+
+        super().__init__(pool, spin)
+
+        self.dac = dac
+        self.voltages = list(voltages)
+        self.frames = ramp_frames(self.voltages, ceiling_mv)   # Encoded before the first step
+        self.interval = interval
+        self.window = max(window, 1)
+        self.start_delay = start_delay
+        self.timeout = timeout
+        self.on_step = on_step                  # on_step(step), called from the ramp thread
+        self.steps = []
+        self.aborted = False                    # Stopped (or timed out) before the last step
+        self.wake = threading.Event()           # A reply arrived or the ramp was stopped
+
+    def wait_reply(self, ticket):
+
+        # Wait for the reply to a step (or for stop); returns the time it arrived (None if not)
+
+        deadline = time.perf_counter() + self.timeout
+
+        while not ticket.done and self.running():
+
+            self.wake.clear()
+
+            if ticket.done:
+                break
+
+            remaining = deadline - time.perf_counter()
+
+            if remaining <= 0:
+                return None
+
+            self.wake.wait(remaining)
+
+        return ticket.received if ticket.confirmed and self.running() else None
+
+    def run(self):
+
+        stimulator = self.pool[self.dac]
+        self.stop_count = self.pool.stop_count
+
+        planned = time.perf_counter() + self.start_delay
+
+        for index, (voltage, frame) in enumerate(zip(self.voltages, self.frames)):
+
+            if index >= self.window:
+
+                received = self.wait_reply(self.steps[index - self.window].ticket)
+
+                if received is None:
+                    break
+
+                if not self.interval:
+                    planned = max(planned, received)
+
+            tickets, codes = stimulator.prepare(frame)
+
+            if not self.wait_until(planned):
+                break
+
+            # Written once the DAC is idle, unless the ramp was stopped first
+            actual = self.release(stimulator, frame, tickets, codes)
+
+            if actual is None:
+                break
+
+            ticket = tickets[0]
+            ticket.add_done_callback(lambda _: self.wake.set())
+
+            step = RampStep(index=index, voltage_mv=voltage, planned=planned, actual=actual, ticket=ticket)
+
+            self.steps.append(step)
+
+            if self.on_step is not None:
+                self.on_step(step)
+
+            planned += self.interval
+
+        for step in self.steps[-self.window:]:  # Replies to the last steps
+            self.wait_reply(step.ticket)
+
+        self.aborted = len(self.steps) < len(self.frames) or not self.running()
+
+    def stop(self):
+
+        # End the ramp before its next write (the voltage stays at the last step sent)
+
+        super().stop()
+        self.wake.set()
+
+    def summary(self):
+
+        return ramp_summary(self.steps)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Acknowledgement parsing for the Arduino DS5 Controller
+# -----------------------------------------------------------------------------
+# Description:
+# DS5_Controller.ino answers most commands with a status byte and the query
+# command with a 14-byte record. The parser below turns the incoming byte
+# stream into replies, a background thread per port feeds it, and replies are
+# matched to the commands that were sent to measure round-trip latency.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import threading
+import time
+from array import array
+from collections import deque
+
+from .protocol import QUERY_HEADER, QUERY_RECORD_SIZE, REPLIES
+
+##################################################################################################################################
+
+# Incremental parser for the reply byte stream
+
+
+class ReplyParser:
+
+    # Status bytes are reported one by one. A query header byte (1, never used as a
+    # status byte) starts a 14-byte record that is collected in a preallocated buffer,
+    # so a record split across several reads is reassembled.
+
+    def __init__(self, on_reply, on_record):
+
+        self.on_reply = on_reply
+        self.on_record = on_record
+
+        self.record = bytearray(QUERY_RECORD_SIZE)
+        self.fill = 0
+
+    def feed(self, data, t):
+
+        for byte in data:
+
+            if self.fill:
+
+                self.record[self.fill] = byte
+                self.fill += 1
+
+                if self.fill == QUERY_RECORD_SIZE:
+                    self.fill = 0
+                    self.on_record(bytes(self.record), t)
+
+            elif byte == QUERY_HEADER:
+
+                self.record[0] = byte
+                self.fill = 1
+
+            else:
+
+                self.on_reply(byte, t)
+
+##################################################################################################################################
+
+# Commands waiting for their reply
+
+_callback_lock = threading.Lock()
+
+
+class Ticket:
+
+    __slots__ = ("code", "payload", "expected", "sent", "written", "received", "reply", "record",
+                 "_event", "_callbacks")
+
+    def __init__(self, code, payload=b""):
+
+        self.code = code
+        self.payload = payload
+        self.expected = REPLIES[code]
+        self.sent = None
+        self.written = None   # perf_counter() time the write call returned
+        self.received = None
+        self.reply = None     # Reply byte, or None if the command was not confirmed
+        self.record = None    # Query data record (query command only)
+        self._event = threading.Event()
+        self._callbacks = []
+
+    @property
+    def done(self):
+
+        return self._event.is_set()
+
+    @property
+    def confirmed(self):
+
+        return self.reply is not None
+
+    @property
+    def latency(self):
+
+        # Round trip from write to reply in seconds
+        if self.received is None:
+            return None
+
+        return self.received - self.sent
+
+    def wait(self, timeout=None):
+
+        self._event.wait(timeout)
+
+        return self.confirmed
+
+    def add_done_callback(self, callback):
+
+        # callback(ticket) is called from the reader thread once the ticket is resolved
+        # (or right away if it already is)
+        with _callback_lock:
+
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def resolve(self, reply, t):
+
+        with _callback_lock:
+
+            self.reply = reply
+            self.received = t
+            self._event.set()
+
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback(self)
+
+
+class PendingCommands:
+
+    # The firmware handles commands in order, so replies are matched against the oldest
+    # pending command expecting them. Older commands without a reply (e.g. an argument
+    # lost to the 100 ms readBytes timeout) are resolved as not confirmed.
+
+    def __init__(self):
+
+        self.queue = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self.queue)
+
+    def add(self, ticket):
+
+        with self.lock:
+            self.queue.append(ticket)
+
+    def match(self, reply, t, record=None):
+
+        with self.lock:
+
+            for i, ticket in enumerate(self.queue):
+
+                if ticket.expected == reply:
+                    break
+
+            else:
+                return None  # Unsolicited byte (e.g. ready byte after a reset)
+
+            lost = [self.queue.popleft() for _ in range(i)]
+
+            self.queue.popleft()
+
+        for skipped in lost:
+            skipped.resolve(None, t)
+
+        ticket.record = record
+        ticket.resolve(reply, t)
+
+        return ticket
+
+    def discard(self, ticket):
+
+        # Stop waiting for the ticket's reply; False if it is no longer pending
+
+        with self.lock:
+
+            if ticket not in self.queue:
+                return False
+
+            self.queue.remove(ticket)
+
+        return True
+
+    def clear(self):
+
+        with self.lock:
+            lost = list(self.queue)
+            self.queue.clear()
+
+        for ticket in lost:
+            ticket.resolve(None, None)
+
+
+def wait_all(tickets, timeout=None):
+
+    # True if every ticket was confirmed within the timeout
+    deadline = None if timeout is None else time.perf_counter() + timeout
+
+    for ticket in tickets:
+
+        remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+
+        if not ticket.wait(remaining):
+            return False
+
+    return True
+
+##################################################################################################################################
+
+# Round-trip latency history (fixed size, preallocated)
+
+
+class LatencyLog:
+
+    def __init__(self, size=1024):
+
+        self.size = size
+        self.codes = array("B", bytes(size))
+        self.latencies = array("d", bytes(8 * size))
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, code, latency):
+
+        with self.lock:
+            i = self.count % self.size
+            self.codes[i] = code
+            self.latencies[i] = latency
+            self.count += 1
+
+    def samples(self, code=None):
+
+        with self.lock:
+            n = min(self.count, self.size)
+            pairs = list(zip(self.codes[:n], self.latencies[:n]))
+
+        return [latency for c, latency in pairs if code is None or c == code]
+
+    def summary(self):
+
+        # Per command code: number of samples, mean, median and maximum latency (s)
+        with self.lock:
+            n = min(self.count, self.size)
+            codes = set(self.codes[:n])
+
+        result = {}
+
+        for code in sorted(codes):
+
+            samples = sorted(self.samples(code))
+
+            result[code] = dict(n=len(samples),
+                                mean=sum(samples) / len(samples),
+                                median=samples[len(samples) // 2],
+                                max=samples[-1])
+
+        return result
+
+##################################################################################################################################
+
+# Background reader (one per port)
+
+
+class ReplyReader(threading.Thread):
+
+    def __init__(self, ser, parser, poll=0.05, on_data=None, on_poll=None):
+
+        super().__init__(daemon=True)
+
+        self.ser = ser
+        self.parser = parser
+        self.poll = poll
+        self.on_data = on_data      # on_data(data, t) for every chunk read, after parsing
+        self.on_poll = on_poll      # on_poll() after every read, at least once per poll interval
+        self.stopped = threading.Event()
+
+    def run(self):
+
+        # Blocking reads with a short timeout, so the thread sleeps while the line is idle
+        self.ser.timeout = self.poll
+
+        while not self.stopped.is_set():
+
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+
+            except Exception:
+                break  # Port closed or unplugged
+
+            if data:
+
+                t = time.perf_counter()
+
+                self.parser.feed(data, t)
+
+                if self.on_data is not None:
+                    self.on_data(data, t)
+
+            if self.on_poll is not None:
+                self.on_poll()
+
+    def stop(self):
+
+        self.stopped.set()
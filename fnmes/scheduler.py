@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Timed protocol scheduler
+# -----------------------------------------------------------------------------
+# Description:
+# Runs a list of trials (target DAC, parameters, inter-trial interval) on a
+# dedicated timing thread. Parameters for the next trial are uploaded during
+# the previous inter-trial interval, and each start byte is released with a
+# hybrid sleep/spin wait on the monotonic performance counter. Planned and
+# actual start times are recorded for every trial.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import csv
+import statistics
+import time
+from collections import namedtuple
+
+from .protocol import PARAMETER_NAMES, START_PULSE, command
+from .replies import wait_all
+from .timing import TimedThread
+
+##################################################################################################################################
+
+# Trial lists
+#   dac: index of the device in the pool (0 = DAC1)
+#   parameters: keyword arguments for send_parameters (see parameter_commands)
+#   iti: start-to-start interval to the next trial in seconds
+
+Trial = namedtuple("Trial", ("dac", "parameters", "iti"))
+
+# Parameters that are read as floats from a trial list (all others are integers)
+FLOAT_PARAMETERS = ("period_ms", "width_ms", "voltage_mv")
+
+
+def load_trials(path):
+
+    # Read a CSV trial list with a header row: dac (1 = DAC1), iti_ms and any of the
+    # parameter names (trigger, count, period_ms, period_us, width_ms, width_us, voltage_mv).
+    # Empty cells are left out: nothing is sent for them, so the device keeps the value of
+    # its previous trial (or its power-on default).
+
+    trials = []
+
+    with open(path, newline="") as file:
+
+        for line, row in enumerate(csv.DictReader(file), 2):
+
+            try:
+                parameters = {}
+
+                for name in PARAMETER_NAMES:
+
+                    value = (row.get(name) or "").strip()
+
+                    if value:
+                        parameters[name] = float(value) if name in FLOAT_PARAMETERS else int(value)
+
+                trials.append(Trial(dac=int(row["dac"]) - 1, parameters=parameters,
+                                    iti=float(row["iti_ms"]) / 1000))
+
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValueError("%s, line %i: %s" % (path, line, error))
+
+    return trials
+
+##################################################################################################################################
+
+# Timing records
+#   planned / actual: perf_counter() time the start byte was due / written
+#   uploaded: True if the trial's parameters were confirmed before its start time
+
+TrialRecord = namedtuple("TrialRecord", ("index", "dac", "planned", "actual", "uploaded", "ticket"))
+
+
+def timing_summary(records):
+
+    # Start time error (actual - planned) in seconds: n, mean, sd, max and number of
+    # trials whose parameters were not confirmed in time
+
+    errors = [record.actual - record.planned for record in records]
+
+    if not errors:
+        return {"n": 0}
+
+    return {"n": len(errors),
+            "mean": statistics.fmean(errors),
+            "sd": statistics.pstdev(errors),
+            "max": max(errors),
+            "late_uploads": sum(not record.uploaded for record in records)}
+
+##################################################################################################################################
+
+# Scheduler
+
+
+class ProtocolScheduler(TimedThread):
+
+    def __init__(self, pool, trials, start_delay=0.5, spin=0.002, upload_timeout=1.0,
+                 on_trial=None):
+
+        super().__init__(pool, spin)
+
+        self.trials = list(trials)
+        self.start_delay = start_delay          # Time for the first upload (s)
+        self.upload_timeout = upload_timeout
+        self.on_trial = on_trial                # on_trial(record), called from the timing thread
+        self.records = []
+        self.aborted = False                    # Ended by an emergency stop of the pool
+
+        for trial in self.trials:
+            if not 0 <= trial.dac < len(pool):
+                raise ValueError("trial for DAC%i, but the pool has %i devices"
+                                 % (trial.dac + 1, len(pool)))
+
+    def upload(self, trial, deadline):
+
+        # Runs on the device's worker: wait until the previous train on this device has
+        # ended (parameter bytes would otherwise be read only after it, and would hide a
+        # stop byte), then send the changed parameters and wait for their confirmation
+
+        stimulator = self.pool[trial.dac]
+
+        stimulator.idle.wait(max(0.0, deadline - time.perf_counter()))
+
+        return wait_all(stimulator.send_parameters(**trial.parameters), self.upload_timeout)
+
+    def preupload(self, index, deadline):
+
+        trial = self.trials[index]
+
+        return self.pool.workers[trial.dac].submit(self.upload, trial, deadline)
+
+    def run(self):
+
+        if not self.trials:
+            return
+
+        self.stop_count = self.pool.stop_count
+
+        frame = command(START_PULSE)
+        planned = time.perf_counter() + self.start_delay
+        upload = self.preupload(0, planned)
+
+        for index, trial in enumerate(self.trials):
+
+            stimulator = self.pool[trial.dac]
+            tickets, codes = stimulator.prepare(frame)  # Nothing but the write is left after the wait
+
+            if not self.wait_until(planned):
+                break
+
+            if upload.done():
+                uploaded = not upload.cancelled() and upload.exception() is None and upload.result()
+
+            else:
+                uploaded = False  # Late: start as soon as the upload is done (the delay is recorded)
+
+                try:
+                    upload.result(self.upload_timeout)
+
+                except Exception:
+                    pass
+
+            if upload.cancelled():
+                break   # Emergency stop: the worker's queue was cleared
+
+            # Written once the device is idle (a trial whose DAC still runs starts late either way)
+            actual = self.release(stimulator, frame, tickets, codes)
+
+            if actual is None:
+                break
+
+            record = TrialRecord(index=index, dac=trial.dac, planned=planned,
+                                 actual=actual, uploaded=uploaded, ticket=tickets[0])
+
+            self.records.append(record)
+
+            if self.on_trial is not None:
+                self.on_trial(record)
+
+            # Pre-upload the next trial during this inter-trial interval
+            planned += trial.iti
+
+            if index + 1 < len(self.trials):
+                upload = self.preupload(index + 1, planned)
+
+        self.aborted = self.pool.stop_count != self.stop_count
+
+    def summary(self):
+
+        return timing_summary(self.records)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Binary session log (memory-mapped ring file)
+# -----------------------------------------------------------------------------
+# Description:
+# Records every command written to and every byte read from the stimulators
+# with a monotonic nanosecond timestamp and a device id. Records have a fixed
+# size and are written into a memory-mapped ring file, so logging costs a
+# single struct copy and the log survives a crash of the experiment script.
+# load_session() reads a whole session into a NumPy structured array.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import json
+import mmap
+import struct
+import threading
+import time
+
+##################################################################################################################################
+
+# File layout
+#   Header (4096 bytes): magic, version, record size, capacity, records written,
+#   perf_counter_ns() and time_ns() at creation, then the device names as JSON
+#   Records (32 bytes each): t_ns (perf_counter_ns), device, direction, length, data
+
+MAGIC = b"FNMESLOG"
+VERSION = 1
+
+HEADER = struct.Struct("<8sIIQQQQ")
+HEADER_SIZE = 4096
+WRITTEN_OFFSET = 24         # Offset of the records written counter in the header
+
+RECORD = struct.Struct("<QHBB20s")
+RECORD_SIZE = RECORD.size   # 32
+DATA_SIZE = 20              # Longer writes are split into several records
+
+SENT = 0
+RECEIVED = 1
+
+CAPACITY = 1 << 20          # Records (32 MiB)
+
+##################################################################################################################################
+
+# Writer
+
+
+class SessionLog:
+
+    def __init__(self, path, capacity=CAPACITY):
+
+        self.path = path
+        self.capacity = capacity
+        self.devices = []
+        self.ids = {}               # Stimulator -> device id
+        self.written = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+        with open(path, "wb") as file:
+            file.truncate(HEADER_SIZE + capacity * RECORD_SIZE)
+
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD_SIZE, capacity, 0,
+                         time.perf_counter_ns(), time.time_ns())
+
+        self._write_devices()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+    def _write_devices(self):
+
+        names = json.dumps(self.devices).encode()
+
+        if HEADER.size + len(names) + 1 > HEADER_SIZE:
+            raise ValueError("too many devices for the log header")
+
+        self.map[HEADER.size:HEADER.size + len(names) + 1] = names + b"\0"
+
+    def attach(self, stimulator):
+
+        # Log everything sent to and received from this stimulator (device id = order attached)
+
+        with self.lock:
+            self.ids[stimulator] = len(self.devices)
+            self.devices.append(stimulator.name)
+            self._write_devices()
+
+        stimulator.observers.append(self)
+
+    def detach(self, stimulator):
+
+        if self in stimulator.observers:
+            stimulator.observers.remove(self)
+
+    def log(self, device, direction, data, t):
+
+        # t in perf_counter() seconds
+
+        t_ns = round(t * 1e9)
+
+        with self.lock:
+
+            if self.closed:
+                return
+
+            for i in range(0, len(data), DATA_SIZE):
+
+                chunk = data[i:i + DATA_SIZE]
+                offset = HEADER_SIZE + (self.written % self.capacity) * RECORD_SIZE
+
+                RECORD.pack_into(self.map, offset, t_ns, device, direction, len(chunk), chunk)
+                self.written += 1
+
+            # Counter last, so a crash can at most lose the record being written
+            struct.pack_into("<Q", self.map, WRITTEN_OFFSET, self.written)
+
+    # Observer interface (see Stimulator)
+
+    def sent(self, stimulator, frame, tickets, t):
+
+        self.log(self.ids[stimulator], SENT, frame, t)
+
+    def received(self, stimulator, data, t):
+
+        self.log(self.ids[stimulator], RECEIVED, data, t)
+
+    def flush(self):
+
+        # Write the mapped pages to disk (they survive a crash of the process without it)
+        with self.lock:
+            if not self.closed:
+                self.map.flush()
+
+    def close(self):
+
+        with self.lock:
+
+            if self.closed:
+                return
+
+            self.closed = True
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+
+##################################################################################################################################
+
+# Reader
+
+
+def read_header(path):
+
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+
+    magic, version, record_size, capacity, written, start_ns, wall_ns = HEADER.unpack_from(header)
+
+    if magic != MAGIC or record_size != RECORD_SIZE:
+        raise ValueError("%s is not an fNMES session log" % path)
+
+    names = header[HEADER.size:].split(b"\0", 1)[0]
+
+    return {"version": version, "capacity": capacity, "written": written,
+            "start_ns": start_ns, "wall_ns": wall_ns, "devices": json.loads(names or b"[]")}
+
+
+def load_session(path):
+
+    # All records still in the ring, oldest first, as a NumPy structured array with the
+    # fields t_ns, device, direction (0 = sent, 1 = received), length and data
+
+    import numpy as np
+
+    header = read_header(path)
+
+    dtype = np.dtype([("t_ns", "<u8"), ("device", "<u2"), ("direction", "u1"),
+                      ("length", "u1"), ("data", "u1", DATA_SIZE)])
+
+    count = min(header["written"], header["capacity"])
+    records = np.fromfile(path, dtype=dtype, count=header["capacity"], offset=HEADER_SIZE)
+
+    if header["written"] > header["capacity"]:
+        start = header["written"] % header["capacity"]
+        return np.concatenate((records[start:], records[:start]))
+
+    return records[:count]
+
+
+def session_bytes(records, device, direction):
+
+    # Concatenated bytes of one device and direction (e.g. everything DAC1 was sent)
+
+    import numpy as np
+
+    selected = records[(records["device"] == device) & (records["direction"] == direction)]
+    used = np.arange(DATA_SIZE) < selected["length"][:, None]
+
+    return selected["data"][used].tobytes()
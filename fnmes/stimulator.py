@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: One DS5 Controller on one serial port
+# -----------------------------------------------------------------------------
+# Description:
+# Wraps an open serial port with a background reply reader. Every frame sent
+# returns one ticket per command that expects a reply; a ticket is resolved
+# when the firmware confirms the command and records the round-trip latency.
+# Query Data records keep an in-memory mirror of the device settings, and a
+# shadow of the last confirmed parameter values lets send_parameters() transmit
+# only the parameters that changed. Observers (e.g. a session log) are told
+# about every write and every chunk of bytes read. Frames sent while a pulse
+# train runs are held until its end-of-sequence byte (or its predicted end),
+# so they are not applied late and never sit in front of a stop byte. With a
+# CreditWindow (see flow.py), frames are written as the receive buffer has room.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from .flow import TRAIN_TIMEOUT
+from .protocol import (DISPLAY_OFF, DISPLAY_ON, PARAMETER_CODES, PARAMETER_GROUPS, QUERY,
+                       QUERY_HEADER, READY, REPLIES, SET_COUNT, SET_PERIOD_MS, SET_PERIOD_US,
+                       SET_WIDTH_MS, SET_WIDTH_US, START_DEVICE, START_PULSE, STOP, build_frame,
+                       command, parameter_commands, split_frame)
+from .query import decode_query
+from .replies import LatencyLog, PendingCommands, ReplyParser, ReplyReader, Ticket
+
+##################################################################################################################################
+
+# A train counts as ended if its end-of-sequence byte has not arrived by the predicted end
+# plus this margin (Arduino clock tolerance, reply latency). A train of unknown length (e.g.
+# started after a stop cleared the confirmed settings) is given TRAIN_TIMEOUT.
+
+DEADLINE_SLACK = 0.02
+DEADLINE_MARGIN = 0.1
+
+
+def train_duration(payloads):
+
+    # Train length (s) from the payloads of the count, period and width commands
+    # ({code: payload}, as the firmware applies them); None if one is missing
+
+    def value(code):
+
+        payload = payloads.get(code)
+
+        return None if payload is None else payload[0] << 8 | payload[1]
+
+    repeat = value(SET_COUNT)
+    times = []
+
+    for us, ms in ((SET_PERIOD_US, SET_PERIOD_MS), (SET_WIDTH_US, SET_WIDTH_MS)):
+
+        if value(us) is not None:
+            times.append(min(max(value(us), 10), 9999))
+        elif value(ms) is not None:
+            times.append(min(max(100 * value(ms), 100), 9999900))
+        else:
+            return None
+
+    if repeat is None:
+        return None
+
+    period, width = times
+    repeat = max((repeat + 0x8000) % 0x10000 - 0x8000, 1)   # Arduino int, at least one pulse
+
+    return ((repeat - 1) * max(period, width) + width) / 1e6
+
+##################################################################################################################################
+
+
+class Stimulator:
+
+    def __init__(self, ser, name=None, history=1024, flow=None, gate=True):
+
+        self.ser = ser
+        self.name = name or getattr(ser, "port", None)
+        self.flow = flow          # CreditWindow, or None to write every frame right away
+        self.send_lock = threading.Lock()  # Keeps the commands of a frame together under flow control
+        self.gate = gate          # Hold frames sent during a train until it has ended
+
+        self.pending = PendingCommands()
+        self.latencies = LatencyLog(history)
+        self.write_lock = threading.Lock()
+
+        self.state = None         # Last decoded Query Data record (DeviceState)
+        self.state_time = None    # perf_counter() time the record arrived
+        self.idle = threading.Event()
+        self.idle.set()           # Cleared from a start command until the train ends (see _check_deadline)
+        self.deadline = None      # (start ticket, perf_counter() time the train should have ended by)
+        self.held = deque()       # (frame, tickets, codes) held back during a train
+        self.holds = 0            # Frames held so far
+        self.overruns = 0         # Trains given up on at their deadline (end-of-sequence byte missing)
+        self.stops = 0            # Emergency stops so far (paced writes end at a stop)
+
+        self.shadow = {}          # Last confirmed payload per parameter command code
+        self.shadow_lock = threading.Lock()
+        self.display = True       # LCD on (as after a reset) or off, from the last confirmed display command
+
+        self.observers = []       # observer.sent(stimulator, frame, tickets, t), observer.received(stimulator, data, t)
+
+        self._train = None
+        self._train_frame = None
+        self._previous = None     # (ticket, frame) of the train still running when this one was sent
+        self._query = None
+
+        self.parser = ReplyParser(self._reply, self._record)
+        self.reader = ReplyReader(ser, self.parser, on_data=self._received, on_poll=self._check_deadline)
+        self.reader.start()
+
+    def __repr__(self):
+
+        return "Stimulator(%r)" % self.name
+
+    @property
+    def busy(self):
+
+        return not self.idle.is_set()
+
+    def send(self, frame, only_idle=False):
+
+        # Write a frame (one or more commands) with a single write and return the
+        # tickets of the commands that expect a reply. With only_idle, nothing is
+        # sent while a pulse train is running and None is returned. Otherwise a frame
+        # sent during a train is held (see hold) and the tickets are returned right away.
+
+        tickets, codes = self.prepare(frame)
+
+        with self.write_lock:
+
+            if only_idle and self.busy:
+                return None
+
+            if self.hold(frame, tickets, codes):
+                return tickets
+
+            if self.flow is None:
+                self.transmit(frame, tickets, codes)
+                return tickets
+
+        self.send_paced(frame, tickets, codes)
+
+        return tickets
+
+    def send_paced(self, frame, tickets, codes):
+
+        # Write the frame in as few writes as the credit window allows, waiting for replies
+        # (never for the write lock, so an emergency stop is not held up)
+
+        commands = list(split_frame(frame))
+        waiting = iter(tickets)
+        tickets = [next(waiting) if code in REPLIES else None for code, _ in commands]
+
+        with self.send_lock:
+
+            sent = 0
+            stops = self.stops
+
+            while sent < len(commands):
+
+                taken = self.flow.acquire([(code, 1 + len(payload), ticket) for (code, payload), ticket
+                                           in zip(commands[sent:], tickets[sent:])])
+
+                with self.write_lock:
+
+                    if self.stops != stops:
+                        break   # The rest of the frame was meant for before the stop
+
+                    self.transmit(build_frame(bytes((code,)) + payload
+                                              for code, payload in commands[sent:sent + taken]),
+                                  [ticket for ticket in tickets[sent:sent + taken] if ticket], codes,
+                                  paced=True)
+
+                sent += taken
+
+            else:
+                return
+
+        # Stopped: the commands not written are not confirmed (which also gives back their credits)
+
+        for ticket in tickets[sent:]:
+            if ticket is not None:
+                ticket.resolve(None, None)
+
+    def hold(self, frame, tickets, codes):
+
+        # Keep a frame back while a train runs (or frames are already held), so that it is not
+        # applied late and a stop byte always reaches the front of the receive buffer; the
+        # caller holds write_lock. Stop and restart commands are never held. True if held.
+
+        if not self.gate or STOP in codes or START_DEVICE in codes:
+            return False
+
+        if not self.busy and not self.held:
+            return False
+
+        self.held.append((frame, tickets, codes))
+        self.holds += 1
+
+        return True
+
+    def release(self):
+
+        # Write the held frames in order until one of them starts a train
+
+        while True:
+
+            with self.write_lock:
+
+                if not self.held or self.busy:
+                    return
+
+                frame, tickets, codes = self.held.popleft()
+
+                if self.flow is None:
+                    self.transmit(frame, tickets, codes)
+                    continue
+
+            self.send_paced(frame, tickets, codes)
+
+    def withdraw(self, tickets):
+
+        # Take back a held frame (the one sent with these tickets) before it is written; its
+        # tickets are resolved as not confirmed. False if the frame is no longer held.
+
+        with self.write_lock:
+
+            for entry in self.held:
+                if entry[1] is tickets:
+                    self.held.remove(entry)
+                    break
+
+            else:
+                return False
+
+        for ticket in tickets:
+            ticket.resolve(None, None)
+
+        return True
+
+    def prepare(self, frame):
+
+        # Tickets for the commands of a frame that expect a reply, and the frame's command codes
+
+        commands = list(split_frame(frame))
+        codes = frozenset(code for code, _ in commands)
+
+        return [Ticket(code, payload) for code, payload in commands if code in REPLIES], codes
+
+    def transmit(self, frame, tickets, codes, notify=True, paced=False):
+
+        # Register the tickets and write the frame; the caller holds write_lock.
+        # Returns the perf_counter() time the write call returned. With notify=False
+        # the caller calls notify_sent() later (e.g. after a synchronized start).
+        # A frame that did not wait for credits (paced=False) still takes them, and one
+        # that was not sent through hold() (e.g. a synchronized start) is written behind
+        # the held frames, so that the device gets them in order.
+
+        if START_DEVICE in codes:
+            self.invalidate()  # Device restarted (or stopped)
+
+        held = ()
+        frames = ((frame, tickets, codes),)
+        data = frame
+
+        if self.held and not paced:
+            held, self.held = self.held, deque()
+            frames = tuple(held) + frames
+            data = b"".join(part for part, _, _ in frames)
+
+        if self.flow is not None and not paced:
+            for part, part_tickets, _ in frames:
+                waiting = iter(part_tickets)
+                self.flow.register([(code, 1 + len(payload), next(waiting) if code in REPLIES else None)
+                                    for code, payload in split_frame(part)])
+
+        t = time.perf_counter()
+
+        for _, part_tickets, part_codes in frames:
+
+            for ticket in part_tickets:
+
+                ticket.sent = t
+                self.pending.add(ticket)
+
+                if ticket.code == START_PULSE:
+                    self._previous = (self._train, self._train_frame) if self.busy else None
+                    self._train = ticket
+                    self._train_frame = data
+                    self.idle.clear()
+                    ticket.add_done_callback(self._train_done)
+
+                elif ticket.code in PARAMETER_CODES:
+                    ticket.add_done_callback(partial(self._confirmed, part_codes))
+
+                elif ticket.code in (DISPLAY_ON, DISPLAY_OFF):
+                    ticket.add_done_callback(self._display_confirmed)
+
+        self.ser.write(data)
+
+        written = time.perf_counter()
+
+        for _, part_tickets, _ in frames:
+            for ticket in part_tickets:
+                ticket.written = written
+
+        for part, part_tickets, _ in held:
+            self.notify_sent(part, part_tickets, written)
+
+        if notify:
+            self.notify_sent(frame, tickets, written)
+
+        return written
+
+    def notify_sent(self, frame, tickets, t):
+
+        for observer in self.observers:
+            observer.sent(self, frame, tickets, t)
+
+    def emergency_stop(self):
+
+        # Discard output the host has not sent yet and write the stop byte. The firmware only
+        # checks Serial.peek() == 33 between pulses, so no other byte may be queued ahead of it.
+        # Returns the perf_counter() time the write returned and the ticket of the interrupted
+        # train (None if idle), which is resolved by the end-of-sequence byte.
+
+        # Held frames are dropped (their tickets are resolved as not confirmed).
+
+        train = self._train if self.busy else None
+
+        with self.write_lock:
+
+            self.ser.reset_output_buffer()
+            self.invalidate()  # Discarded parameter bytes may or may not have reached the device
+            self.ser.write(command(STOP))
+
+            written = time.perf_counter()
+            self.stops += 1
+
+            held, self.held = self.held, deque()
+
+        self.notify_sent(command(STOP), [], written)
+
+        for _, tickets, _ in held:
+            for ticket in tickets:
+                ticket.resolve(None, None)
+
+        return written, train
+
+    def drain(self):
+
+        # Block until everything written so far has left the host's output buffer
+        self.ser.flush()
+
+    def send_parameters(self, force=False, **parameters):
+
+        # Encode a parameter set (see parameter_commands) and send only the commands whose
+        # value differs from the last confirmed one. Returns the tickets of the commands sent.
+
+        commands = list(split_frame(build_frame(parameter_commands(**parameters))))
+
+        if not force:
+            commands = self.changed(commands)
+
+        if not commands:
+            return []
+
+        return self.send(build_frame(bytes((code,)) + payload for code, payload in commands))
+
+    def changed(self, commands):
+
+        # Keep the (code, payload) commands that would change the device. Period and width
+        # can each be set in ms or us; such a group is unchanged only if the device's value
+        # was last set by exactly the same commands.
+
+        codes = set(code for code, _ in commands)
+
+        with self.shadow_lock:
+
+            stale = set()
+
+            for code, payload in commands:
+
+                if self.shadow.get(code) != payload:
+                    stale.add(code)
+
+                for sibling in PARAMETER_GROUPS.get(code, ()):
+                    if sibling not in codes and sibling in self.shadow:
+                        stale.add(code)
+
+        for code in list(stale):
+            stale.update(c for c in PARAMETER_GROUPS.get(code, ()) if c in codes)
+
+        return [(code, payload) for code, payload in commands if code in stale]
+
+    def train_duration(self, frame=b""):
+
+        # Expected length (s) of a train started by the frame: the confirmed settings, updated
+        # by the parameter commands in the frame itself. None if one of them is not known.
+
+        with self.shadow_lock:
+            payloads = dict(self.shadow)
+
+        for code, payload in split_frame(frame):
+
+            if code in PARAMETER_CODES:
+
+                for sibling in PARAMETER_GROUPS.get(code, ()):
+                    payloads.pop(sibling, None)
+
+                payloads[code] = payload
+
+        return train_duration(payloads)
+
+    def invalidate(self):
+
+        # Forget all confirmed values (reconnect, restart or reset of the device)
+        with self.shadow_lock:
+            self.shadow.clear()
+
+    def request_state(self):
+
+        # Send Query Data unless a train is running or a query is still outstanding
+
+        if self._query is not None and not self._query.done:
+            return None
+
+        tickets = self.send(command(QUERY), only_idle=True)
+
+        if tickets:
+            self._query = tickets[0]
+            return self._query
+
+        return None
+
+    def query(self, timeout=0.5):
+
+        # Refresh the device state mirror and return it (the old mirror if the
+        # device is busy or does not answer in time)
+
+        ticket = self.request_state()
+
+        if ticket is not None:
+            ticket.wait(timeout)
+
+        return self.state
+
+    def close(self):
+
+        self.reader.stop()
+        self.ser.close()
+        self.pending.clear()
+        self.invalidate()
+
+    ##############################################################################################################################
+
+    # Called from the reader thread
+
+    def _reply(self, reply, t, record=None):
+
+        ticket = self.pending.match(reply, t, record)
+
+        if ticket is not None:
+            self.latencies.add(ticket.code, ticket.latency)
+
+        elif reply == READY:
+
+            self.invalidate()  # Arduino was reset and is back to its defaults
+            self.display = True
+
+            if self.flow is not None:
+                self.flow.reset()
+
+        return ticket
+
+    def _received(self, data, t):
+
+        for observer in self.observers:
+            observer.received(self, data, t)
+
+    def _record(self, record, t):
+
+        self.state = decode_query(record)
+        self.state_time = t
+
+        return self._reply(QUERY_HEADER, t, record)
+
+    def _confirmed(self, codes, ticket):
+
+        if not ticket.confirmed:
+            return
+
+        with self.shadow_lock:
+
+            self.shadow[ticket.code] = ticket.payload
+
+            # A value set in other units by an earlier frame is no longer in effect
+            for sibling in PARAMETER_GROUPS.get(ticket.code, ()):
+                if sibling not in codes:
+                    self.shadow.pop(sibling, None)
+
+    def _display_confirmed(self, ticket):
+
+        # The firmware answers both commands, but only switches with the argument 1 (on) or 0 (off)
+
+        if ticket.confirmed and ticket.payload == bytes((ticket.code == DISPLAY_ON,)):
+            self.display = ticket.code == DISPLAY_ON
+
+    def _train_done(self, ticket):
+
+        if ticket is not self._train:
+            return
+
+        self.idle.set()
+
+        if self.held:
+
+            if self.flow is None:
+                self.release()
+            else:
+                threading.Thread(target=self.release, daemon=True).start()  # May wait for replies
+
+    def _check_deadline(self):
+
+        # Give up on a train whose end-of-sequence byte is overdue: its ticket is resolved as
+        # not confirmed, which ends the busy state and releases the held frames. The deadline
+        # is predicted on the first poll after the start (not while the start byte is written).
+
+        train = self._train
+
+        if train is None or train.done or train.written is None:
+            return
+
+        if self.deadline is None or self.deadline[0] is not train:
+
+            # A start sent during a train is read once that train has ended
+            begin = train.written
+            previous = self._previous
+
+            if previous is not None and not previous[0].done:
+                duration = self.train_duration(previous[1])
+                begin = max(begin, previous[0].written + (TRAIN_TIMEOUT if duration is None else duration))
+
+            duration = self.train_duration(self._train_frame)
+            duration = TRAIN_TIMEOUT if duration is None else duration
+            self.deadline = (train, begin + duration * (1 + DEADLINE_SLACK) + DEADLINE_MARGIN)
+
+        if time.perf_counter() < self.deadline[1] or not self.pending.discard(train):
+            return
+
+        self.overruns += 1
+        train.resolve(None, time.perf_counter())
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Timed release of commands
+# -----------------------------------------------------------------------------
+# Description:
+# Base of the threads that write commands at planned times (protocol
+# scheduler, voltage ramps, closed-loop control): a hybrid sleep/spin wait on
+# the monotonic performance counter, and a write that is only made while the
+# thread is still running. Both end at stop() or at an emergency stop of the
+# pool, which is checked under the port's write lock. Also the percentiles
+# used by their timing summaries and by the benchmarks.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import threading
+import time
+
+##################################################################################################################################
+
+# Statistics
+
+
+def percentile(values, q):
+
+    # Nearest-rank percentile of a sorted list
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+##################################################################################################################################
+
+# Timed threads
+
+
+class TimedThread(threading.Thread):
+
+    def __init__(self, pool, spin=0.002):
+
+        super().__init__(daemon=True)
+
+        self.pool = pool
+        self.spin = spin                        # Busy-wait this long before each write (s)
+        self.stopped = threading.Event()
+        self.stop_count = pool.stop_count       # An emergency stop of the pool ends the thread
+
+    def running(self):
+
+        return not self.stopped.is_set() and self.pool.stop_count == self.stop_count
+
+    def wait_until(self, t):
+
+        # Sleep until shortly before t, then spin on the performance counter.
+        # Returns False if the thread was stopped while waiting.
+
+        remaining = t - time.perf_counter() - self.spin
+
+        if remaining > 0 and self.stopped.wait(remaining):
+            return False
+
+        while time.perf_counter() < t:
+            pass
+
+        return self.running()
+
+    def release(self, stimulator, frame, tickets, codes, check=None):
+
+        # Write a prepared frame (see Stimulator.prepare) once the device is idle: a frame sent
+        # during a train would only be read after it and would sit in front of a later stop
+        # byte. Returns the write time, or None if the thread was stopped first (checked under
+        # the write lock, so nothing is written after an emergency stop). check: condition for
+        # the write instead of running().
+
+        check = check or self.running
+
+        while True:
+
+            with stimulator.write_lock:
+
+                if not check():
+                    return None
+
+                if not stimulator.busy:
+                    return stimulator.transmit(frame, tickets, codes)
+
+            stimulator.idle.wait(0.01)
+
+    def stop(self):
+
+        self.stopped.set()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Vectorized encoding of whole trial protocols (NumPy)
+# -----------------------------------------------------------------------------
+# Description:
+# Encodes arrays of trial parameters into the firmware's byte frames in one
+# pass. All conversions use integer arithmetic on microseconds and 0.5mV steps
+# and every value is checked against the firmware limits before encoding, so
+# a 10,000-trial protocol is precompiled in milliseconds.
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import numpy as np
+
+from .protocol import (SET_COUNT, SET_PERIOD_MS, SET_PERIOD_US, SET_TRIGGER, SET_VOLTAGE,
+                       SET_WIDTH_MS, SET_WIDTH_US)
+
+##################################################################################################################################
+
+# Firmware limits (DS5_Controller.ino)
+
+TRIGGER_MAX = 3
+COUNT_MIN, COUNT_MAX = 1, 9999
+US_MIN, US_MAX = 10, 9999             # 0x3A / 0x39: 1us steps
+MS_MIN, MS_MAX = 100, 6553500         # 0x58 / 0x57: 0.1ms steps, in us (firmware clamps at
+                                      # 9999900us, but a 16-bit argument ends at 6553.5ms)
+VOLTAGE_MAX = 4095                    # 0.5mV steps
+
+# Frame layout per trial: trigger (optional), count, period, width, voltage
+# (command byte + high byte + low byte each; the trigger has a single argument byte)
+
+FRAME_SIZE = 12
+TRIGGER_FRAME_SIZE = 14
+
+##################################################################################################################################
+
+# Range checks
+
+
+def _check(name, values, valid):
+
+    bad = np.flatnonzero(~valid)
+
+    if bad.size:
+        shown = ", ".join(str(i) for i in bad[:10]) + (", ..." if bad.size > 10 else "")
+        raise ValueError("%s out of range in %i trial(s): %s" % (name, bad.size, shown))
+
+
+def _integer(name, values):
+
+    values = np.asarray(values)
+
+    if values.dtype.kind == "f":
+        _check(name + " (not a whole number)", values, values == np.floor(values))
+
+    return values.astype(np.int64)
+
+
+def _time_commands(name, values_us, us_code, ms_code):
+
+    # Values up to 9999us are sent in us, longer ones in 0.1ms steps (must be exact)
+
+    fine = values_us <= US_MAX
+
+    _check(name, values_us, np.where(fine, values_us >= US_MIN,
+                                     (values_us <= MS_MAX) & (values_us % 100 == 0)))
+
+    codes = np.where(fine, us_code, ms_code).astype(np.uint8)
+    words = np.where(fine, values_us, values_us // 100)
+
+    return codes, words
+
+##################################################################################################################################
+
+# Encoder
+
+
+def encode_trials(count, period_us, width_us, voltage_mv, trigger=None):
+
+    # One frame per trial as an (n, FRAME_SIZE) uint8 array (TRIGGER_FRAME_SIZE with a
+    # trigger). Arguments are arrays (or scalars) of equal length; periods and widths are
+    # in whole microseconds, voltages in mV (rounded down to 0.5mV like encode_voltage).
+    # Raises ValueError naming the offending trials if any value is outside the firmware limits.
+
+    count = _integer("count", count)
+    period_us = _integer("period_us", period_us)
+    width_us = _integer("width_us", width_us)
+    voltage = np.asarray(voltage_mv, dtype=np.float64) * 2   # Exact in floating point
+
+    arrays = [count, period_us, width_us, voltage]
+
+    if trigger is not None:
+        trigger = _integer("trigger", trigger)
+        arrays.append(trigger)
+
+    arrays = np.broadcast_arrays(*arrays)
+    count, period_us, width_us, voltage = arrays[:4]
+
+    _check("count", count, (count >= COUNT_MIN) & (count <= COUNT_MAX))
+    _check("voltage_mv", voltage, (voltage >= 0) & (voltage < VOLTAGE_MAX + 1))
+
+    voltage = np.floor(voltage).astype(np.int64)
+
+    period_codes, periods = _time_commands("period_us", period_us, SET_PERIOD_US, SET_PERIOD_MS)
+    width_codes, widths = _time_commands("width_us", width_us, SET_WIDTH_US, SET_WIDTH_MS)
+
+    offset = 0
+
+    if trigger is not None:
+        trigger = arrays[4]
+        _check("trigger", trigger, (trigger >= 0) & (trigger <= TRIGGER_MAX))
+        frames = np.empty((count.size, TRIGGER_FRAME_SIZE), dtype=np.uint8)
+        frames[:, 0] = SET_TRIGGER
+        frames[:, 1] = trigger.ravel()
+        offset = 2
+
+    else:
+        frames = np.empty((count.size, FRAME_SIZE), dtype=np.uint8)
+
+    for code, words in ((SET_COUNT, count), (period_codes, periods),
+                        (width_codes, widths), (SET_VOLTAGE, voltage)):
+
+        words = words.ravel()
+
+        frames[:, offset] = np.ravel(code)
+        frames[:, offset + 1] = words >> 8      # High byte
+        frames[:, offset + 2] = words & 0xFF    # Low byte
+
+        offset += 3
+
+    return frames
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Shared test fixtures
+# -----------------------------------------------------------------------------
+# Description:
+# A fast firmware emulator with a one-device pool for the tests that run
+# against the pseudo-terminal emulator (Linux, needs pyserial).
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+##################################################################################################################################
+
+
+@pytest.fixture
+def device():
+
+    pytest.importorskip("serial")
+
+    from fnmes import StimulatorPool
+    from fnmes.emulator import FirmwareEmulator
+
+    emulator = FirmwareEmulator(boot_time=0.05, splash_time=0, blink_time=0.01)
+    pool = StimulatorPool.open([emulator.port])
+
+    yield emulator, pool
+
+    pool.close()
+    emulator.close()
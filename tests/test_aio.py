@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Asyncio client tests
+# -----------------------------------------------------------------------------
+# Description:
+# Runs the asyncio client against the pseudo-terminal firmware emulator
+# (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("serial")
+
+from fnmes import wait_all
+from fnmes.aio import AsyncStimulator
+
+##################################################################################################################################
+
+
+def test_async_timeout_withdraws_held_frame(device):
+
+    # A voltage command that times out while held during a train is never written
+
+    emulator, pool = device
+
+    assert wait_all(pool[0].send_parameters(count=8, period_ms=100, width_us=200, voltage_mv=100), 1.0)
+
+    async def session():
+
+        dac = AsyncStimulator(pool[0])
+        train = asyncio.ensure_future(dac.start(timeout=2.0))
+        await asyncio.sleep(0.1)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await dac.voltage(500, timeout=0.2)
+
+        await train
+
+    asyncio.run(session())
+    time.sleep(0.1)
+
+    assert not pool[0].held
+    assert emulator.voltage == 200      # 100 mV in 0.5 mV steps
+
+
+def test_flow_controlled_send_does_not_block_loop():
+
+    # A write that waits for credits leaves the event loop free for other coroutines
+
+    from fnmes import StimulatorPool
+    from fnmes.emulator import FirmwareEmulator
+    from fnmes.protocol import encode_voltage
+
+    emulator = FirmwareEmulator(boot_time=0.05, splash_time=0, blink_time=0.01)
+    pool = StimulatorPool.open([emulator.port], flow=True)
+
+    try:
+        stimulator = pool[0]
+        stimulator.flow.window = stimulator.flow.max_window = 1
+
+        async def session():
+
+            dac = AsyncStimulator(stimulator)
+            frame = b"".join(encode_voltage(voltage) for voltage in range(0, 200, 10))
+            send = asyncio.ensure_future(dac.send(frame, timeout=5.0))
+            gaps = []
+
+            while not send.done():
+                t = time.perf_counter()
+                await asyncio.sleep(0.005)
+                gaps.append(time.perf_counter() - t)
+
+            await send
+
+            return gaps
+
+        gaps = asyncio.run(session())
+
+        assert max(gaps) < 0.1
+        assert emulator.voltage == 2 * 190
+
+    finally:
+        pool.close()
+        emulator.close()
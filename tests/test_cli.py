@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Command-line tests
+# -----------------------------------------------------------------------------
+# Description:
+# Runs the command-line entry point against the pseudo-terminal firmware
+# emulator (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+pytest.importorskip("serial")
+
+from fnmes.cli import main
+from fnmes.emulator import FirmwareEmulator
+
+##################################################################################################################################
+
+
+@pytest.mark.parametrize("command", ("start", "query"))
+def test_cli_after_reset(command, capsys):
+
+    # Opening the port resets the device; the first command waits for the start screen
+
+    emulator = FirmwareEmulator()
+
+    try:
+        if command == "start":
+            assert main(["-p", emulator.port, "start", "--count", "2", "--period-ms", "10",
+                         "--voltage-mv", "100", "--wait"]) == 0
+            assert [train.pulses for train in emulator.trains] == [2]
+
+        else:
+            assert main(["-p", emulator.port, "query"]) == 0
+            assert "no data" not in capsys.readouterr().out
+
+    finally:
+        emulator.close()
+
+
+def test_cli_start_sends_given_parameters():
+
+    # Parameters left out of the command line keep the firmware defaults (1 pulse at 2000 mV)
+
+    emulator = FirmwareEmulator()
+
+    try:
+        assert main(["-p", emulator.port, "start", "--period-ms", "20", "--width-us", "100",
+                     "--wait"]) == 0
+        assert [(train.pulses, train.voltage, train.period) for train in emulator.trains] == [
+            (1, 4000, 20000)]
+
+    finally:
+        emulator.close()
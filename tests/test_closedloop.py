@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Closed-loop control tests
+# -----------------------------------------------------------------------------
+# Description:
+# Sample parsing (no device needed) and amplitude control of the
+# pseudo-terminal firmware emulator (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import time
+
+import pytest
+
+from fnmes import AmplitudeController, wait_all
+from fnmes.closedloop import parse_sample
+
+##################################################################################################################################
+
+
+class ConstantSignal:
+
+    # A signal whose latest sample is always fresh
+
+    def __init__(self, value):
+
+        self.value = value
+
+    def latest(self):
+
+        return self.value, time.perf_counter(), 1
+
+
+def test_parse_sample():
+
+    assert parse_sample(b"1.5\n") == 1.5
+    assert parse_sample(b"0.1, 2; 3.25\n") == 3.25
+    assert parse_sample(b"0.1\t2\t3\n", 0) == 0.1
+
+    with pytest.raises(ValueError):
+        parse_sample(b"nan\n")
+
+
+def test_floor_after_rounding(device):
+
+    # Commands are rounded to 0.5 mV steps without going below the floor or above the ceiling
+
+    emulator, pool = device
+    loop = AmplitudeController(pool, 0, ConstantSignal(0), floor_mv=100.2, ceiling_mv=300.7)
+
+    assert loop.step(loop.target(0)) == 100.5
+    assert loop.step(loop.target(1000)) == 300.5
+
+    with pytest.raises(ValueError):
+        AmplitudeController(pool, 0, ConstantSignal(0), floor_mv=100.2, ceiling_mv=100.4)
+
+
+def test_loop_and_park(device):
+
+    emulator, pool = device
+    loop = AmplitudeController(pool, 0, ConstantSignal(2), rate_hz=50, gain_mv=100, ceiling_mv=500,
+                               duration=0.3, park_mv=50)
+    loop.start()
+    loop.join(2.0)
+
+    assert not loop.aborted
+    assert [tick.command_mv for tick in loop.ticks if tick.state == "sent"] == [200]
+    assert emulator.voltage == 100      # Parked at 50 mV
+
+
+def test_no_command_after_stop(device):
+
+    # An emergency stop between a tick's wait and its write ends the loop without the write
+    # and without the park voltage
+
+    class StoppedBeforeWrite(AmplitudeController):
+
+        def wait_until(self, t):
+
+            running = super().wait_until(t)
+            self.pool.emergency_stop()
+
+            return running
+
+    emulator, pool = device
+
+    assert wait_all(pool[0].send_parameters(voltage_mv=100), 1.0)
+
+    loop = StoppedBeforeWrite(pool, 0, ConstantSignal(2), gain_mv=100, ceiling_mv=500)
+    loop.start()
+    loop.join(2.0)
+
+    assert loop.aborted and not loop.ticks
+    assert emulator.voltage == 200
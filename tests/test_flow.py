@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Flow control tests
+# -----------------------------------------------------------------------------
+# Description:
+# Credit window accounting (no device needed) and paced writes against the
+# pseudo-terminal firmware emulator (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import threading
+import time
+
+import pytest
+
+from fnmes import CreditWindow, Ticket
+from fnmes.protocol import SET_VOLTAGE, START_PULSE, encode_voltage
+
+##################################################################################################################################
+
+
+def test_lost_train_end_gives_back_credit():
+
+    # A start whose end-of-sequence byte never arrives does not block the window for good
+
+    window = CreditWindow(train_timeout=0.2)
+    window.register([(START_PULSE, 1, Ticket(START_PULSE))])
+
+    assert window.acquire([(SET_VOLTAGE, 3, Ticket(SET_VOLTAGE, b"\0\0"))]) == 1
+    assert window.stats()["expired"] == 1
+
+
+def test_emergency_stop_ends_paced_frame():
+
+    # Commands of a paced frame that were not written before the stop are never written
+
+    pytest.importorskip("serial")
+
+    from fnmes import StimulatorPool
+    from fnmes.emulator import FirmwareEmulator
+
+    emulator = FirmwareEmulator(boot_time=0.05, splash_time=0, blink_time=0.01)
+    pool = StimulatorPool.open([emulator.port], flow=True)
+
+    try:
+        stimulator = pool[0]
+        stimulator.flow.window = stimulator.flow.max_window = 1
+
+        frame = b"".join(encode_voltage(voltage) for voltage in range(0, 400, 10))
+        sender = threading.Thread(target=stimulator.send, args=(frame,))
+        sender.start()
+        time.sleep(0.2)
+
+        pool.emergency_stop()
+        sender.join(1.0)
+        voltage = emulator.voltage
+        time.sleep(0.5)
+
+        assert not sender.is_alive()
+        assert emulator.voltage == voltage < 2 * 390
+
+    finally:
+        pool.close()
+        emulator.close()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Serial link tests
+# -----------------------------------------------------------------------------
+# Description:
+# Opens the pseudo-terminal firmware emulator with its real start screen
+# (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip("serial")
+
+from fnmes.emulator import FirmwareEmulator
+from fnmes.link import open_device
+
+##################################################################################################################################
+
+
+def test_baudrate_after_start_screen():
+
+    # With the real start screen, the switch is negotiated once the firmware reads commands,
+    # and both sides end up at the new rate
+
+    emulator = FirmwareEmulator()
+
+    try:
+        ser = open_device(emulator.port, 115200)
+
+        try:
+            assert ser.baudrate == 115200
+            time.sleep(0.6)     # Longer than the firmware's wait for the confirmation
+            assert emulator.baudrate == 115200
+
+        finally:
+            ser.close()
+
+    finally:
+        emulator.close()
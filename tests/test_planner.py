@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Session planner tests
+# -----------------------------------------------------------------------------
+# Description:
+# Plans trial lists and checks the trains, carried-over settings, conflicts
+# and charge (no device needed, needs NumPy).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from fnmes import Trial
+from fnmes.planner import plan_trials
+
+##################################################################################################################################
+
+
+def test_carry_over():
+
+    # Settings a trial leaves out come from the same DAC's previous trial, or from the
+    # firmware defaults (1 x 1000 ms, 50 ms, 2000 mV) for its first trial
+
+    plan = plan_trials([Trial(0, dict(count=3, period_ms=10, width_us=100, voltage_mv=250), 1.0),
+                        Trial(1, dict(period_ms=20), 1.0),
+                        Trial(0, dict(period_ms=20), 1.0)])
+
+    assert plan.count.tolist() == [3, 1, 3]
+    assert plan.period_us.tolist() == [10000, 20000, 20000]
+    assert plan.width_us.tolist() == [100, 50000, 100]
+    assert plan.voltage_mv.tolist() == [250.0, 2000.0, 250.0]
+
+
+def test_timeline():
+
+    plan = plan_trials([Trial(0, dict(count=3, period_ms=10, width_us=100), 0.015),
+                        Trial(0, dict(count=1, period_ms=10, width_us=100), 0.1)], start_delay=0.5)
+
+    assert plan.start.tolist() == [0.5, 0.515]
+    assert np.allclose(plan.duration, [0.0201, 0.0001])
+    assert plan.conflict.tolist() == [False, True]     # Due while the first train still runs
+
+    onsets, offsets, trial = plan.pulses(dac=0)
+
+    assert np.allclose(onsets, [0.5, 0.51, 0.52, 0.515])
+    assert np.allclose(offsets - onsets, 0.0001)
+    assert trial.tolist() == [0, 0, 0, 1]
+
+    starts, ends = plan.busy_windows(0)
+
+    assert np.allclose(starts, [0.5]) and np.allclose(ends, [0.5201])
+
+
+def test_charge():
+
+    # 500 mV at 10 mA/V is 5 mA: 100 us pulses carry 0.5 uC, half per phase when bipolar
+
+    trials = [Trial(0, dict(count=4, period_ms=10, width_us=100, voltage_mv=500), 1.0)]
+
+    bipolar = plan_trials(trials, gain=10)
+    monopolar = plan_trials(trials, bipolar=False, gain=10)
+
+    assert np.allclose(bipolar.phase_charge_uc, 0.25)
+    assert np.allclose(monopolar.phase_charge_uc, 0.5)
+    assert np.allclose(bipolar.charge_uc, 2.0)
+    assert bipolar.summary()["devices"]["DAC1"]["pulses"] == 4
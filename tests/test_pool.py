@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Pool tests against the firmware emulator
+# -----------------------------------------------------------------------------
+# Description:
+# Synchronized starts and emergency stops of the stimulator pool against
+# the pseudo-terminal firmware emulator (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip("serial")
+
+from fnmes import wait_all
+
+##################################################################################################################################
+
+
+def test_start_start_stop(device):
+
+    # A second start during a train is refused, so the stop byte is the next byte the
+    # firmware reads and ends the running train
+
+    emulator, pool = device
+
+    assert wait_all(pool[0].send_parameters(count=50, period_ms=100, width_us=200, voltage_mv=100), 1.0)
+
+    report = pool.start_synchronized()
+    time.sleep(0.3)
+
+    with pytest.raises(RuntimeError):
+        pool.start_synchronized(timeout=0.2)
+
+    stopped = time.perf_counter()
+    pool.emergency_stop()
+
+    assert report.tickets[0].wait(1.0)
+    assert report.tickets[0].received - stopped < 0.5
+
+    time.sleep(0.3)     # A queued start would begin another train here
+
+    assert len(emulator.trains) == 1
+    assert emulator.trains[0].aborted
+    assert emulator.trains[0].pulses < 50
+
+
+def test_streaming_display_off_not_confirmed(device):
+
+    # A display-off held behind a running train is not confirmed, so the batch does not run
+
+    emulator, pool = device
+
+    assert wait_all(pool[0].send_parameters(count=3, period_ms=100, width_us=200), 1.0)
+    pool.start_synchronized()
+
+    with pytest.raises(RuntimeError):
+        with pool.streaming(timeout=0.1):
+            pytest.fail("the batch ran with the display on")
+
+    pool.emergency_stop()
+    time.sleep(0.5)
+
+    assert pool[0].display
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Preset store tests
+# -----------------------------------------------------------------------------
+# Description:
+# Saves and reopens preset files (no device needed).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import struct
+
+import pytest
+
+from fnmes import PresetStore, encode_parameters
+
+##################################################################################################################################
+
+
+def test_preset_frames(tmp_path):
+
+    path = str(tmp_path / "presets.fnpreset")
+    parameters = [dict(count=2, voltage_mv=100), dict(count=3, width_us=200)]
+
+    with PresetStore(path) as store:
+        store.save("a", parameters)
+
+    with PresetStore(path) as store:
+        assert store.names() == ["a"]
+        assert store.frames("a") == [encode_parameters(**values) for values in parameters]
+
+
+def test_preset_version(tmp_path):
+
+    # A preset file of another format version is refused instead of sending its frames
+
+    path = str(tmp_path / "presets.fnpreset")
+
+    with PresetStore(path) as store:
+        store.save("a", [dict(count=2, voltage_mv=100)])
+
+    with open(path, "r+b") as file:
+        file.seek(8)
+        file.write(struct.pack("<I", 2))
+
+    with pytest.raises(ValueError, match="version 2"):
+        PresetStore(path)
+
+
+def test_closed_store(tmp_path):
+
+    path = str(tmp_path / "presets.fnpreset")
+
+    with PresetStore(path) as store:
+        store.save("a", [dict(count=2, voltage_mv=100)])
+
+    with pytest.raises(ValueError, match="closed"):
+        store.frames("a")
+
+    with pytest.raises(ValueError, match="closed"):
+        store.recall([], "a")
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Command encoding tests
+# -----------------------------------------------------------------------------
+# Description:
+# Checks the command encoders and parameter frames byte by byte against the
+# protocol of DS5_Controller.ino (no device needed).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+from fnmes import (encode_count, encode_display, encode_parameters, encode_period_ms,
+                   encode_voltage, encode_width_us)
+from fnmes.protocol import encode_trigger, split_frame
+
+##################################################################################################################################
+
+
+def test_encoders():
+
+    assert encode_trigger(3) == bytes((0x5A, 3))
+    assert encode_count(300) == bytes((0x59, 0x01, 0x2C))           # High byte, low byte
+    assert encode_period_ms(17) == bytes((0x58, 0x00, 0xAA))        # 0.1 ms steps
+    assert encode_width_us(100) == bytes((0x39, 0x00, 0x64))
+    assert encode_voltage(500.5) == bytes((0x53, 0x03, 0xE9))       # 0.5 mV steps
+    assert encode_display(False) == bytes((0x44, 0))
+    assert encode_display(True) == bytes((0x45, 1))
+
+
+def test_encoder_range():
+
+    with pytest.raises(ValueError):
+        encode_count(0x10000)
+
+    with pytest.raises(ValueError):
+        encode_trigger(-1)
+
+
+def test_parameter_frame():
+
+    # One frame in the GUI's order: trigger, count, period, width, voltage
+
+    frame = encode_parameters(trigger=0, count=30, period_ms=17, width_us=100, voltage_mv=500)
+
+    assert frame == bytes((0x5A, 0, 0x59, 0, 30, 0x58, 0, 170, 0x39, 0, 100, 0x53, 0x03, 0xE8))
+    assert [code for code, _ in split_frame(frame)] == [0x5A, 0x59, 0x58, 0x39, 0x53]
+
+
+def test_split_truncated():
+
+    with pytest.raises(ValueError):
+        list(split_frame(bytes((0x53, 0x03))))
+
+
+def test_parameters_left_out():
+
+    # Parameters that are not given are not sent, so the firmware keeps its current value
+
+    assert encode_parameters(period_ms=20) == bytes((0x58, 0x00, 0xC8))
+    assert encode_parameters(count=2, period_ms=0, width_us=0) == bytes((0x59, 0, 2))
+    assert encode_parameters() == b""
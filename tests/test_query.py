@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Query Data decoding tests
+# -----------------------------------------------------------------------------
+# Description:
+# Decodes Query Data records laid out as DS5_Controller.ino sends them
+# (no device needed).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+from fnmes import decode_query
+
+##################################################################################################################################
+
+
+def test_decode_defaults():
+
+    # Power-on settings: 2000 mV, 50 ms width, 1 x 1 s period (modulo 65536 us), trigger 3
+
+    record = bytes((1, 0x0F, 0xA0, 0xC3, 0x50, 0, 7, 0, 1, 0x42, 0x40, 3, 1, 1))
+    state = decode_query(record)
+
+    assert state.voltage == 4000 and state.voltage_mv == 2000
+    assert state.width == 50000
+    assert state.count == 7
+    assert state.repeat == 1
+    assert state.period == 1000000 % 65536
+    assert state.trigger == 3
+    assert state.bipolar and state.opamp_enabled
+
+
+def test_decode_not_a_record():
+
+    with pytest.raises(ValueError):
+        decode_query(bytes(14))                     # Wrong header byte
+
+    with pytest.raises(ValueError):
+        decode_query(bytes((1,) + (0,) * 12))       # Too short
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Voltage ramp tests
+# -----------------------------------------------------------------------------
+# Description:
+# Ramp trajectories (no device needed) and ramps streamed to the
+# pseudo-terminal firmware emulator (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+from fnmes import VoltageRamp, ramp_frames, ramp_voltages, wait_all
+
+##################################################################################################################################
+
+
+def test_ramp_voltages():
+
+    assert ramp_voltages(0, 100, 4) == [0, 25, 50, 75, 100]
+    assert ramp_voltages(0, 100, 2, shape="cosine") == [0, 50, 100]
+
+    with pytest.raises(ValueError):
+        ramp_frames([0, 500, 1500], ceiling_mv=1000)
+
+
+def test_ramp(device):
+
+    emulator, pool = device
+
+    ramp = VoltageRamp(pool, 0, ramp_voltages(0, 100, 10))
+    ramp.start()
+    ramp.join(2.0)
+
+    assert not ramp.aborted
+    assert ramp.summary()["unconfirmed"] == 0
+    assert emulator.voltage == 200
+
+
+def test_no_step_after_stop(device):
+
+    # An emergency stop between a step's wait and its write ends the ramp without the write
+
+    class StoppedBeforeWrite(VoltageRamp):
+
+        def wait_until(self, t):
+
+            running = super().wait_until(t)
+            self.pool.emergency_stop()
+
+            return running
+
+    emulator, pool = device
+
+    assert wait_all(pool[0].send_parameters(voltage_mv=100), 1.0)
+
+    ramp = StoppedBeforeWrite(pool, 0, [500, 600])
+    ramp.start()
+    ramp.join(2.0)
+
+    assert ramp.aborted and not ramp.steps
+    assert emulator.voltage == 200
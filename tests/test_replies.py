@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Reply parsing tests
+# -----------------------------------------------------------------------------
+# Description:
+# Feeds reply byte streams to the parser and matches replies to pending
+# commands (no device needed).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+from fnmes import PendingCommands, ReplyParser, Ticket
+from fnmes.protocol import QUERY, SET_COUNT, SET_VOLTAGE, START_PULSE
+
+##################################################################################################################################
+
+
+def test_parser_split_record():
+
+    # Status bytes are reported one by one; a query record split across reads is reassembled
+
+    replies, records = [], []
+    parser = ReplyParser(lambda reply, t: replies.append((reply, t)),
+                         lambda record, t: records.append((record, t)))
+
+    record = bytes((1,) + tuple(range(2, 15)))
+
+    parser.feed(bytes((120, 110)) + record[:5], 1.0)
+    parser.feed(record[5:] + bytes((100,)), 2.0)
+
+    assert replies == [(120, 1.0), (110, 1.0), (100, 2.0)]
+    assert records == [(record, 2.0)]
+
+
+def test_pending_in_order():
+
+    pending = PendingCommands()
+    count, voltage = Ticket(SET_COUNT), Ticket(SET_VOLTAGE)
+
+    pending.add(count)
+    pending.add(voltage)
+
+    assert pending.match(120, 1.0) is count
+    assert pending.match(110, 2.0) is voltage
+    assert count.confirmed and voltage.confirmed
+    assert len(pending) == 0
+
+
+def test_pending_lost_reply():
+
+    # A reply for a later command resolves the older ones without a reply as not confirmed
+
+    pending = PendingCommands()
+    count, voltage = Ticket(SET_COUNT), Ticket(SET_VOLTAGE)
+
+    pending.add(count)
+    pending.add(voltage)
+
+    assert pending.match(110, 1.0) is voltage
+    assert count.done and not count.confirmed
+    assert voltage.confirmed
+
+
+def test_pending_unsolicited():
+
+    # A byte no pending command expects (e.g. the ready byte after a reset) is ignored
+
+    pending = PendingCommands()
+    start = Ticket(START_PULSE)
+    pending.add(start)
+
+    assert pending.match(101, 1.0) is None
+    assert not start.done
+    assert len(pending) == 1
+
+
+def test_pending_record():
+
+    pending = PendingCommands()
+    query = Ticket(QUERY)
+    pending.add(query)
+
+    record = bytes(14)
+
+    assert pending.match(1, 1.0, record) is query
+    assert query.record == record
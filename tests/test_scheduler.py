@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Protocol scheduler tests
+# -----------------------------------------------------------------------------
+# Description:
+# Runs trial lists against the pseudo-terminal firmware emulator
+# (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip("serial")
+
+from fnmes import ProtocolScheduler, Trial, load_trials
+
+##################################################################################################################################
+
+
+def test_scheduler_emergency_stop(device):
+
+    # An emergency stop cancels the queued upload and ends the run: no start byte follows it
+
+    emulator, pool = device
+
+    parameters = dict(count=5, period_ms=20, width_us=200, voltage_mv=100)
+    scheduler = ProtocolScheduler(pool, [Trial(0, parameters, 0.15)] * 20, start_delay=0.1)
+
+    scheduler.start()
+    time.sleep(0.5)
+
+    pool.emergency_stop()
+    stopped = len(emulator.trains)
+
+    scheduler.join(1.0)
+
+    assert not scheduler.is_alive()
+    assert scheduler.aborted
+    assert 0 < len(scheduler.records) < 20
+
+    time.sleep(0.3)
+
+    assert len(emulator.trains) <= stopped + 1     # At most the train the stop interrupted
+
+
+def test_empty_cells_keep_values(device, tmp_path):
+
+    # A trial that leaves count and voltage empty runs with the previous trial's values
+
+    emulator, pool = device
+
+    path = tmp_path / "trials.csv"
+    path.write_text("dac,count,period_ms,width_us,voltage_mv,iti_ms\n"
+                    "1,3,10,100,250,200\n"
+                    "1,,20,,,200\n")
+
+    trials = load_trials(str(path))
+
+    assert trials[1].parameters == {"period_ms": 20.0}
+
+    scheduler = ProtocolScheduler(pool, trials, start_delay=0.1)
+    scheduler.start()
+    scheduler.join(2.0)
+    time.sleep(0.2)
+
+    assert [(train.pulses, train.voltage, train.period) for train in emulator.trains] == [
+        (3, 500, 10000), (3, 500, 20000)]
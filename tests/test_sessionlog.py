@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Session log tests
+# -----------------------------------------------------------------------------
+# Description:
+# Writes session logs and reads them back (no device needed, needs NumPy).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from fnmes import SessionLog, load_session, read_header, session_bytes
+from fnmes.sessionlog import RECEIVED, SENT
+
+##################################################################################################################################
+
+
+class Device:
+
+    # What SessionLog.attach() needs from a Stimulator
+
+    def __init__(self, name):
+
+        self.name = name
+        self.observers = []
+
+
+def test_round_trip(tmp_path):
+
+    path = str(tmp_path / "session.fnlog")
+    dac1, dac2 = Device("DAC1"), Device("DAC2")
+    frame = bytes(range(50))                    # Split into three records
+
+    with SessionLog(path, capacity=16) as log:
+
+        log.attach(dac1)
+        log.attach(dac2)
+
+        log.sent(dac1, frame, [], 1.0)
+        log.received(dac1, b"\x78\x6e", 1.5)
+        log.sent(dac2, b"\x50", [], 2.0)
+
+    header = read_header(path)
+    records = load_session(path)
+
+    assert header["devices"] == ["DAC1", "DAC2"]
+    assert header["written"] == 5
+    assert records["t_ns"].tolist() == [10 ** 9] * 3 + [15 * 10 ** 8, 2 * 10 ** 9]
+    assert session_bytes(records, 0, SENT) == frame
+    assert session_bytes(records, 0, RECEIVED) == b"\x78\x6e"
+    assert session_bytes(records, 1, SENT) == b"\x50"
+
+
+def test_ring(tmp_path):
+
+    # Once the ring is full, the oldest records are overwritten and the rest read oldest first
+
+    path = str(tmp_path / "session.fnlog")
+    dac = Device("DAC1")
+
+    with SessionLog(path, capacity=4) as log:
+
+        log.attach(dac)
+
+        for i in range(6):
+            log.sent(dac, bytes((i,)), [], float(i))
+
+    assert session_bytes(load_session(path), 0, SENT) == bytes((2, 3, 4, 5))
+
+
+def test_not_a_log(tmp_path):
+
+    path = tmp_path / "other.bin"
+    path.write_bytes(bytes(4096))
+
+    with pytest.raises(ValueError):
+        read_header(str(path))
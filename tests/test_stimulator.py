@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+# -----------------------------------------------------------------------------
+# fNMES-GUI: Stimulator tests
+# -----------------------------------------------------------------------------
+# Description:
+# Delta sync of parameter uploads against the pseudo-terminal firmware
+# emulator (Linux, needs pyserial).
+# Run as: python -m pytest tests
+# -----------------------------------------------------------------------------
+# License:
+# This project is licensed under the MIT License - see the LICENSE.md file for details.
+# -----------------------------------------------------------------------------
+"""
+
+import pytest
+
+pytest.importorskip("serial")
+
+from fnmes import wait_all
+from fnmes.protocol import SET_PERIOD_MS, SET_PERIOD_US, SET_VOLTAGE
+
+##################################################################################################################################
+
+
+def codes(tickets):
+
+    return [ticket.code for ticket in tickets]
+
+
+def test_only_changes_are_sent(device):
+
+    emulator, pool = device
+    stimulator = pool[0]
+    parameters = dict(count=30, period_ms=17, width_us=100, voltage_mv=500)
+
+    assert wait_all(stimulator.send_parameters(**parameters), 1.0)
+    assert stimulator.send_parameters(**parameters) == []
+
+    tickets = stimulator.send_parameters(**dict(parameters, voltage_mv=600))
+
+    assert codes(tickets) == [SET_VOLTAGE]
+    assert wait_all(tickets, 1.0)
+    assert emulator.voltage == 1200
+
+
+def test_unit_switch(device):
+
+    # A period set in us replaces the one set in ms, and going back to the same ms value
+    # resends it, since the device's value now comes from the us command
+
+    emulator, pool = device
+    stimulator = pool[0]
+
+    assert wait_all(stimulator.send_parameters(period_ms=17), 1.0)
+
+    tickets = stimulator.send_parameters(period_us=500)
+
+    assert codes(tickets) == [SET_PERIOD_US]
+    assert wait_all(tickets, 1.0)
+    assert emulator.period == 500
+
+    tickets = stimulator.send_parameters(period_ms=17)
+
+    assert codes(tickets) == [SET_PERIOD_MS]
+    assert wait_all(tickets, 1.0)
+    assert emulator.period == 17000
+
+
+def test_force_and_invalidate(device):
+
+    emulator, pool = device
+    stimulator = pool[0]
+    parameters = dict(count=30, voltage_mv=500)
+
+    assert wait_all(stimulator.send_parameters(**parameters), 1.0)
+    assert len(stimulator.send_parameters(force=True, **parameters)) == 2
+
+    stimulator.invalidate()
+
+    assert len(stimulator.send_parameters(**parameters)) == 2